@@ -1,21 +1,20 @@
 import argparse
 import asyncio
 import logging
+import shutil
 import sys
+import tempfile
 from typing import List, Optional
 
-from . import __version__
+from . import __version__, tracing
 from .exceptions import KaptenError
+from .fleet import Client, Fleet, parse_endpoint
 from .log import logger
+from .state import StateStore
 from .tool import Kapten
 
 
-def command(
-    input_args: Optional[List[str]] = None, disable_healthcheck: bool = False
-) -> None:
-    if input_args is None:
-        input_args = sys.argv[1:]
-
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         description="Checks for new images and updates services if needed."
     )
@@ -31,9 +30,23 @@ def command(
         type=str,
         action="append",
         dest="services",
-        help="Service to update.",
+        help=(
+            "Service to update. Also a glob, /regex/, label=KEY[=VALUE] "
+            "or image=GLOB selector."
+        ),
     )
     parser.add_argument("-p", "--project", type=str, help="Optional project name.")
+    parser.add_argument(
+        "-e",
+        "--endpoint",
+        type=str,
+        action="append",
+        dest="endpoints",
+        help=(
+            "Named Docker endpoint NAME=HOST, repeat for several. "
+            "Services prefixed NAME: are only tracked on that endpoint."
+        ),
+    )
 
     if has_feature("server"):
         parser.add_argument(
@@ -53,7 +66,73 @@ def command(
             type=str,
             help="Server token to use for webhook endpoints.",
         )
+        parser.add_argument(
+            "--delivery-ttl",
+            type=float,
+            default=3600.0,
+            help="Seconds to answer redelivered webhooks with their original job, "
+            "0 disables. [default: 3600]",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of server worker processes. [default: 1]",
+        )
+        parser.add_argument(
+            "--lock-dir",
+            type=str,
+            help="Directory shared between processes, locking updates of an image "
+            "and keeping job status. [default: new temp dir, with several workers]",
+        )
+        parser.add_argument(
+            "--resync-interval",
+            type=float,
+            default=300.0,
+            help="Seconds between full resyncs of tracked services. [default: 300]",
+        )
+        parser.add_argument(
+            "--debounce",
+            type=float,
+            default=0.0,
+            help="Seconds to collapse webhooks for the same image into one update, "
+            "latest wins. [default: 0]",
+        )
+        parser.add_argument(
+            "--job-workers",
+            type=int,
+            default=4,
+            help="Number of workers running queued webhook updates. [default: 4]",
+        )
+        parser.add_argument(
+            "--queue-size",
+            type=int,
+            default=100,
+            help="Max queued webhook updates before rejecting with 429. "
+            "[default: 100]",
+        )
 
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and poll for new images.",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=60.0,
+        help="Seconds between checks of each repository in watch mode. [default: 60]",
+    )
+    parser.add_argument(
+        "--min-interval",
+        type=float,
+        help="Shortest interval to adapt to for often pushed repositories.",
+    )
+    parser.add_argument(
+        "--max-interval",
+        type=float,
+        help="Longest interval to adapt to for rarely pushed repositories.",
+    )
     parser.add_argument(
         "--slack-token", type=str, help="Slack token to use for notification."
     )
@@ -68,6 +147,88 @@ def command(
         help="Only check if service needs to be updated.",
     )
     parser.add_argument("--force", action="store_true", help="Force service update.")
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=10,
+        help="Max pooled connections to the Docker API. [default: 10]",
+    )
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=5.0,
+        help="Docker API connect timeout in seconds. [default: 5]",
+    )
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=5.0,
+        help="Docker API read timeout in seconds. [default: 5]",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=2,
+        help="Retries of failed idempotent Docker API calls. [default: 2]",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=60.0,
+        help="Seconds to cache resolved image digests, 0 disables. [default: 60]",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=1024,
+        help="Max number of cached image digests. [default: 1024]",
+    )
+    parser.add_argument(
+        "--state-file",
+        type=str,
+        help="SQLite file keeping last known image digests across restarts.",
+    )
+    parser.add_argument(
+        "--trace-file",
+        type=str,
+        help="Append a JSON line per Docker, registry and webhook call to file.",
+    )
+    parser.add_argument(
+        "--registry-lookup",
+        action="store_true",
+        help="Resolve digests directly from the image registry.",
+    )
+    parser.add_argument(
+        "--lookup-concurrency",
+        type=int,
+        default=10,
+        help="Max concurrent image digest lookups. [default: 10]",
+    )
+    parser.add_argument(
+        "--update-concurrency",
+        type=int,
+        default=5,
+        help="Max concurrent service updates. [default: 5]",
+    )
+    parser.add_argument(
+        "--waves",
+        type=str,
+        help=(
+            "Update services in waves, per stack, per label:KEY or N at a time, "
+            "waiting for each wave to converge."
+        ),
+    )
+    parser.add_argument(
+        "--wait",
+        action="store_true",
+        help="Wait for updated services to converge and report deploy durations.",
+    )
+    parser.add_argument(
+        "--rollout-timeout",
+        type=float,
+        default=300.0,
+        help="Seconds to wait for a service to converge. [default: 300]",
+    )
     parser.add_argument(
         "-v",
         "--verbosity",
@@ -76,6 +237,16 @@ def command(
         help="Level of verbosity. [default: 1]",
     )
 
+    return parser
+
+
+def command(
+    input_args: Optional[List[str]] = None, disable_healthcheck: bool = False
+) -> None:
+    if input_args is None:
+        input_args = sys.argv[1:]
+
+    parser = build_parser()
     args = parser.parse_args(input_args)
 
     # Show version
@@ -87,24 +258,8 @@ def command(
     if not args.services:
         parser.error("Missing required argument SERVICES")
 
-    # Set verbosity
-    level = logging.INFO
-    if args.verbosity == 0:
-        level = logging.CRITICAL
-    elif args.verbosity > 1:
-        level = logging.DEBUG
-
-    logger.setLevel(level)
-
-    # Configure
-    client = Kapten(
-        args.services,
-        project=args.project,
-        slack_token=args.slack_token,
-        slack_channel=args.slack_channel,
-        only_check=args.check,
-        force=args.force,
-    )
+    configure(args)
+    client = build_client(parser, args)
 
     try:
         loop = asyncio.get_event_loop()
@@ -120,17 +275,135 @@ def command(
             if not args.webhook_token:
                 parser.error("Missing required argument WEBHOOK_TOKEN")
 
-            server.run(client, token=args.webhook_token, host=args.host, port=args.port)
+            # Worker processes always need to coordinate their updates, in a
+            # directory of this server's own, handed to them on the command line
+            lock_dir = args.lock_dir
+            if lock_dir is None and args.workers > 1:
+                lock_dir = tempfile.mkdtemp(prefix="kapten-")
+                input_args = input_args + ["--lock-dir", lock_dir]
+
+            # Pooled connections are bound to this loop, let the server reconnect
+            loop.run_until_complete(client.close())
+            try:
+                server.run(
+                    client,
+                    token=args.webhook_token,
+                    host=args.host,
+                    port=args.port,
+                    debounce=args.debounce,
+                    job_workers=args.job_workers,
+                    queue_size=args.queue_size,
+                    workers=args.workers,
+                    lock_dir=lock_dir,
+                    delivery_ttl=args.delivery_ttl,
+                    argv=input_args,
+                )
+            finally:
+                if lock_dir != args.lock_dir:
+                    shutil.rmtree(lock_dir, ignore_errors=True)
+
+        elif args.watch:
+            # Poll for new images until interrupted
+            from .scheduler import Scheduler
+
+            scheduler = Scheduler(
+                client,
+                interval=args.interval,
+                min_interval=args.min_interval,
+                max_interval=args.max_interval,
+            )
+            try:
+                loop.run_until_complete(scheduler.run())
+            except KeyboardInterrupt:
+                pass
+            finally:
+                loop.run_until_complete(client.close())
 
         else:
             # Run one-off check/update
-            loop.run_until_complete(client.update_services())
+            try:
+                loop.run_until_complete(client.update_services())
+            finally:
+                loop.run_until_complete(client.close())
 
     except KaptenError as e:
         logger.critical(str(e))
         exit(666)
 
 
+def configure(args: argparse.Namespace) -> None:
+    # Set verbosity
+    level = logging.INFO
+    if args.verbosity == 0:
+        level = logging.CRITICAL
+    elif args.verbosity > 1:
+        level = logging.DEBUG
+
+    logger.setLevel(level)
+
+    # Trace external calls
+    if args.trace_file:
+        tracing.add_hook(tracing.SpanFile(args.trace_file))
+
+
+def build_client(parser: argparse.ArgumentParser, args: argparse.Namespace) -> Client:
+    # Configure
+    options = dict(
+        project=args.project,
+        slack_token=args.slack_token,
+        slack_channel=args.slack_channel,
+        only_check=args.check,
+        force=args.force,
+        pool_size=args.pool_size,
+        cache_ttl=args.cache_ttl,
+        cache_size=args.cache_size,
+        registry_lookup=args.registry_lookup,
+        lookup_concurrency=args.lookup_concurrency,
+        update_concurrency=args.update_concurrency,
+        resync_interval=getattr(args, "resync_interval", 300.0),
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+        retries=args.retries,
+        waves=args.waves,
+        rollout_timeout=args.rollout_timeout,
+        wait=args.wait,
+        state=StateStore(args.state_file) if args.state_file else None,
+    )
+    client: Client
+    try:
+        if args.endpoints:
+            # Track services on several named Docker endpoints
+            endpoints = dict(map(parse_endpoint, args.endpoints))
+            client = Fleet(endpoints, args.services, **options)
+        else:
+            client = Kapten(args.services, **options)
+    except ValueError as e:
+        parser.error(str(e))
+
+    return client
+
+
+def worker(input_args: List[str]) -> None:
+    """
+    Configure a spawned server worker process from the server's command line.
+    """
+    from kapten import server
+
+    parser = build_parser()
+    args = parser.parse_args(input_args)
+    configure(args)
+
+    server.configure(
+        build_client(parser, args),
+        token=args.webhook_token,
+        debounce=args.debounce,
+        job_workers=args.job_workers,
+        queue_size=args.queue_size,
+        lock_dir=args.lock_dir,
+        delivery_ttl=args.delivery_ttl,
+    )
+
+
 def has_feature(name: str) -> bool:
     if name == "server":  # pragma: nocover
         try:
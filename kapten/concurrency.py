@@ -0,0 +1,226 @@
+import asyncio
+import fcntl
+import hashlib
+import os
+import time
+from collections import deque
+from functools import partial
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Hashable,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+T = TypeVar("T")
+
+
+class AdaptiveLimiter:
+    """
+    Limits concurrent calls, adapting the limit to observed behaviour.
+
+    The limit is halved when a call fails or exceeds the latency target,
+    and grows back by roughly one slot per limit's worth of healthy calls,
+    never leaving the range `min_limit` - `max_limit`.
+    """
+
+    def __init__(
+        self, max_limit: int, min_limit: int = 1, latency_target: float = 5.0
+    ) -> None:
+        self.max_limit = max(max_limit, 1)
+        self.min_limit = max(min(min_limit, self.max_limit), 1)
+        self.latency_target = latency_target
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    async def acquire(self) -> None:
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Pass on a wakeup we will not use
+                if waiter.done() and not waiter.cancelled():
+                    self._wakeup()
+                raise
+
+        self.in_flight += 1
+
+    def release(self, latency: float, failed: bool = False) -> None:
+        self.in_flight -= 1
+
+        if failed or latency > self.latency_target:
+            self.limit = max(float(self.min_limit), self.limit / 2)
+        else:
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+
+        self._wakeup()
+
+    def _wakeup(self) -> None:
+        available = int(self.limit) - self.in_flight
+        while available > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                available -= 1
+
+    async def call(
+        self, func: Callable[..., Awaitable[T]], *args: Any, **kwargs: Any
+    ) -> T:
+        await self.acquire()
+        start = time.monotonic()
+        failed = True
+        try:
+            result = await func(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            self.release(time.monotonic() - start, failed=failed)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one in-flight call,
+    whose result or error is shared with every caller.
+    """
+
+    def __init__(self) -> None:
+        self.flights: Dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self.flights)
+
+    async def call(
+        self, key: Hashable, func: Callable[..., Awaitable[T]], *args: Any
+    ) -> T:
+        future = self.flights.get(key)
+        if future is None:
+            future = self.flights[key] = asyncio.ensure_future(func(*args))
+            future.add_done_callback(partial(self.land, key))
+
+        # Leave the shared call running if this caller is cancelled
+        result: T = await asyncio.shield(future)
+        return result
+
+    def land(self, key: Hashable, future: asyncio.Future) -> None:
+        if self.flights.get(key) is future:
+            del self.flights[key]
+
+
+class Flight:
+    __slots__ = ("args", "started", "departed", "future")
+
+    def __init__(self, args: Tuple[Any, ...]) -> None:
+        self.args = args
+        self.started = False
+        self.departed = False
+        self.future: Optional[asyncio.Future] = None
+
+    def depart(self) -> None:
+        self.departed = True
+
+
+class BoardingFlight:
+    """
+    Coalesces calls with the same key like SingleFlight, but callers only join
+    a call until it departs, as signalled by the call itself through the
+    `depart` callable passed as its first argument, e.g. once it has looked up
+    what to do. Later callers queue one more call after it, shared by all of
+    them and made with the latest caller's arguments.
+    """
+
+    def __init__(self) -> None:
+        self.flights: Dict[Hashable, Flight] = {}
+
+    def __len__(self) -> int:
+        return len(self.flights)
+
+    async def call(
+        self, key: Hashable, func: Callable[..., Awaitable[T]], *args: Any
+    ) -> T:
+        flight = self.flights.get(key)
+        if flight is None or flight.departed:
+            previous = flight.future if flight is not None else None
+            flight = self.flights[key] = Flight(args)
+            flight.future = asyncio.ensure_future(self.fly(flight, previous, func))
+            flight.future.add_done_callback(partial(self.land, key, flight))
+        elif not flight.started:
+            # Latest wins
+            flight.args = args
+
+        # Leave the shared call running if this caller is cancelled
+        assert flight.future is not None
+        result: T = await asyncio.shield(flight.future)
+        return result
+
+    async def fly(
+        self,
+        flight: Flight,
+        previous: Optional[asyncio.Future],
+        func: Callable[..., Awaitable[T]],
+    ) -> T:
+        if previous is not None:
+            # Its outcome is for its own callers
+            await asyncio.wait([previous])
+        flight.started = True
+        return await func(flight.depart, *flight.args)
+
+    def land(self, key: Hashable, flight: Flight, future: asyncio.Future) -> None:
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+
+class FileLocks:
+    """
+    Exclusive locks per key, shared between processes as flock()ed files in
+    `directory`. A lock held elsewhere is polled for, with growing delays,
+    instead of blocking the event loop.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        poll_interval: float = 0.05,
+        max_poll_interval: float = 1.0,
+    ) -> None:
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{name}.lock")
+
+    async def acquire(self, key: str) -> int:
+        fd = os.open(self.path(key), os.O_RDWR | os.O_CREAT, 0o644)
+        delay = self.poll_interval
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except BlockingIOError:
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.max_poll_interval)
+        except BaseException:
+            os.close(fd)
+            raise
+
+    def release(self, fd: int) -> None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    async def call(self, key: str, func: Callable[..., Awaitable[T]], *args: Any) -> T:
+        fd = await self.acquire(key)
+        try:
+            return await func(*args)
+        finally:
+            self.release(fd)
@@ -1,78 +1,168 @@
+import asyncio
 import base64
-import copy
 import json
 import os
-from typing import Any, Dict, List, Mapping, Optional, Union
+from typing import (
+    Any,
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    TypeVar,
+    Union,
+)
 
 import httpx
-from httpx.exceptions import ConnectTimeout
+from httpx.exceptions import (
+    ConnectionClosed,
+    HTTPError,
+    ProtocolError,
+    TimeoutException,
+)
 from httpx.models import QueryParamTypes
 
-from .exceptions import KaptenAPIError, KaptenConnectionError
+from .exceptions import KaptenAPIError, KaptenConflictError, KaptenConnectionError
+from .retry import CircuitBreaker, backoff_delay
+from .tracing import span
 
+T = TypeVar("T")
 Filter = Optional[List[str]]
 
+# Transient, worth retrying idempotent requests for
+CONNECTION_ERRORS = (TimeoutException, ConnectionClosed, ProtocolError, OSError)
+
+
+class Service:
+    """
+    Parsed view of the service fields kapten uses. Of the raw service
+    document only `Spec` is kept, which is what service updates need.
+    """
+
+    __slots__ = (
+        "id",
+        "version",
+        "spec",
+        "name",
+        "stack",
+        "short_name",
+        "image_with_digest",
+        "image",
+        "digest",
+        "repository",
+        "labels",
+        "update_state",
+        "first_running_after",
+        "converged_after",
+    )
+
+    def __init__(self, data: Mapping[str, Any]) -> None:
+        self.id: str = data["ID"]
+        self.version: int = data["Version"]["Index"]
+        self.spec: Dict[str, Any] = data["Spec"]
+
+        container_spec = self.spec["TaskTemplate"]["ContainerSpec"]
+        labels = container_spec.get("Labels") or {}
+        self.name: str = self.spec["Name"]
+        self.stack: Optional[str] = labels.get("com.docker.stack.namespace")
+
+        self.short_name = self.name
+        if self.stack and self.name.startswith(self.stack + "_"):
+            self.short_name = self.name[len(self.stack) + 1 :]
+
+        self.image_with_digest: str = container_spec["Image"]
+        self.image, _, self.digest = self.image_with_digest.partition("@")
+
+        # Strip tag, but not a registry port
+        repository, separator, tag = self.image.rpartition(":")
+        self.repository = repository if separator and "/" not in tag else self.image
+
+        # Service labels, as matched by docker's label filter
+        self.labels: Dict[str, str] = self.spec.get("Labels") or {}
+        self.update_state: Optional[str] = (data.get("UpdateStatus") or {}).get("State")
+
+        # Seconds from update until a task ran and until converged, if followed
+        self.first_running_after: Optional[float] = None
+        self.converged_after: Optional[float] = None
+
+    def __repr__(self) -> str:
+        return f"<Service {self.name} {self.image_with_digest}>"
 
-class Service(dict):
-    @property
-    def id(self) -> str:
-        return self["ID"]
-
-    @property
-    def version(self) -> int:
-        return self["Version"]["Index"]
-
-    @property
-    def stack(self) -> str:
-        labels = self["Spec"]["TaskTemplate"]["ContainerSpec"]["Labels"]
-        return labels.get("com.docker.stack.namespace")
-
-    @property
-    def name(self) -> str:
-        return self["Spec"]["Name"]
-
-    @property
-    def short_name(self) -> str:
-        name = self.name
-        stack = self.stack
-        if stack and name.startswith(stack + "_"):
-            return name[len(stack) + 1 :]
-        return self.name
-
-    @property
-    def image_with_digest(self) -> str:
-        return self["Spec"]["TaskTemplate"]["ContainerSpec"]["Image"]
-
-    @property
-    def image(self) -> str:
-        image = self.image_with_digest
-        return image[: image.rindex("@")]
-
-    @property
-    def digest(self) -> str:
-        digest = self.image_with_digest
-        return digest[digest.rindex("@") + 1 :]
+    def clone(self, digest: str) -> "Service":
+        # Copy only the path down to the image, share everything else
+        spec = dict(self.spec)
+        task_template = spec["TaskTemplate"] = dict(spec["TaskTemplate"])
+        container_spec = dict(task_template["ContainerSpec"])
+        container_spec["Image"] = "{}@{}".format(self.image, digest)
+        task_template["ContainerSpec"] = container_spec
+
+        return Service(
+            {"ID": self.id, "Version": {"Index": self.version}, "Spec": spec}
+        )
 
-    @property
-    def repository(self) -> str:
-        repository = self.image
-        return repository[: repository.index(":")]
 
-    # @property
-    # def tag(self):
-    # image = self.image
-    # return image[image.index(":") + 1 :]
+class JSONArrayDecoder:
+    """
+    Incrementally decodes the items of a JSON array from text chunks.
+    """
 
-    def clone(self, digest: str) -> "Service":
-        clone = copy.deepcopy(self)
-        task_template = clone["Spec"]["TaskTemplate"]
-        task_template["ContainerSpec"]["Image"] = "{}@{}".format(self.image, digest)
-        return clone
+    def __init__(self) -> None:
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.started = False
+        self.finished = False
+
+    def feed(self, chunk: str) -> List[Any]:
+        items = []
+        buffer = self.buffer + chunk
+        position = 0
+        length = len(buffer)
+
+        while position < length and not self.finished:
+            char = buffer[position]
+            if char.isspace() or (self.started and char == ","):
+                position += 1
+            elif not self.started:
+                if char != "[":
+                    raise ValueError("Expected a JSON array")
+                self.started = True
+                position += 1
+            elif char == "]":
+                self.finished = True
+                position += 1
+            else:
+                try:
+                    item, end = self.decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    break  # Incomplete item, wait for more data
+
+                if end >= length:
+                    break  # Item may continue in next chunk
+
+                items.append(item)
+                position = end
+
+        self.buffer = buffer[position:]
+        return items
+
+    def close(self) -> None:
+        if not self.finished or self.buffer.strip():
+            raise ValueError("Incomplete JSON array")
 
 
 class DockerAPIClient:
-    def __init__(self) -> None:
-        base_url = os.environ.get("DOCKER_HOST", "unix://var/run/docker.sock")
+    def __init__(
+        self,
+        pool_size: int = 10,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 5.0,
+        retries: int = 2,
+        breaker: Optional[CircuitBreaker] = None,
+        host: Optional[str] = None,
+    ) -> None:
+        base_url = host or os.environ.get("DOCKER_HOST") or "unix://var/run/docker.sock"
         uds = None
 
         if base_url.startswith("unix://"):
@@ -81,7 +171,30 @@ class DockerAPIClient:
         else:
             base_url = base_url.replace("tcp://", "http://")
 
-        self.config: Mapping[str, Any] = {"base_url": base_url, "uds": uds}
+        self.config: Mapping[str, Any] = {
+            "base_url": base_url,
+            "uds": uds,
+            "pool_limits": httpx.PoolLimits(soft_limit=pool_size, hard_limit=pool_size),
+            # Wait for a free pooled connection instead of failing on bursts
+            "timeout": httpx.Timeout(
+                read_timeout, connect_timeout=connect_timeout, pool_timeout=None
+            ),
+        }
+        self._client: Optional[httpx.Client] = None
+        self.retries = retries
+        self.breaker = breaker or CircuitBreaker()
+
+    @property
+    def client(self) -> httpx.Client:
+        # Lazily open one long-lived, keep-alive connection pool
+        if self._client is None:
+            self._client = httpx.Client(**self.config)
+        return self._client
+
+    async def close(self) -> None:
+        client, self._client = self._client, None
+        if client is not None:
+            await client.close()
 
     def build_filters_param(self, **filters: Filter) -> Optional[Dict[str, str]]:
         params = {
@@ -104,6 +217,23 @@ class DockerAPIClient:
             )
         }
 
+    async def retrying(self, func: Callable[[], Awaitable[T]], retry: bool) -> T:
+        attempt = 0
+        while True:
+            self.breaker.check()
+            try:
+                result = await func()
+            except KaptenConnectionError:
+                self.breaker.failure()
+                if not retry or attempt >= self.retries or self.breaker.is_open:
+                    raise
+            else:
+                self.breaker.success()
+                return result
+
+            await asyncio.sleep(backoff_delay(attempt))
+            attempt += 1
+
     async def request(
         self,
         method: str,
@@ -112,25 +242,91 @@ class DockerAPIClient:
         params: Optional[QueryParamTypes] = None,
         data: Optional[Mapping] = None,
         authenticate: bool = False,
+        template: Optional[str] = None,
     ) -> Union[List, Dict]:
-        async with httpx.Client(**self.config) as client:
-            headers = self.get_auth_header() if authenticate else {}
+        # Only retry idempotent requests
+        retry = method in ("GET", "HEAD")
+        return await self.retrying(
+            lambda: self.send(
+                method,
+                url,
+                params=params,
+                data=data,
+                authenticate=authenticate,
+                template=template,
+            ),
+            retry=retry,
+        )
 
+    async def send(
+        self,
+        method: str,
+        url: str,
+        *,
+        params: Optional[QueryParamTypes] = None,
+        data: Optional[Mapping] = None,
+        authenticate: bool = False,
+        template: Optional[str] = None,
+    ) -> Union[List, Dict]:
+        headers = self.get_auth_header() if authenticate else {}
+
+        with span("docker", method, template or url) as current:
             try:
-                response = await client.request(
+                response = await self.client.request(
                     method, url, params=params or {}, json=data, headers=headers
                 )
+                current.status = response.status_code
+                current.bytes = len(response.content)
                 result = response.json()
-            except ConnectTimeout as e:
+            except CONNECTION_ERRORS as e:
+                # The pool drops the broken connection by itself, keep any other
+                # connection in use, or idle and alive, as is
                 raise KaptenConnectionError("Docker API Connection Error") from e
-            except Exception as e:  # pragma: nocover
+            except (HTTPError, ValueError) as e:
                 raise KaptenAPIError(f"Docker API Error: {str(e)}") from e
 
             if response.status_code >= 400:
-                message = result["message"] if isinstance(result, dict) else "?"
-                raise KaptenAPIError(f"Docker API Error: {message}")
+                raise self.response_error(response.status_code, result)
 
-            return result
+        return result
+
+    def response_error(self, status_code: int, result: Any) -> KaptenAPIError:
+        message = result["message"] if isinstance(result, dict) else "?"
+        message = f"Docker API Error: {message}"
+
+        if status_code in (502, 503, 504):
+            # Manager unavailable, e.g. swarm without leader
+            return KaptenConnectionError(message)
+        elif "update out of sequence" in message:
+            return KaptenConflictError(message)
+
+        return KaptenAPIError(message)
+
+    async def stream_array(
+        self, url: str, *, params: Optional[QueryParamTypes] = None
+    ) -> AsyncGenerator[Any, None]:
+        with span("docker", "GET", url) as current:
+            try:
+                async with self.client.stream(
+                    "GET", url, params=params or {}
+                ) as response:
+                    current.status = response.status_code
+                    if response.status_code >= 400:
+                        await response.read()
+                        raise self.response_error(response.status_code, response.json())
+
+                    # Decode items as chunks arrive instead of buffering everything
+                    decoder = JSONArrayDecoder()
+                    current.bytes = 0
+                    async for chunk in response.aiter_text():
+                        current.bytes += len(chunk)
+                        for item in decoder.feed(chunk):
+                            yield item
+                    decoder.close()
+            except CONNECTION_ERRORS as e:
+                raise KaptenConnectionError("Docker API Connection Error") from e
+            except (HTTPError, ValueError) as e:
+                raise KaptenAPIError(f"Docker API Error: {str(e)}") from e
 
     async def version(self) -> Dict:
         result = await self.request("GET", "/version")
@@ -141,15 +337,73 @@ class DockerAPIClient:
     # params = self.build_filters_param(**filters)
     # return await self.request("GET", "/containers/json", params=params)
 
-    async def services(self, **filters: Filter) -> List[Service]:
+    async def services(
+        self, keep: Optional[Callable[[Service], bool]] = None, **filters: Filter
+    ) -> List[Service]:
         params = self.build_filters_param(**filters)
-        result = await self.request("GET", "/services", params=params)
+
+        async def list_services() -> List[Service]:
+            services = []
+            async for data in self.stream_array("/services", params=params):
+                service = Service(data)
+                if keep is None or keep(service):
+                    services.append(service)
+            return services
+
+        return await self.retrying(list_services, retry=True)
+
+    async def service(self, id_or_name: str) -> Service:
+        result = await self.request(
+            "GET", f"/services/{id_or_name}", template="/services/{id}"
+        )
+        assert isinstance(result, dict), "Invalid response"
+        return Service(result)
+
+    async def tasks(self, **filters: Filter) -> List[Dict]:
+        params = self.build_filters_param(**filters)
+        result = await self.request("GET", "/tasks", params=params)
         assert isinstance(result, list), "Invalid response"
-        return [Service(service) for service in result]
+        return result
+
+    async def events(
+        self,
+        on_connect: Optional[Callable[[], Awaitable[None]]] = None,
+        **filters: Filter,
+    ) -> AsyncGenerator[Dict, None]:
+        params = self.build_filters_param(**filters)
+
+        # Events are streamed, never time out waiting for the next one
+        timeout = httpx.Timeout(5.0, read_timeout=None, pool_timeout=None)
+
+        # The stream holds its connection for as long as it is followed, use
+        # one of its own to leave the shared pool, and on_connect, unblocked
+        config = {**self.config, "pool_limits": httpx.PoolLimits(hard_limit=1)}
+
+        try:
+            async with httpx.Client(**config) as client:
+                async with client.stream(
+                    "GET", "/events", params=params or {}, timeout=timeout
+                ) as response:
+                    if response.status_code >= 400:
+                        raise KaptenAPIError(
+                            f"Docker API Error: {response.status_code} on /events"
+                        )
+
+                    # Subscribed, changes from here on will be streamed
+                    if on_connect is not None:
+                        await on_connect()
+
+                    async for line in response.aiter_lines():
+                        if line.strip():
+                            yield json.loads(line)
+        except CONNECTION_ERRORS as e:
+            raise KaptenConnectionError("Docker API Connection Error") from e
 
     async def distribution(self, image: str) -> Dict:
         url = f"/distribution/{image}/json"
-        result = await self.request("GET", url, authenticate=True)
+        result = await self.request(
+            "GET", url, authenticate=True, template="/distribution/{image}/json"
+        )
         assert isinstance(result, dict), "Invalid response"
         return result
 
@@ -158,7 +412,12 @@ class DockerAPIClient:
 
         params = {"version": version}
         result = await self.request(
-            "POST", url, params=params, data=spec, authenticate=True
+            "POST",
+            url,
+            params=params,
+            data=spec,
+            authenticate=True,
+            template="/services/{id}/update",
         )
         assert isinstance(result, dict), "Invalid response"
         return result
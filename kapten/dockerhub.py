@@ -1,12 +1,14 @@
-from typing import Any, Dict, List, Tuple
+from typing import AbstractSet, Any, Dict, Tuple
 
 import httpx
 
 from . import __version__
+from .metrics import measure
+from .tracing import span
 
 
 def parse_webhook_payload(
-    payload: Dict[str, Any], tracked_repositories: List[str]
+    payload: Dict[str, Any], tracked_repositories: AbstractSet[str]
 ) -> Tuple[str, str]:
     # Validate payload structure
     valid_structure = payload and (
@@ -41,5 +43,10 @@ async def callback(url: str, description: str, state: str = "success") -> bool:
         "context": f"Kapten {__version__}",
         "description": description[:255],
     }
-    response = await httpx.post(url, json=payload)
+    # Callback urls carry a secret hook id, only trace up to the repository
+    template = url.partition("/hook/")[0] + "/hook/{id}/"
+    with measure("callback"), span("dockerhub.callback", "POST", template) as current:
+        response = await httpx.post(url, json=payload)
+        current.status = response.status_code
+        current.bytes = len(response.content)
     return not response.is_error
@@ -12,3 +12,11 @@ class KaptenAPIError(KaptenError):
 
 class KaptenConnectionError(KaptenAPIError):
     pass
+
+
+class KaptenRegistryError(KaptenAPIError):
+    pass
+
+
+class KaptenConflictError(KaptenAPIError):
+    pass
@@ -0,0 +1,142 @@
+import asyncio
+import re
+from itertools import chain
+from typing import AbstractSet, Any, Dict, List, Optional, Tuple, Union
+
+from .cache import TTLCache
+from .docker import Service
+from .inventory import ServiceIndex
+from .log import logger
+from .selectors import ServiceSelector
+from .tool import Kapten
+
+ENDPOINT_NAME = re.compile(r"^[\w.-]+$")
+
+
+def parse_endpoint(value: str) -> Tuple[str, str]:
+    name, separator, host = value.partition("=")
+    if not separator or not name or not host:
+        raise ValueError(f"Invalid endpoint, expected NAME=HOST: {value}")
+    return name, host
+
+
+def split_endpoint(service_name: str) -> Tuple[Optional[str], str]:
+    # Selectors may contain colons too, only a plain name prefix is an endpoint
+    prefix, separator, selector = service_name.partition(":")
+    if separator and ENDPOINT_NAME.match(prefix):
+        return prefix, selector
+    return None, service_name
+
+
+def route_services(service_names: List[str], endpoint: str) -> List[str]:
+    """
+    Services tracked on given endpoint. Names are either prefixed with the
+    endpoint name, as in `staging:app`, or unprefixed to track on all.
+    """
+    routed = []
+    for service_name in service_names:
+        prefix, selector = split_endpoint(service_name)
+        if prefix is None or prefix == endpoint:
+            routed.append(selector)
+    return routed
+
+
+class Fleet:
+    """
+    Tracks services on several named Docker endpoints, with one Kapten per
+    endpoint. Digest lookups, caches and registry sessions are shared, while
+    services on each endpoint are updated concurrently.
+    """
+
+    def __init__(
+        self, endpoints: Dict[str, str], service_names: List[str], **kwargs: Any
+    ) -> None:
+        # Refuse prefixes of unknown endpoints
+        for service_name in service_names:
+            prefix, _ = split_endpoint(service_name)
+            if prefix is not None and prefix not in endpoints:
+                raise ValueError(f"Unknown endpoint of service: {service_name}")
+
+        self.clients: Dict[str, Kapten] = {}
+        shared = None
+        for name, host in endpoints.items():
+            routed = route_services(service_names, name)
+            if not routed:
+                continue
+
+            shared = self.clients[name] = Kapten(
+                routed, docker_host=host, name=name, share_with=shared, **kwargs
+            )
+
+        if shared is None:
+            raise ValueError("No services tracked on any endpoint")
+
+        self.primary = next(iter(self.clients.values()))
+        self.selector = ServiceSelector(
+            list(chain.from_iterable(c.service_names for c in self.clients.values()))
+        )
+
+    @property
+    def digests(self) -> TTLCache[str, str]:
+        return self.primary.digests
+
+    async def gather(self, *coros: Any) -> List[Any]:
+        # Run on all endpoints, failing only once all are done
+        results = await asyncio.gather(*coros, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    async def close(self) -> None:
+        await asyncio.gather(*(client.close() for client in self.clients.values()))
+
+    async def healthcheck(self) -> int:
+        counts = await self.gather(
+            *(client.healthcheck() for client in self.clients.values())
+        )
+        return sum(counts)
+
+    async def watch(self) -> None:
+        await asyncio.gather(*(client.watch() for client in self.clients.values()))
+
+    async def get_latest_digests(self, images: List[str]) -> Dict[str, str]:
+        return await self.primary.get_latest_digests(images)
+
+    async def get_index(self) -> ServiceIndex:
+        indices = await self.gather(
+            *(client.get_index() for client in self.clients.values())
+        )
+        return ServiceIndex(
+            chain.from_iterable(index.services for index in indices), self.selector
+        )
+
+    async def list_repositories(self) -> AbstractSet[str]:
+        index = await self.get_index()
+        return index.repositories
+
+    def tracked_repositories(self) -> Optional[AbstractSet[str]]:
+        repositories = [c.tracked_repositories() for c in self.clients.values()]
+        if any(r is None for r in repositories):
+            return None
+        return frozenset(chain.from_iterable(r for r in repositories if r))
+
+    async def update_services(self, image: str = "") -> List[Service]:
+        name, _, digest = image.partition("@")
+
+        if name and not digest:
+            # Resolve pushed image once, for all endpoints
+            index = await self.get_index()
+            if name in index.by_image:
+                self.digests.pop(name)
+                digest = await self.primary.get_latest_digest(name)
+                image = f"{name}@{digest}"
+                logger.debug("Resolved %s for all endpoints", image)
+
+        results = await self.gather(
+            *(client.update_services(image) for client in self.clients.values())
+        )
+        return list(chain.from_iterable(results))
+
+
+Client = Union[Kapten, Fleet]
@@ -1,12 +1,14 @@
 import hashlib
 import hmac
 import json
-from typing import Any, Dict, List, Tuple, Union
+from typing import AbstractSet, Any, Dict, Tuple, Union
 
 import httpx
 from starlette.datastructures import Secret
 
 from .log import logger
+from .metrics import measure
+from .tracing import span
 
 
 def validate_signature(
@@ -35,7 +37,7 @@ def validate_signature(
 
 
 def parse_webhook_payload(
-    payload: Dict[str, Any], tracked_repositories: List[str]
+    payload: Dict[str, Any], tracked_repositories: AbstractSet[str]
 ) -> Tuple[str, str]:
     # Validate payload structure
     valid_structure = payload and all(
@@ -116,9 +118,19 @@ async def callback(url: str, state: str, environment: str, description: str) ->
         "description": description,
         "environment": environment,
     }
+    # Leave out which deployment of which repository
+    template = (
+        url.partition("/repos/")[0] + "/repos/{owner}/{repo}/deployments/{id}/statuses"
+    )
+
     async with httpx.Client(headers=headers) as client:
         try:
-            response = await client.request("POST", url, json=data)
+            with measure("callback"), span(
+                "github.callback", "POST", template
+            ) as current:
+                response = await client.request("POST", url, json=data)
+                current.status = response.status_code
+                current.bytes = len(response.content)
         except Exception as e:  # pragma: nocover
             # TODO: Retry
             logger.critical(e)
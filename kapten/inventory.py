@@ -0,0 +1,121 @@
+import asyncio
+from typing import Dict, FrozenSet, Iterable, List, Optional
+
+from .docker import DockerAPIClient, Service
+from .exceptions import KaptenAPIError
+from .log import logger
+from .selectors import ServiceSelector
+
+
+class ServiceIndex:
+    """
+    Lookup tables over tracked services, ordered as tracked.
+    """
+
+    def __init__(self, services: Iterable[Service], selector: ServiceSelector) -> None:
+        # Sort in selector order and filter out any non matching services
+        self.services: List[Service] = sorted(
+            (s for s in services if selector.matches(s)), key=selector.sort_key
+        )
+
+        self.by_name: Dict[str, Service] = {}
+        self.by_image: Dict[str, List[Service]] = {}
+        self.by_repository: Dict[str, List[Service]] = {}
+        for service in self.services:
+            self.by_name[service.name] = service
+            self.by_image.setdefault(service.image, []).append(service)
+            self.by_repository.setdefault(service.repository, []).append(service)
+
+        self.images: FrozenSet[str] = frozenset(self.by_image)
+        self.repositories: FrozenSet[str] = frozenset(self.by_repository)
+        self.missing: List[str] = selector.missing(self.services)
+
+    def __len__(self) -> int:
+        return len(self.services)
+
+
+class ServiceInventory:
+    """
+    Live in-memory view of tracked services.
+
+    Seeded with a full listing and then kept current by following Docker's
+    service events, with a periodic full resync as a safety net.
+    """
+
+    def __init__(
+        self,
+        docker: DockerAPIClient,
+        selector: ServiceSelector,
+        resync_interval: float = 300.0,
+    ) -> None:
+        self.docker = docker
+        self.selector = selector
+        self.resync_interval = resync_interval
+        self.index = ServiceIndex([], selector)
+        self.ready = False
+        self.synced = False
+
+    async def resync(self) -> None:
+        services = await self.docker.services(
+            keep=self.selector.matches, **self.selector.filters()
+        )
+        self.index = ServiceIndex(services, self.selector)
+        self.ready = self.synced = True
+        logger.debug("Synced inventory of %s service(s)", len(self.index))
+
+    async def apply(self, event: Dict) -> None:
+        if event.get("Type") != "service":
+            return
+
+        actor = event.get("Actor") or {}
+        name = (actor.get("Attributes") or {}).get("name")
+        if not name or not self.selector.may_match(name):
+            return
+
+        action = event.get("Action")
+        logger.debug("Service %s event: %s", action, name)
+
+        services = dict(self.index.by_name)
+        if action == "remove":
+            services.pop(name, None)
+        elif action in ("create", "update"):
+            service = await self.docker.service(actor["ID"])
+            if self.selector.matches(service):
+                services[name] = service
+            elif services.pop(name, None) is None:
+                return
+        else:
+            return
+
+        # Swap in a rebuilt index
+        self.index = ServiceIndex(services.values(), self.selector)
+
+    async def follow(self) -> None:
+        # Seed once the event stream is connected, to not miss any changes
+        events = self.docker.events(on_connect=self.resync, type=["service"])
+        try:
+            async for event in events:
+                await self.apply(event)
+        finally:
+            await events.aclose()
+
+    async def watch(self, retry_delay: float = 1.0) -> None:
+        delay: Optional[float] = None
+        while True:
+            try:
+                await asyncio.wait_for(self.follow(), timeout=self.resync_interval)
+            except asyncio.TimeoutError:
+                # Periodic resync by reconnecting
+                delay = None
+                continue
+            except KaptenAPIError as e:
+                logger.warning("Service inventory out of sync: %s", e)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Service inventory failed")
+
+            # Fall back to listing services until reconnected
+            self.ready = False
+            delay = min((delay or retry_delay / 2) * 2, 30.0)
+            await asyncio.sleep(delay)
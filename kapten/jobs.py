@@ -0,0 +1,358 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, TypeVar
+
+from .docker import Service
+from .exceptions import KaptenError
+from .log import logger
+
+Hook = Callable[["Job"], Awaitable[None]]
+T = TypeVar("T")
+
+# Seconds a delivery stays reserved without a job, e.g. by a crashed process
+CLAIM_TIMEOUT = 60.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS deliveries (
+    key TEXT PRIMARY KEY,
+    job TEXT NOT NULL,
+    received REAL NOT NULL
+);
+"""
+
+
+class Job:
+    """
+    A queued update of the services running an image. Webhooks for the same
+    image arriving before it starts are attached to it, latest image wins.
+    """
+
+    __slots__ = (
+        "id",
+        "image",
+        "status",
+        "services",
+        "error",
+        "created",
+        "started",
+        "finished",
+        "on_start",
+        "on_finish",
+    )
+
+    def __init__(
+        self,
+        image: str,
+        on_start: Optional[Hook] = None,
+        on_finish: Optional[Hook] = None,
+    ) -> None:
+        self.id = uuid.uuid4().hex
+        self.image = image
+        self.status = "queued"
+        self.services: List[Service] = []
+        self.error: Optional[str] = None
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.on_start: List[Hook] = []
+        self.on_finish: List[Hook] = []
+        self.attach(image, on_start=on_start, on_finish=on_finish)
+
+    def __repr__(self) -> str:
+        return f"<Job {self.id} {self.image} {self.status}>"
+
+    @property
+    def key(self) -> str:
+        return self.image.partition("@")[0]
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+    def attach(
+        self,
+        image: str,
+        on_start: Optional[Hook] = None,
+        on_finish: Optional[Hook] = None,
+    ) -> None:
+        self.image = image
+        if on_start is not None:
+            self.on_start.append(on_start)
+        if on_finish is not None:
+            self.on_finish.append(on_finish)
+
+
+class JobQueue:
+    """
+    Bounded queue of image updates, run in the background by a pool of
+    workers. Finished jobs are kept around, up to `history` of them, for
+    their status to be looked up.
+
+    Submitted jobs wait `debounce` seconds before being queued, without
+    holding a worker, for bursts of webhooks to collapse into them.
+    """
+
+    def __init__(
+        self,
+        func: Callable[[str], Awaitable[List[Service]]],
+        workers: int = 4,
+        maxsize: int = 100,
+        history: int = 1000,
+        debounce: float = 0.0,
+        publish: Optional[Callable[[Job], None]] = None,
+    ) -> None:
+        self.func = func
+        self.workers = max(workers, 1)
+        self.maxsize = maxsize
+        self.history = history
+        self.debounce = debounce
+        self.publish = publish
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        # Jobs not yet started, by image without digest
+        self.pending: Dict[str, Job] = {}
+        self.delayed: Set[asyncio.Future] = set()
+        self.queue: Optional[asyncio.Queue] = None
+        self.tasks: List[asyncio.Future] = []
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def start(self) -> None:
+        # Queue is bound to the running loop
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self.tasks = [asyncio.ensure_future(self.work()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        tasks = self.tasks + list(self.delayed)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.tasks = []
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def submit(
+        self,
+        image: str,
+        on_start: Optional[Hook] = None,
+        on_finish: Optional[Hook] = None,
+    ) -> Job:
+        """
+        Enqueue an update of image, raising asyncio.QueueFull when at capacity.
+        Returns the not yet started job of the same image instead, if any.
+        """
+        assert self.queue is not None, "Job queue not started"
+        job = self.pending.get(image.partition("@")[0])
+        if job is not None:
+            job.attach(image, on_start=on_start, on_finish=on_finish)
+            logger.debug("Attached %s to queued job %s", image, job.id)
+            self.changed(job)
+            return job
+
+        if len(self.pending) >= self.maxsize:
+            raise asyncio.QueueFull()
+
+        job = Job(image, on_start=on_start, on_finish=on_finish)
+        self.pending[job.key] = job
+        if self.debounce > 0:
+            delayed = asyncio.ensure_future(self.enqueue_later(job))
+            self.delayed.add(delayed)
+            delayed.add_done_callback(self.delayed.discard)
+        else:
+            self.queue.put_nowait(job)
+        self.jobs[job.id] = job
+        logger.debug("Queued job %s for %s", job.id, image)
+        self.changed(job)
+
+        # Forget oldest finished jobs
+        while len(self.jobs) > self.history:
+            oldest = next(iter(self.jobs.values()))
+            if not oldest.done:
+                break
+            self.jobs.popitem(last=False)
+
+        return job
+
+    async def enqueue_later(self, job: Job) -> None:
+        assert self.queue is not None
+        await asyncio.sleep(self.debounce)
+        self.queue.put_nowait(job)
+
+    async def join(self) -> None:
+        if self.delayed:
+            await asyncio.gather(*self.delayed, return_exceptions=True)
+        if self.queue is not None:
+            await self.queue.join()
+
+    async def work(self) -> None:
+        assert self.queue is not None
+        while True:
+            job = await self.queue.get()
+            try:
+                await self.run(job)
+            finally:
+                self.queue.task_done()
+
+    async def run(self, job: Job) -> None:
+        # Webhooks from now on need a job of their own
+        del self.pending[job.key]
+        job.status = "running"
+        job.started = time.time()
+        self.changed(job)
+        for hook in job.on_start:
+            await self.hook(job, hook)
+
+        try:
+            job.services = await self.func(job.image)
+            job.status = "succeeded"
+        except KaptenError as e:
+            logger.warning(e)
+            job.error = str(e)
+            job.status = "failed"
+        except Exception as e:
+            logger.exception("Unhandled error")
+            job.error = str(e) or type(e).__name__
+            job.status = "failed"
+
+        job.finished = time.time()
+        self.changed(job)
+        logger.debug(
+            "Job %s %s after %.1fs", job.id, job.status, job.finished - job.started
+        )
+        for hook in job.on_finish:
+            await self.hook(job, hook)
+
+    def changed(self, job: Job) -> None:
+        if self.publish is None:
+            return
+
+        try:
+            self.publish(job)
+        except Exception:  # pragma: nocover
+            logger.exception("Failed publishing job %s", job.id)
+
+    async def hook(self, job: Job, hook: Hook) -> None:
+        try:
+            await hook(job)
+        except Exception:  # pragma: nocover
+            logger.exception("Failed running hook of job %s", job.id)
+
+
+class JobStore:
+    """
+    Status of jobs and the webhook deliveries that queued them, in SQLite,
+    for worker processes of a server to share. Deliveries are remembered for
+    `ttl` seconds, the latest `history` jobs are kept, give or take a tenth.
+
+    Queries are run with `call` or `defer` off the event loop, one at a time
+    and in order, for a job status never to be overwritten by an older one.
+    """
+
+    def __init__(
+        self, path: str = ":memory:", ttl: float = 3600.0, history: int = 1000
+    ) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.history = history
+        self.connection = sqlite3.connect(path, timeout=5.0, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.saves = 0
+
+    async def call(self, func: Callable[..., T], *args: Any) -> T:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def defer(self, func: Callable[..., Any], *args: Any) -> None:
+        # Not waited for, failures are only logged
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(self.deferred)
+
+    def deferred(self, future: Future) -> None:
+        e = future.exception()
+        if e is not None:
+            logger.error("Failed writing jobs to %s: %s", self.path, e)
+
+    def save(self, job_id: str, data: Dict[str, Any]) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)",
+                (job_id, json.dumps(data), time.time()),
+            )
+            # Keep only the most recently updated jobs, pruned now and then
+            self.saves += 1
+            if self.saves % max(self.history // 10, 1) == 0:
+                self.connection.execute(
+                    "DELETE FROM jobs WHERE id NOT IN "
+                    "(SELECT id FROM jobs ORDER BY updated DESC LIMIT ?)",
+                    (self.history,),
+                )
+
+    def load(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT data FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def claim(self, key: str) -> bool:
+        """
+        Reserve a webhook delivery until its job is queued, false when already
+        delivered or reserved, by any process.
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM deliveries WHERE received <= ? "
+                "OR (job = '' AND received <= ?)",
+                (now - self.ttl, now - CLAIM_TIMEOUT),
+            )
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO deliveries VALUES (?, '', ?)", (key, now)
+            )
+        return cursor.rowcount == 1
+
+    def deliver(self, key: str, job_id: str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO deliveries VALUES (?, ?, ?)",
+                (key, job_id, time.time()),
+            )
+
+    def release(self, key: str) -> None:
+        # Give up a reservation, for the webhook to be delivered again
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM deliveries WHERE key = ? AND job = ''", (key,)
+            )
+
+    def delivery(self, key: str) -> Optional[str]:
+        """
+        Id of the job queued by an earlier delivery of a webhook, if any.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT job FROM deliveries WHERE key = ? AND received > ?",
+                (key, time.time() - self.ttl),
+            ).fetchone()
+        return (row[0] or None) if row else None
+
+    def close(self) -> None:
+        # Finish deferred writes first
+        self.executor.shutdown()
+        self.connection.close()
@@ -0,0 +1,167 @@
+import contextlib
+import time
+from bisect import bisect_left
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+Labels = Tuple[str, ...]
+
+
+class Metric:
+    """
+    Base of the metrics kapten exports, in Prometheus text format.
+    Values are kept per tuple of label values.
+    """
+
+    kind = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def labels(self, labels: Dict[str, str]) -> Labels:
+        return tuple(labels[name] for name in self.labelnames)
+
+    def format_labels(self, values: Labels, **extra: str) -> str:
+        pairs = list(zip(self.labelnames, values)) + list(extra.items())
+        if not pairs:
+            return ""
+        return "{%s}" % ",".join(f'{name}="{escape(value)}"' for name, value in pairs)
+
+    def samples(self) -> Iterator[str]:  # pragma: nocover
+        raise NotImplementedError
+
+    def render(self) -> str:
+        header = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        return "\n".join(header + list(self.samples()))
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self.labels(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self.values.get(self.labels(labels), 0)
+
+    def samples(self) -> Iterator[str]:
+        for key, value in sorted(self.values.items()):
+            yield f"{self.name}{self.format_labels(key)} {value}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[self.labels(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per labels: count per bucket, with a last +Inf bucket, and sum
+        self.values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self.labels(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+
+        counts, total = entry
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def count(self, **labels: str) -> int:
+        entry = self.values.get(self.labels(labels))
+        return sum(entry[0]) if entry else 0
+
+    def samples(self) -> Iterator[str]:
+        for key, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                labels = self.format_labels(key, le=le)
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            yield f"{self.name}_sum{self.format_labels(key)} {total[0]}"
+            yield f"{self.name}_count{self.format_labels(key)} {cumulative}"
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+REGISTRY = Registry()
+
+PHASE_DURATION = Histogram(
+    "kapten_phase_duration_seconds",
+    "Seconds spent per phase of handling webhooks and updates.",
+    ["phase"],
+)
+PHASE_IN_FLIGHT = Gauge(
+    "kapten_phase_in_flight", "Phases currently in progress.", ["phase"]
+)
+PHASE_ERRORS = Counter(
+    "kapten_phase_errors_total", "Failed phases, per error type.", ["phase", "type"]
+)
+JOBS_QUEUED = Gauge("kapten_jobs_queued", "Updates waiting in the job queue.")
+
+for metric in (PHASE_DURATION, PHASE_IN_FLIGHT, PHASE_ERRORS, JOBS_QUEUED):
+    REGISTRY.register(metric)
+
+
+@contextlib.contextmanager
+def measure(phase: str) -> Iterator[None]:
+    """
+    Time a phase, counting it as in flight meanwhile and its errors by type.
+    """
+    PHASE_IN_FLIGHT.inc(phase=phase)
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        PHASE_ERRORS.inc(phase=phase, type=type(e).__name__)
+        raise
+    finally:
+        PHASE_DURATION.observe(time.perf_counter() - started, phase=phase)
+        PHASE_IN_FLIGHT.dec(phase=phase)
@@ -0,0 +1,181 @@
+import os
+import re
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+import httpx
+from httpx.exceptions import HTTPError
+
+from .cache import TTLCache
+from .exceptions import KaptenRegistryError
+from .log import logger
+from .tracing import span
+
+DOCKER_HUB_REGISTRY = "registry-1.docker.io"
+MANIFEST_MEDIA_TYPES = (
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.oci.image.manifest.v1+json",
+)
+
+challenge_param = re.compile(r'(\w+)="([^"]*)"')
+
+
+def parse_image(image: str) -> Tuple[str, str, str]:
+    """
+    Splits an image reference, i.e. repository:tag, into registry host,
+    repository name and tag, normalized the same way as the docker cli.
+    """
+    name, _, tag = image.rpartition(":")
+    if not name or "/" in tag:
+        name, tag = image, "latest"
+
+    registry, _, remainder = name.partition("/")
+    if not remainder or not (
+        "." in registry or ":" in registry or registry == "localhost"
+    ):
+        registry, remainder = "docker.io", name
+
+    if registry in ("docker.io", "index.docker.io"):
+        registry = DOCKER_HUB_REGISTRY
+        if "/" not in remainder:
+            remainder = f"library/{remainder}"
+
+    return registry, remainder, tag
+
+
+def parse_challenge(header: str) -> Tuple[str, Dict[str, str]]:
+    scheme, _, params = header.partition(" ")
+    return scheme.lower(), dict(challenge_param.findall(params))
+
+
+class RegistryClient:
+    """
+    Resolves image digests straight from registry v2 manifests.
+    """
+
+    def __init__(self, pool_size: int = 10) -> None:
+        self.config: Mapping[str, Any] = {
+            "pool_limits": httpx.PoolLimits(soft_limit=pool_size, hard_limit=pool_size),
+            "timeout": httpx.Timeout(5.0, pool_timeout=None),
+        }
+        self._client: Optional[httpx.Client] = None
+
+        # Bearer tokens per (registry, scope)
+        self.tokens: TTLCache[Tuple[str, str], str] = TTLCache(maxsize=256)
+
+        # Last known (etag, digest) per image, used for conditional requests
+        self.etags: TTLCache[str, Tuple[str, str]] = TTLCache(ttl=24 * 60 * 60)
+
+    @property
+    def client(self) -> httpx.Client:
+        if self._client is None:
+            self._client = httpx.Client(**self.config)
+        return self._client
+
+    async def close(self) -> None:
+        client, self._client = self._client, None
+        if client is not None:
+            await client.close()
+
+    def get_credentials(self) -> Optional[Tuple[str, str]]:
+        username = os.environ.get("DOCKER_USERNAME")
+        password = os.environ.get("DOCKER_PASSWORD")
+        return (username, password) if username and password else None
+
+    def get_base_url(self, registry: str) -> str:
+        host = registry.partition(":")[0]
+        scheme = "http" if host in ("localhost", "127.0.0.1") else "https"
+        return f"{scheme}://{registry}"
+
+    async def authenticate(self, registry: str, challenge: str) -> Dict[str, str]:
+        scheme, params = parse_challenge(challenge)
+        credentials = self.get_credentials()
+
+        if scheme == "basic" and credentials:
+            return {"Authorization": httpx.BasicAuth(*credentials).auth_header}
+
+        if scheme != "bearer" or "realm" not in params:
+            raise KaptenRegistryError(
+                f"Registry authentication not supported: {challenge}"
+            )
+
+        key = (registry, params.get("scope", ""))
+        token = self.tokens.get(key)
+
+        if token is None:
+            query = {k: v for k, v in params.items() if k in ("service", "scope")}
+            response = await self.client.get(
+                params["realm"], params=query, auth=credentials
+            )
+            if response.is_error:
+                raise KaptenRegistryError(
+                    f"Registry authentication failed: {response.status_code}"
+                )
+
+            try:
+                data = response.json()
+            except ValueError as e:
+                raise KaptenRegistryError(
+                    "Registry authentication failed: Invalid response"
+                ) from e
+            if not isinstance(data, dict):
+                data = {}
+
+            token = data.get("token") or data.get("access_token")
+            if not token:
+                raise KaptenRegistryError("Registry authentication failed: No token")
+
+            # Renew a bit before the token actually expires
+            ttl = max(int(data.get("expires_in") or 60) - 10, 0)
+            self.tokens.set(key, token, ttl=ttl)
+
+        return {"Authorization": f"Bearer {token}"}
+
+    async def head(self, url: str, headers: Dict[str, str]) -> httpx.Response:
+        base_url, _, _ = url.partition("/v2/")
+        template = f"{base_url}/v2/{{name}}/manifests/{{tag}}"
+        with span("registry.manifest", "HEAD", template) as current:
+            response = await self.client.head(url, headers=headers)
+            current.status = response.status_code
+            return response
+
+    async def manifest_digest(self, image: str) -> str:
+        registry, name, tag = parse_image(image)
+        url = f"{self.get_base_url(registry)}/v2/{name}/manifests/{tag}"
+        headers = {"Accept": ", ".join(MANIFEST_MEDIA_TYPES)}
+
+        known = self.etags.get(image)
+        if known:
+            headers["If-None-Match"] = known[0]
+
+        scope = f"repository:{name}:pull"
+        token = self.tokens.get((registry, scope))
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+
+        try:
+            response = await self.head(url, headers)
+            if response.status_code == 401:
+                challenge = response.headers.get("www-authenticate", "")
+                headers.update(await self.authenticate(registry, challenge))
+                response = await self.head(url, headers)
+        except (HTTPError, OSError) as e:
+            raise KaptenRegistryError(f"Registry Error: {str(e)}") from e
+
+        if response.status_code == 304 and known:
+            logger.debug("Registry manifest not modified for %s", image)
+            return known[1]
+
+        if response.is_error:
+            raise KaptenRegistryError(f"Registry Error: {response.status_code}")
+
+        digest = response.headers.get("docker-content-digest")
+        if not digest:
+            raise KaptenRegistryError("Registry Error: Missing Docker-Content-Digest")
+
+        etag = response.headers.get("etag")
+        if etag:
+            self.etags.set(image, (etag, digest))
+
+        return digest
@@ -0,0 +1,46 @@
+import random
+import time
+from typing import Optional
+
+from .exceptions import KaptenConnectionError
+
+
+def backoff_delay(attempt: int, base: float = 0.1, cap: float = 10.0) -> float:
+    """
+    Exponential backoff with full jitter.
+    """
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+class CircuitBreaker:
+    """
+    Fails fast after `threshold` consecutive failures, until `reset_timeout`
+    seconds have passed and a trial call is let through again.
+    """
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30.0) -> None:
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return (
+            self.opened_at is not None
+            and time.monotonic() - self.opened_at < self.reset_timeout
+        )
+
+    def check(self) -> None:
+        if self.is_open:
+            raise KaptenConnectionError("Docker API unavailable, failing fast")
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.threshold:
+            # (Re)open, also when a trial call fails
+            self.opened_at = time.monotonic()
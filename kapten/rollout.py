@@ -0,0 +1,201 @@
+import asyncio
+import time
+from typing import Dict, List, Optional
+
+from .docker import DockerAPIClient, Service
+from .exceptions import KaptenAPIError, KaptenError
+from .log import logger
+
+FAILED_UPDATE_STATES = (
+    "paused",
+    "rollback_started",
+    "rollback_paused",
+    "rollback_completed",
+)
+
+
+def validate_waves(waves: Optional[str]) -> None:
+    if not waves or waves.isdigit() or waves == "stack":
+        return
+    if waves.startswith("label:") and waves != "label:":
+        return
+    raise ValueError(f"Invalid rollout waves: {waves}")
+
+
+def plan_waves(services: List[Service], waves: Optional[str]) -> List[List[Service]]:
+    """
+    Split services into rollout waves, keeping their order.
+
+    Waves are either per "stack", per "label:<key>" value or "<n>" services
+    at a time. No waves rolls out all services at once.
+    """
+    if not waves:
+        return [services] if services else []
+
+    if waves.isdigit():
+        size = max(int(waves), 1)
+        return [services[i : i + size] for i in range(0, len(services), size)]
+
+    if waves == "stack":
+        keys = [service.stack for service in services]
+    elif waves.startswith("label:"):
+        label = waves[len("label:") :]
+        keys = [service.labels.get(label) for service in services]
+    else:
+        raise KaptenError(f"Invalid rollout waves: {waves}")
+
+    groups: Dict[Optional[str], List[Service]] = {}
+    for key, service in zip(keys, services):
+        groups.setdefault(key, []).append(service)
+
+    return list(groups.values())
+
+
+def is_converged(service: Service, tasks: List[Dict]) -> bool:
+    if service.update_state in FAILED_UPDATE_STATES:
+        raise KaptenError(f"Rollout of {service.name} failed: {service.update_state}")
+
+    if service.update_state not in (None, "completed"):
+        return False
+
+    # All tasks meant to run must be running the new image
+    replicas = service.spec.get("Mode", {}).get("Replicated", {}).get("Replicas")
+    return (bool(tasks) or replicas == 0) and all(
+        task["Status"]["State"] == "running"
+        and task["Spec"]["ContainerSpec"]["Image"] == service.image_with_digest
+        for task in tasks
+    )
+
+
+def is_running(service: Service, tasks: List[Dict]) -> bool:
+    return any(
+        task["Status"]["State"] == "running"
+        and task["Spec"]["ContainerSpec"]["Image"] == service.image_with_digest
+        for task in tasks
+    )
+
+
+class Convergence:
+    __slots__ = ("service", "started", "future")
+
+    def __init__(self, service: Service) -> None:
+        self.service = service
+        self.started = time.monotonic()
+        self.future: "asyncio.Future[Service]" = (
+            asyncio.get_event_loop().create_future()
+        )
+
+
+class ConvergenceWatcher:
+    """
+    Follows updated services until their tasks converge on the new spec.
+
+    All pending services share one polling loop, costing two Docker API
+    calls per poll no matter how many services are being watched.
+    """
+
+    def __init__(
+        self,
+        docker: DockerAPIClient,
+        timeout: float = 300.0,
+        poll_interval: float = 2.0,
+    ) -> None:
+        self.docker = docker
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.pending: Dict[str, Convergence] = {}
+        self.task: Optional[asyncio.Future] = None
+
+    async def wait(self, service: Service) -> Service:
+        """
+        Wait for an updated service to converge, recording the seconds it took
+        to get a task running and to converge on the service.
+        """
+        superseded = self.pending.get(service.id)
+        if superseded is not None and not superseded.future.done():
+            superseded.future.set_exception(
+                KaptenError(f"Update of {service.name} was superseded")
+            )
+
+        convergence = self.pending[service.id] = Convergence(service)
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.poll())
+
+        try:
+            return await asyncio.wait_for(convergence.future, timeout=self.timeout)
+        except asyncio.TimeoutError:
+            raise KaptenError(f"Timed out waiting for {service.name} to converge")
+        finally:
+            if self.pending.get(service.id) is convergence:
+                del self.pending[service.id]
+
+    def close(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+
+    async def poll(self) -> None:
+        try:
+            while self.pending:
+                await asyncio.sleep(self.poll_interval)
+
+                ids = list(self.pending)
+                try:
+                    services = await self.docker.services(id=ids)
+                    tasks = await self.docker.tasks(
+                        service=ids, **{"desired-state": ["running"]}
+                    )
+                except KaptenAPIError as e:
+                    logger.warning("Failed polling service convergence: %s", e)
+                    services, tasks = None, []
+
+                self.update(ids, services, tasks)
+        except Exception:
+            logger.exception("Failed watching service convergence")
+        finally:
+            # Never leave anyone waiting on a loop that is gone
+            for convergence in self.pending.values():
+                if not convergence.future.done():
+                    convergence.future.set_exception(
+                        KaptenError(
+                            f"Stopped watching {convergence.service.name} converge"
+                        )
+                    )
+            self.pending.clear()
+
+    def update(
+        self, ids: List[str], services: Optional[List[Service]], tasks: List[Dict]
+    ) -> None:
+        now = time.monotonic()
+        current = {s.id: s for s in services or []}
+        service_tasks: Dict[str, List[Dict]] = {}
+        for task in tasks:
+            service_tasks.setdefault(task["ServiceID"], []).append(task)
+
+        for service_id in ids:
+            # Skip services no longer awaited
+            convergence = self.pending.get(service_id)
+            if convergence is None or convergence.future.done():
+                continue
+
+            service = convergence.service
+            elapsed = now - convergence.started
+
+            try:
+                if services is not None:
+                    found = current.get(service_id)
+                    if found is None:
+                        raise KaptenError(f"Service {service.name} was removed")
+
+                    polled = service_tasks.get(service_id, [])
+                    if service.first_running_after is None and is_running(
+                        service, polled
+                    ):
+                        service.first_running_after = elapsed
+
+                    if is_converged(found, polled):
+                        if service.first_running_after is None:
+                            service.first_running_after = elapsed
+                        service.converged_after = elapsed
+                        convergence.future.set_result(service)
+            except KaptenError as e:
+                convergence.future.set_exception(e)
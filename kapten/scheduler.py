@@ -0,0 +1,144 @@
+import asyncio
+import random
+import time
+from typing import AbstractSet, Dict, List, Optional
+
+from .docker import Service
+from .exceptions import KaptenError
+from .fleet import Client
+from .log import logger
+
+
+class Scheduler:
+    """
+    Polls tracked repositories for new image digests.
+
+    Every repository gets its own schedule, spread evenly over the interval
+    and jittered, so that lookups trickle instead of bursting each tick.
+
+    Check intervals adapt to how often a repository's digests change, halved
+    on every change and stretched while unchanged, within the given bounds.
+    """
+
+    def __init__(
+        self,
+        client: Client,
+        interval: float = 60.0,
+        jitter: float = 0.1,
+        min_interval: Optional[float] = None,
+        max_interval: Optional[float] = None,
+        growth: float = 1.5,
+    ) -> None:
+        self.client = client
+        self.interval = interval
+        self.jitter = jitter
+        self.min_interval = min(interval, min_interval or interval)
+        self.max_interval = max(interval, max_interval or interval)
+        self.growth = growth
+        self.due: Dict[str, float] = {}
+        self.intervals: Dict[str, float] = {}
+        self.digests: Dict[str, Dict[str, str]] = {}
+        self.checks: Dict[str, asyncio.Future] = {}
+
+    def schedule(self, repositories: AbstractSet[str], now: float) -> None:
+        # Forget repositories no longer tracked
+        for repository in set(self.due) - repositories:
+            del self.due[repository]
+            self.intervals.pop(repository, None)
+            self.digests.pop(repository, None)
+
+        # Spread new repositories evenly over one interval
+        added = sorted(repositories - set(self.due))
+        for i, repository in enumerate(added):
+            self.due[repository] = now + self.interval * i / len(added)
+
+    def next_interval(self, repository: str) -> float:
+        interval = self.intervals.get(repository, self.interval)
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def learn(self, repository: str, digests: Dict[str, str]) -> None:
+        seen = self.digests.get(repository)
+        self.digests[repository] = digests
+        if seen is None:
+            return
+
+        interval = self.intervals.get(repository, self.interval)
+        if any(seen.get(image) != digest for image, digest in digests.items()):
+            # Pushed since last check, look closer
+            interval = max(interval / 2, self.min_interval)
+        else:
+            interval = min(interval * self.growth, self.max_interval)
+
+        if interval != self.intervals.get(repository, self.interval):
+            logger.debug("Checking %s every %.0fs", repository, interval)
+        self.intervals[repository] = interval
+
+    async def check(self, repository: str) -> List[Service]:
+        index = await self.client.get_index()
+        images = sorted({s.image for s in index.by_repository.get(repository, [])})
+
+        # Skip cached digests, this is the freshness check
+        for image in images:
+            self.client.digests.pop(image)
+        digests = await self.client.get_latest_digests(images)
+        self.learn(repository, digests)
+
+        updated_services: List[Service] = []
+        for image, digest in digests.items():
+            if all(s.digest == digest for s in index.by_image[image]):
+                continue
+
+            logger.info("New digest for %s: %s", image, digest)
+            updated_services.extend(
+                await self.client.update_services(image=f"{image}@{digest}")
+            )
+
+        return updated_services
+
+    async def run_check(self, repository: str) -> None:
+        try:
+            await self.check(repository)
+        except KaptenError as e:
+            logger.error("Failed checking %s: %s", repository, e)
+        finally:
+            self.checks.pop(repository, None)
+
+        # Reschedule from completion, with any newly learned interval
+        if repository in self.due:
+            self.due[repository] = time.monotonic() + self.next_interval(repository)
+
+    async def tick(self) -> Optional[float]:
+        index = await self.client.get_index()
+        now = time.monotonic()
+        self.schedule(index.repositories, now)
+
+        for repository, due in self.due.items():
+            if due <= now and repository not in self.checks:
+                self.due[repository] = now + self.next_interval(repository)
+                self.checks[repository] = asyncio.ensure_future(
+                    self.run_check(repository)
+                )
+
+        # Seconds until next check is due
+        return min(self.due.values()) - now if self.due else None
+
+    async def run(self) -> None:
+        logger.info("Watching for new images every %ss", self.interval)
+
+        # Follow service events instead of listing services each check
+        inventory = asyncio.ensure_future(self.client.watch())
+        try:
+            while True:
+                try:
+                    delay = await self.tick()
+                except KaptenError as e:
+                    logger.error("Failed listing services: %s", e)
+                    delay = None
+
+                await asyncio.sleep(
+                    self.interval if delay is None else max(delay, 0.01)
+                )
+        finally:
+            inventory.cancel()
+            for check in list(self.checks.values()):
+                check.cancel()
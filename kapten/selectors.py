@@ -0,0 +1,150 @@
+import fnmatch
+import re
+from typing import Dict, List, Optional, Pattern, Sequence, Tuple
+
+from .docker import Filter, Service
+
+GLOB_CHARS = "*?["
+
+
+class Selector:
+    """
+    A single compiled service selector. Either an exact service name, a
+    glob or `/regex/` name pattern, `label=KEY[=VALUE]` or `image=GLOB`.
+    """
+
+    __slots__ = ("value", "kind", "name", "pattern", "label", "label_value")
+
+    def __init__(self, value: str) -> None:
+        self.value = value
+        self.name: Optional[str] = None
+        self.pattern: Optional[Pattern] = None
+        self.label: Optional[str] = None
+        self.label_value: Optional[str] = None
+
+        if value.startswith("label="):
+            self.kind = "label"
+            label, separator, label_value = value[len("label=") :].partition("=")
+            self.label = label
+            self.label_value = label_value if separator else None
+        elif value.startswith("image="):
+            self.kind = "image"
+            self.pattern = re.compile(fnmatch.translate(value[len("image=") :]))
+        elif len(value) > 2 and value.startswith("/") and value.endswith("/"):
+            self.kind = "regex"
+            try:
+                self.pattern = re.compile(value[1:-1])
+            except re.error as e:
+                raise ValueError(f"Invalid service pattern {value}: {e}") from e
+        elif any(char in value for char in GLOB_CHARS):
+            self.kind = "glob"
+            self.pattern = re.compile(fnmatch.translate(value))
+        else:
+            self.kind = "name"
+            self.name = value
+
+    def __repr__(self) -> str:
+        return f"<Selector {self.kind} {self.value}>"
+
+    @property
+    def name_prefix(self) -> Optional[str]:
+        # Literal start of a name pattern, usable as docker name filter
+        if self.kind == "name":
+            return self.name
+        if self.kind == "glob":
+            prefix = re.split(r"[*?\[]", self.value, maxsplit=1)[0]
+            return prefix or None
+        return None
+
+    def matches_name(self, name: str) -> bool:
+        if self.kind == "name":
+            return name == self.name
+        if self.kind == "glob":
+            assert self.pattern is not None
+            return bool(self.pattern.match(name))
+        if self.kind == "regex":
+            # Unanchored, as with grep
+            assert self.pattern is not None
+            return bool(self.pattern.search(name))
+        return False
+
+    def matches(self, service: Service) -> bool:
+        if self.kind == "label":
+            labels = service.labels
+            if self.label not in labels:
+                return False
+            return self.label_value is None or labels[self.label] == self.label_value
+        if self.kind == "image":
+            assert self.pattern is not None
+            return bool(self.pattern.match(service.image))
+        return self.matches_name(service.name)
+
+
+class ServiceSelector:
+    """
+    Compiled set of selectors, matching services matched by any of them.
+    """
+
+    def __init__(self, selectors: Sequence[str]) -> None:
+        self.values = list(dict.fromkeys(selectors))
+        self.selectors = [Selector(value) for value in self.values]
+
+        self.names: Dict[str, int] = {
+            s.value: position
+            for position, s in enumerate(self.selectors)
+            if s.kind == "name"
+        }
+        self.exact = len(self.names) == len(self.selectors)
+        self.by_name = all(s.kind in ("name", "glob", "regex") for s in self.selectors)
+
+    def position(self, service: Service) -> Optional[int]:
+        position = self.names.get(service.name)
+        if position is not None or self.exact:
+            return position
+
+        for position, selector in enumerate(self.selectors):
+            if selector.matches(service):
+                return position
+
+        return None
+
+    def matches(self, service: Service) -> bool:
+        return self.position(service) is not None
+
+    def may_match(self, name: str) -> bool:
+        """
+        Whether a service with given name could be selected, without
+        knowing its labels or image.
+        """
+        if name in self.names:
+            return True
+        if self.by_name:
+            return any(s.matches_name(name) for s in self.selectors)
+        return True
+
+    def filters(self) -> Dict[str, Filter]:
+        """
+        Docker API filters narrowing down the services to list, as far as
+        they can express the selection.
+        """
+        prefixes = [s.name_prefix for s in self.selectors]
+        if prefixes and all(prefixes):
+            return {"name": [p for p in prefixes if p]}
+
+        # Multiple label filters would all have to match
+        if len(self.selectors) == 1 and self.selectors[0].kind == "label":
+            selector = self.selectors[0]
+            label = selector.label or ""
+            if selector.label_value is not None:
+                label = f"{label}={selector.label_value}"
+            return {"label": [label]}
+
+        return {}
+
+    def missing(self, services: Sequence[Service]) -> List[str]:
+        found = {service.name for service in services}
+        return [name for name in self.names if name not in found]
+
+    def sort_key(self, service: Service) -> Tuple[int, str]:
+        position = self.position(service)
+        return (len(self.selectors) if position is None else position, service.name)
@@ -1,12 +1,23 @@
+import asyncio
+import json
+import os
+from typing import AbstractSet, Any, Dict, List, Optional
+
 from starlette.applications import Starlette
 from starlette.config import Config
 from starlette.datastructures import Secret
 from starlette.responses import JSONResponse, Response
 
 from . import __version__, dockerhub, github
-from .exceptions import KaptenAPIError
+from .concurrency import FileLocks
+from .docker import Service
+from .fleet import Client
+from .jobs import Job, JobQueue, JobStore
 from .log import logger
-from .tool import Kapten
+from .metrics import JOBS_QUEUED, REGISTRY, measure
+
+# Command line of the server, for spawned worker processes to configure from
+WORKER_ARGS = "KAPTEN_WORKER_ARGS"
 
 config = Config()
 app = Starlette()
@@ -18,6 +29,12 @@ async def version(request):
     return JSONResponse({"kapten": __version__})
 
 
+@app.route("/metrics")
+async def metrics(request):
+    JOBS_QUEUED.set(len(app.state.jobs))
+    return Response(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.route("/webhook/dockerhub/{token}", methods=["POST"])
 async def dockerhub_webhook(request):
     logger.info("Received dockerhub webhook from: %s", request.client.host)
@@ -28,40 +45,46 @@ async def dockerhub_webhook(request):
         return Response(status_code=404)
 
     payload = await request.json()
-    repositories = app.state.repositories
+    repositories = tracked_repositories()
 
     # Parse payload
     try:
-        image, callback_url = dockerhub.parse_webhook_payload(payload, repositories)
+        with measure("webhook_parse"):
+            image, callback_url = dockerhub.parse_webhook_payload(payload, repositories)
     except ValueError as e:
         logger.critical(e)
         return Response(status_code=404)
 
-    # Call back to dockerhub to verify legit webhook
-    acked = await dockerhub.callback(callback_url, "Valid webhook received")
-    if not acked:
-        logger.critical("Failed to call back to dockerhub on url: %s", callback_url)
-        return Response(status_code=400)
+    # Docker Hub redelivers to the same callback url, claim it before calling back
+    duplicate = await claim_delivery(callback_url)
+    if duplicate is not None:
+        return duplicate
 
-    # Update all services matching this image
     try:
-        updated_services = await app.state.client.update_services(image=image)
-    except KaptenAPIError as e:
-        logger.warning(e)
-        return Response(status_code=503)
-    except Exception as e:  # pragma: nocover
-        logger.error(e)
-        return Response(status_code=500)
-
-    if not updated_services:
-        logger.debug("No service(s) updated for image: %s", image)
-
-    return JSONResponse(
-        [
-            {"service": service.name, "image": service.image_with_digest}
-            for service in updated_services
-        ]
-    )
+        # Call back to dockerhub to verify legit webhook
+        acked = await dockerhub.callback(callback_url, "Valid webhook received")
+        if not acked:
+            logger.critical("Failed to call back to dockerhub on url: %s", callback_url)
+            await release_delivery(callback_url)
+            return Response(status_code=400)
+
+        # Queue update of all services matching this image
+        try:
+            job = app.state.jobs.submit(image)
+        except asyncio.QueueFull:
+            logger.warning("Job queue full, rejecting update of %s", image)
+            await release_delivery(callback_url)
+            return Response(status_code=429)
+
+        # As accepted, the job may start while recording its delivery
+        data = serialize_job(job)
+        await deliver(callback_url, job.id)
+    except BaseException:
+        # Also when failing or cancelled
+        await release_delivery(callback_url)
+        raise
+
+    return JSONResponse(data, status_code=202)
 
 
 @app.route("/webhook/github", methods=["POST"])
@@ -86,49 +109,245 @@ async def github_webhook(request):
         return Response("Pong", status_code=202)
 
     payload = await request.json()
-    repositories = app.state.repositories
+    repositories = tracked_repositories()
     # Parse payload
     try:
-        image, callback_url = github.parse_webhook_payload(payload, repositories)
+        with measure("webhook_parse"):
+            image, callback_url = github.parse_webhook_payload(payload, repositories)
     except ValueError as e:
         logger.critical(e)
         return Response(status_code=404)
 
-    # TODO: Schedule update service
-    # TODO: Respond with success to webhook (GitHub only waits for 10 sec for response)
-    # TODO: Post deployment status "in_progress" to GitHub
+    environment = payload["deployment"].get("environment") or ""
+
+    async def on_start(job: Job) -> None:
+        await github.callback(
+            callback_url, "in_progress", environment, f"Deploying {job.image}"
+        )
+
+    async def on_finish(job: Job) -> None:
+        if job.status == "succeeded":
+            description = f"Updated {len(job.services)} service(s)"
+            await github.callback(callback_url, "success", environment, description)
+        else:
+            description = (job.error or "Update failed")[:140]
+            await github.callback(callback_url, "failure", environment, description)
+
+    # Redeliveries keep the id of the original delivery
+    delivery = request.headers.get("x-github-delivery")
+    duplicate = await claim_delivery(delivery)
+    if duplicate is not None:
+        return duplicate
 
-    # Update all services matching this deploy
+    # Queue update of all services matching this deploy, GitHub only waits 10s
     try:
-        updated_services = await app.state.client.update_services(image=image)
-    except KaptenAPIError as e:
-        logger.warning(e)
-        return Response(status_code=503)
-    except Exception:  # pragma: nocover
-        logger.exception("Unhandled error")
-        return Response(status_code=500)
-
-    if not updated_services:
-        logger.debug("No service(s) updated for image: %s", image)
-
-    return JSONResponse(
-        [
-            {"service": service.name, "image": service.image_with_digest}
-            for service in updated_services
-        ]
+        job = app.state.jobs.submit(image, on_start=on_start, on_finish=on_finish)
+        data = serialize_job(job)
+        if delivery:
+            await deliver(delivery, job.id)
+    except asyncio.QueueFull:
+        logger.warning("Job queue full, rejecting update of %s", image)
+        await release_delivery(delivery)
+        return Response(status_code=429)
+    except BaseException:
+        await release_delivery(delivery)
+        raise
+
+    return JSONResponse(data, status_code=202)
+
+
+@app.route("/jobs/{id}")
+async def job_status(request):
+    data = await job_data(request.path_params["id"])
+    if data is None:
+        return Response(status_code=404)
+
+    return JSONResponse(data)
+
+
+async def deliver(key: str, job_id: str) -> None:
+    job_store = app.state.job_store
+    await job_store.call(job_store.deliver, key, job_id)
+
+
+async def release_delivery(key: Optional[str]) -> None:
+    # Leave a webhook that was not accepted to be delivered again
+    if key:
+        job_store = app.state.job_store
+        await job_store.call(job_store.release, key)
+
+
+async def job_data(job_id: str) -> Optional[Dict[str, Any]]:
+    job = app.state.jobs.get(job_id)
+    if job is not None:
+        return serialize_job(job)
+
+    # Queued by another worker process
+    job_store = app.state.job_store
+    data: Optional[Dict[str, Any]] = await job_store.call(job_store.load, job_id)
+    return data
+
+
+def publish_job(job: Job) -> None:
+    # Status as of now, written in the background
+    job_store = app.state.job_store
+    job_store.defer(job_store.save, job.id, serialize_job(job))
+
+
+async def claim_delivery(key: Optional[str]) -> Optional[Response]:
+    # Respond to an already accepted webhook with its job, updating nothing
+    job_store = app.state.job_store
+    if not key or await job_store.call(job_store.claim, key):
+        return None
+
+    job_id = await job_store.call(job_store.delivery, key)
+    data = await job_data(job_id) if job_id else None
+    if data is None:
+        logger.info("Webhook already being delivered")
+        return Response(status_code=202)
+
+    logger.info("Webhook already delivered, as job %s", job_id)
+    return JSONResponse(data, status_code=202)
+
+
+def tracked_repositories() -> AbstractSet[str]:
+    # Follow services created or removed since startup, as seen by the inventory
+    repositories = app.state.client.tracked_repositories()
+    if repositories is not None:
+        app.state.repositories = repositories
+    return app.state.repositories
+
+
+async def update_services(image: str) -> List[Service]:
+    client = app.state.client
+    if app.state.locks is None:
+        return await client.update_services(image)
+
+    # Only one worker process at a time updates the services of an image
+    name = image.partition("@")[0]
+    services: List[Service] = await app.state.locks.call(
+        name, client.update_services, image
     )
+    return services
+
+
+def serialize_job(job: Job) -> Dict[str, Any]:
+    data: Dict[str, Any] = {
+        "id": job.id,
+        "image": job.image,
+        "status": job.status,
+        "created": job.created,
+        "started": job.started,
+        "finished": job.finished,
+    }
+    if job.done:
+        data["services"] = [serialize_service(s) for s in job.services]
+    if job.error is not None:
+        data["error"] = job.error
+
+    return data
+
+
+def serialize_service(service: Service) -> Dict[str, Any]:
+    data: Dict[str, Any] = {"service": service.name, "image": service.image_with_digest}
+
+    # Deploy durations, when followed until converged
+    if service.converged_after is not None:
+        data["first_running_after"] = round(service.first_running_after or 0.0, 3)
+        data["converged_after"] = round(service.converged_after, 3)
+
+    return data
 
 
 @app.on_event("startup")
 async def setup() -> None:
+    if not hasattr(app.state, "client"):
+        # Spawned worker process, configure from the server's command line
+        from .cli import worker
+
+        worker(json.loads(os.environ[WORKER_ARGS]))
+
     app.state.repositories = await app.state.client.list_repositories()
 
+    # Keep tracked services in memory, updated by docker service events
+    app.state.inventory = asyncio.ensure_future(app.state.client.watch())
+
+    # Run queued updates in the background
+    app.state.jobs.start()
+
+
+@app.on_event("shutdown")
+async def teardown() -> None:
+    app.state.inventory.cancel()
+    await app.state.jobs.stop()
+    await app.state.client.close()
+    app.state.job_store.close()
 
-def run(client: Kapten, token: str, host: str = "0.0.0.0", port: int = 8800) -> None:
+
+def run(
+    client: Client,
+    token: str,
+    host: str = "0.0.0.0",
+    port: int = 8800,
+    debounce: float = 0.0,
+    job_workers: int = 4,
+    queue_size: int = 100,
+    workers: int = 1,
+    lock_dir: Optional[str] = None,
+    delivery_ttl: float = 3600.0,
+    argv: Optional[List[str]] = None,
+) -> None:
     import uvicorn
 
     logger.info(f"Starting Kapten {__version__} server ...")
+
+    if workers > 1:
+        # Workers are spawned processes importing the app, each with its own client
+        os.environ[WORKER_ARGS] = json.dumps(argv or [])
+        uvicorn.run(
+            "kapten.server:app",
+            host=host,
+            port=port,
+            proxy_headers=True,
+            workers=workers,
+        )
+        return
+
+    configure(
+        client,
+        token,
+        debounce=debounce,
+        job_workers=job_workers,
+        queue_size=queue_size,
+        lock_dir=lock_dir,
+        delivery_ttl=delivery_ttl,
+    )
+    uvicorn.run(app, host=host, port=port, proxy_headers=True)
+
+
+def configure(
+    client: Client,
+    token: str,
+    debounce: float = 0.0,
+    job_workers: int = 4,
+    queue_size: int = 100,
+    lock_dir: Optional[str] = None,
+    delivery_ttl: float = 3600.0,
+) -> None:
     app.state.client = client
     app.state.token = Secret(token)
 
-    uvicorn.run(app, host=host, port=port, proxy_headers=True)
+    app.state.locks = FileLocks(lock_dir) if lock_dir else None
+    # Bursts of webhooks for the same image collapse into one queued job
+    app.state.jobs = JobQueue(
+        update_services,
+        workers=job_workers,
+        maxsize=queue_size,
+        debounce=debounce,
+        publish=publish_job,
+    )
+
+    # Job status and accepted webhooks, by delivery id or callback url, shared
+    # with other worker processes through the lock directory
+    path = os.path.join(lock_dir, "jobs.db") if lock_dir else ":memory:"
+    app.state.job_store = JobStore(path, ttl=delivery_ttl)
@@ -6,6 +6,8 @@ import httpx
 
 from .docker import Service
 from .log import logger
+from .metrics import measure
+from .tracing import span
 
 
 async def post(
@@ -28,9 +30,11 @@ async def post(
             {"color": "#50ba32", "fallback": fallback or text, "fields": fields}
         ]
 
-    response = await httpx.post(
-        f"https://hooks.slack.com/services/{token}", json=payload
-    )
+    url = "https://hooks.slack.com/services/{token}"
+    with measure("slack"), span("slack.post", "POST", url) as current:
+        response = await httpx.post(url.format(token=token), json=payload)
+        current.status = response.status_code
+        current.bytes = len(response.content)
 
     return response.text == "ok"
 
@@ -41,6 +45,7 @@ async def notify(
     *,
     project: Optional[str] = None,
     channel: Optional[str] = None,
+    cluster: Optional[str] = None,
 ) -> bool:
     results = []
 
@@ -57,6 +62,10 @@ async def notify(
 
         fields = [{"title": "Host", "value": hostname, "short": True}]
 
+        # Cluster:
+        if cluster:
+            fields.append({"title": "Cluster", "value": cluster, "short": True})
+
         # Stack:
         stack_names = sorted({s.stack or "(none)" for s in service_group})
         stack_list = "\n".join(f"\u2022 {name}" for name in stack_names)
@@ -85,6 +94,17 @@ async def notify(
             }
         )
 
+        # Durations:
+        converged = [s for s in service_group if s.converged_after is not None]
+        if converged:
+            durations = "\n".join(
+                f"\u2022 {s.short_name}: running after "
+                f"{s.first_running_after or 0.0:.1f}s, "
+                f"converged after {s.converged_after:.1f}s"
+                for s in sorted(converged, key=lambda s: s.short_name)
+            )
+            fields.append({"title": "Durations", "value": durations, "short": False})
+
         result = await post(
             token,
             channel=channel,
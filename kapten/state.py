@@ -0,0 +1,88 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .log import logger
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS digests (
+    image TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    observed REAL NOT NULL
+);
+"""
+
+
+class StateStore:
+    """
+    Last known state, kept in SQLite across restarts: resolved image digests.
+
+    Records are buffered in memory and written in batches, `flush_interval`
+    seconds after the first pending one, off the event loop.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 5.0) -> None:
+        self.path = path
+        self.flush_interval = flush_interval
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+        self.pending_digests: Dict[str, Tuple[str, float]] = {}
+        self.task: Optional[asyncio.Future] = None
+
+    def __len__(self) -> int:
+        return len(self.pending_digests)
+
+    def digests(self) -> Dict[str, Tuple[str, float]]:
+        """
+        Last observed digest per image, with its age in seconds.
+        """
+        now = time.time()
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT image, digest, observed FROM digests"
+            ).fetchall()
+        return {image: (digest, now - observed) for image, digest, observed in rows}
+
+    def record_digest(self, image: str, digest: str) -> None:
+        self.pending_digests[image] = (digest, time.time())
+        self.schedule_flush()
+
+    def schedule_flush(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.flush_later())
+
+    async def flush_later(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self) -> None:
+        if not len(self):
+            return
+
+        digests = [(i, d, o) for i, (d, o) in self.pending_digests.items()]
+        self.pending_digests = {}
+
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, self.write, digests)
+        except sqlite3.Error as e:
+            logger.error("Failed writing state to %s: %s", self.path, e)
+
+    def write(self, digests: List[Tuple[str, str, float]]) -> None:
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO digests VALUES (?, ?, ?)", digests
+            )
+
+        logger.debug("Stored %s digest(s)", len(digests))
+
+    async def close(self) -> None:
+        # Write anything pending, keep the store usable from another loop
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
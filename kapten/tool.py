@@ -1,10 +1,23 @@
 import asyncio
-from typing import Dict, List, Optional
+from typing import AbstractSet, Any, Callable, Dict, List, Optional, Tuple
 
 from . import slack
+from .cache import TTLCache
+from .concurrency import AdaptiveLimiter, BoardingFlight, SingleFlight
 from .docker import DockerAPIClient, Service
-from .exceptions import KaptenAPIError, KaptenError
+from .exceptions import (
+    KaptenAPIError,
+    KaptenConflictError,
+    KaptenError,
+    KaptenRegistryError,
+)
+from .inventory import ServiceIndex, ServiceInventory
 from .log import logger
+from .metrics import measure
+from .registry import RegistryClient
+from .rollout import ConvergenceWatcher, plan_waves, validate_waves
+from .selectors import ServiceSelector
+from .state import StateStore
 
 
 class Kapten:
@@ -16,14 +29,83 @@ class Kapten:
         slack_channel: Optional[str] = None,
         only_check: bool = False,
         force: bool = False,
+        pool_size: int = 10,
+        cache_ttl: float = 60.0,
+        cache_size: int = 1024,
+        registry_lookup: bool = False,
+        lookup_concurrency: int = 10,
+        update_concurrency: int = 5,
+        resync_interval: float = 300.0,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 5.0,
+        retries: int = 2,
+        waves: Optional[str] = None,
+        rollout_timeout: float = 300.0,
+        wait: bool = False,
+        docker_host: Optional[str] = None,
+        name: Optional[str] = None,
+        share_with: Optional["Kapten"] = None,
+        state: Optional[StateStore] = None,
     ) -> None:
+        self.name = name
         self.service_names = service_names
         self.project = project
         self.slack_token = slack_token
         self.slack_channel = slack_channel
         self.only_check = only_check
         self.force = force
-        self.docker = DockerAPIClient()
+        self.docker = DockerAPIClient(
+            pool_size=pool_size,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            retries=retries,
+            host=docker_host,
+        )
+        self.conflict_retries = retries
+
+        if share_with is None:
+            self.digests: TTLCache[str, str] = TTLCache(
+                maxsize=cache_size, ttl=cache_ttl
+            )
+            self.registry: Optional[RegistryClient] = (
+                RegistryClient(pool_size=pool_size) if registry_lookup else None
+            )
+            self.lookups = AdaptiveLimiter(lookup_concurrency)
+            self.resolving = SingleFlight()
+        else:
+            # Share digest lookups and caches with another endpoint's client
+            self.digests = share_with.digests
+            self.registry = share_with.registry
+            self.lookups = share_with.lookups
+            self.resolving = share_with.resolving
+
+        self.state = state
+        if state is not None and share_with is None:
+            # Warm digest cache with what was resolved before a restart
+            for image, (digest, age) in state.digests().items():
+                self.digests.set(image, digest, ttl=cache_ttl - age)
+
+        self.updates = AdaptiveLimiter(update_concurrency)
+        self.flights = BoardingFlight()
+        self.selector = ServiceSelector(service_names)
+        self.inventory = ServiceInventory(
+            self.docker, self.selector, resync_interval=resync_interval
+        )
+        validate_waves(waves)
+        self.waves = waves
+        self.wait = wait or bool(waves)
+        self.convergence = ConvergenceWatcher(self.docker, timeout=rollout_timeout)
+
+    async def close(self) -> None:
+        self.convergence.close()
+        await self.docker.close()
+        if self.state is not None:
+            await self.state.close()
+        if self.registry is not None:
+            await self.registry.close()
+
+    async def watch(self) -> None:
+        await self.inventory.watch()
 
     async def healthcheck(self) -> int:
         logger.info("Verifying connectivity and access to Docker API ...")
@@ -53,11 +135,42 @@ class Kapten:
         return nof_services
 
     async def get_latest_digest(self, image: str) -> str:
-        # Get latest repository image info
-        data = await self.docker.distribution(image)
+        # Use recently resolved digest, if any
+        digest = self.digests.get(image)
+        if digest is not None:
+            logger.debug("Using cached digest for %s: %s", image, digest)
+            return digest
+
+        # Share any in-flight lookup of the same image
+        resolved: str = await self.resolving.call(
+            image, self.lookups.call, self.resolve_digest, image
+        )
+        self.digests.set(image, resolved)
+        if self.state is not None:
+            self.state.record_digest(image, resolved)
+
+        return resolved
+
+    async def resolve_digest(self, image: str) -> str:
+        with measure("distribution"):
+            return await self.lookup_digest(image)
+
+    async def lookup_digest(self, image: str) -> str:
+        digest = None
 
-        # Locate latest digest
-        digest = data["Descriptor"]["digest"]
+        if self.registry is not None:
+            # Resolve digest straight from the registry
+            try:
+                digest = await self.registry.manifest_digest(image)
+            except KaptenRegistryError as e:
+                logger.warning("Falling back to Docker API for %s: %s", image, e)
+
+        if digest is None:
+            # Get latest repository image info
+            data = await self.docker.distribution(image)
+
+            # Locate latest digest
+            digest = data["Descriptor"]["digest"]
 
         return digest
 
@@ -80,35 +193,42 @@ class Kapten:
 
         return image_digests
 
-    async def list_services(self, image: Optional[str] = None) -> List[Service]:
-        # List services
-        services = await self.docker.services(name=self.service_names)
+    async def get_index(self) -> ServiceIndex:
+        # Use live inventory when it is being watched
+        if self.inventory.ready:
+            return self.inventory.index
 
-        # Sort in input order and filter out any non exact matches
-        services = sorted(
-            filter(lambda s: s.name in self.service_names, services),
-            key=lambda s: self.service_names.index(s.name),
+        # Filter what docker can, drop non matching services while decoding
+        services = await self.docker.services(
+            keep=self.selector.matches, **self.selector.filters()
         )
+        return ServiceIndex(services, self.selector)
+
+    async def list_services(self, image: Optional[str] = None) -> List[Service]:
+        with measure("list_services"):
+            index = await self.get_index()
 
         # Assert we got the services we asked for
-        missing_services = set(self.service_names) - {s.name for s in services}
-        if missing_services:
-            missing = ", ".join(sorted(missing_services))
+        if index.missing:
+            missing = ", ".join(sorted(index.missing))
             raise KaptenError(
                 f"Could not find all tracked services. Missing: {missing}"
             )
 
         # Filter by given image
         if image:
-            # TODO: Filter with regex match instead of exact match
-            services = list(filter(lambda s: s.image == image, services))
+            # Webhooks name an exact image, patterns only select tracked services
+            return list(index.by_image.get(image, []))
 
-        return services
+        return list(index.services)
 
-    async def list_repositories(self) -> List[str]:
-        services = await self.list_services()
-        repositories = {service.repository for service in services}
-        return sorted(repositories)
+    async def list_repositories(self) -> AbstractSet[str]:
+        index = await self.get_index()
+        return index.repositories
+
+    def tracked_repositories(self) -> Optional[AbstractSet[str]]:
+        # Last known repositories of the inventory, without blocking on a listing
+        return self.inventory.index.repositories if self.inventory.synced else None
 
     async def update_service(self, service: Service, digest: str) -> Optional[Service]:
         logger.debug("Stack:     %s", service.stack or "-")
@@ -136,36 +256,118 @@ class Kapten:
         )
 
         # Update service to latest image digest
-        await self.docker.service_update(
-            service.id, service.version, spec=new_service["Spec"]
-        )
+        for attempt in range(self.conflict_retries + 1):
+            try:
+                await self.updates.call(self.send_update, service, new_service)
+                break
+            except KaptenConflictError:
+                if attempt >= self.conflict_retries:
+                    raise
+
+            # Service changed since listed, retry with its current version
+            logger.warning("Version conflict updating %s, retrying", service.name)
+            service = await self.docker.service(service.id)
+            if not self.force and digest == service.digest:
+                return None
+            new_service = service.clone(digest)
+
+        return new_service
+
+    async def send_update(self, service: Service, new_service: Service) -> None:
+        # Measured once a slot is free, not while queued for one
+        with measure("service_update"):
+            await self.docker.service_update(
+                service.id, service.version, spec=new_service.spec
+            )
+
+    async def deploy_service(self, service: Service, digest: str) -> Optional[Service]:
+        new_service = await self.update_service(service, digest)
+
+        # Follow updated service until converged
+        if new_service is not None and self.wait and not self.only_check:
+            await self.convergence.wait(new_service)
+            logger.info(
+                "Service %s running after %.1fs, converged after %.1fs",
+                service.name,
+                new_service.first_running_after,
+                new_service.converged_after,
+            )
 
         return new_service
 
+    async def rollout(
+        self, services: List[Service], digests: Dict[str, str]
+    ) -> Dict[str, Any]:
+        service_results: Dict[str, Any] = {}
+        waves = plan_waves(services, self.waves)
+
+        for number, wave in enumerate(waves, 1):
+            if self.waves:
+                logger.info("Rolling out wave %s/%s", number, len(waves))
+
+            results = await asyncio.gather(
+                *(
+                    self.deploy_service(service, digest=digests[service.image])
+                    for service in wave
+                ),
+                return_exceptions=True,
+            )
+            service_results.update(zip((s.name for s in wave), results))
+
+            # Halt rollout on failures
+            if any(isinstance(result, Exception) for result in results):
+                skipped = [s.name for pending in waves[number:] for s in pending]
+                if skipped:
+                    logger.warning("Halting rollout, skipping %s", ", ".join(skipped))
+                break
+
+        return service_results
+
     async def update_services(self, image: str = "") -> List[Service]:
+        name, _, digest = image.partition("@")
+
+        # Share any update of the same image still looking up its digests, or
+        # else the one queued after it
+        digests, updated_services = await self.flights.call(name, self.deploy, image)
+
+        if digest and digests.get(name, digest) != digest:
+            # Joined an update to another digest, update to the given one too
+            logger.debug("Updating %s again, was updated to %s", image, digests[name])
+            _, updated_services = await self.flights.call(name, self.deploy, image)
+
+        return updated_services
+
+    async def deploy(
+        self, depart: Callable[[], None], image: str = ""
+    ) -> Tuple[Dict[str, str], List[Service]]:
         updated_services = []
 
         # List services
         image, _, digest = image.partition("@")
+        if digest:
+            # Nothing to look up, later digests need an update of their own
+            depart()
         services = await self.list_services(image=image)
 
+        if image and not digest:
+            # A push of this image was announced, cached digest is outdated
+            self.digests.pop(image)
+
         if not digest:
             # Fetch latest digests for service's images
             images = list({service.image for service in services})
             digests = await self.get_latest_digests(images)
+            # Pushes from now on are not seen, and need another update
+            depart()
         else:
+            # Explicitly delivered digest supersedes any cached one
+            self.digests.set(image, digest)
+            if self.state is not None:
+                self.state.record_digest(image, digest)
             digests = {service.image: digest for service in services}
 
         # Deploy services
-        results = await asyncio.gather(
-            *(
-                self.update_service(service, digest=digests[service.image])
-                for service in services
-            ),
-            return_exceptions=True,
-        )
-        service_names = [service.name for service in services]
-        service_results = dict(zip(service_names, results))
+        service_results = await self.rollout(services, digests)
 
         # Handle failing services
         failed_services: Dict[str, Exception] = {
@@ -193,6 +395,7 @@ class Kapten:
                 updated_services,
                 project=self.project,
                 channel=self.slack_channel,
+                cluster=self.name,
             )
 
-        return updated_services
+        return digests, updated_services
@@ -0,0 +1,90 @@
+import contextlib
+import json
+import time
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional
+
+from .log import logger
+
+
+class Span:
+    """
+    Timing and outcome of one external call. The url is a template, with
+    identifiers and secrets left out.
+    """
+
+    __slots__ = (
+        "name",
+        "method",
+        "url",
+        "status",
+        "bytes",
+        "error",
+        "started",
+        "duration",
+    )
+
+    def __init__(self, name: str, method: str, url: str) -> None:
+        self.name = name
+        self.method = method
+        self.url = url
+        self.status: Optional[int] = None
+        self.bytes: Optional[int] = None
+        self.error: Optional[str] = None
+        self.started = time.time()
+        self.duration = 0.0
+
+    def __repr__(self) -> str:
+        return f"<Span {self.name} {self.method} {self.url} {self.status}>"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+Hook = Callable[[Span], None]
+
+hooks: List[Hook] = []
+
+
+def add_hook(hook: Hook) -> None:
+    hooks.append(hook)
+
+
+def remove_hook(hook: Hook) -> None:
+    hooks.remove(hook)
+
+
+@contextlib.contextmanager
+def span(name: str, method: str, url: str) -> Iterator[Span]:
+    """
+    Trace a call, handing the finished span to all registered hooks.
+    """
+    current = Span(name, method, url)
+    started = time.perf_counter()
+    try:
+        yield current
+    except Exception as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        current.duration = time.perf_counter() - started
+        for hook in hooks:
+            try:
+                hook(current)
+            except Exception:  # pragma: nocover
+                logger.exception("Failed running span hook %r", hook)
+
+
+class SpanFile:
+    """
+    Span hook appending every span as a line of JSON to a file.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file: IO[str] = open(path, "a", buffering=1)
+
+    def __call__(self, span: Span) -> None:
+        self.file.write(json.dumps(span.to_dict()) + "\n")
+
+    def close(self) -> None:
+        self.file.close()
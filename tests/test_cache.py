@@ -0,0 +1,44 @@
+from unittest import mock
+
+from kapten.cache import TTLCache
+
+from .testcases import KaptenTestCase
+
+
+class TTLCacheTestCase(KaptenTestCase):
+    def test_get_set(self):
+        cache = TTLCache(ttl=10)
+        self.assertIsNone(cache.get("foo"))
+        cache.set("foo", "bar")
+        self.assertEqual(cache.get("foo"), "bar")
+        self.assertIn("foo", cache)
+        self.assertEqual(cache.pop("foo"), "bar")
+        self.assertIsNone(cache.pop("foo"))
+        self.assertNotIn("foo", cache)
+
+    def test_expiry(self):
+        cache = TTLCache(ttl=10)
+        with mock.patch("kapten.cache.time.monotonic", return_value=100):
+            cache.set("foo", "bar")
+            cache.set("baz", "ham", ttl=20)
+        with mock.patch("kapten.cache.time.monotonic", return_value=115):
+            self.assertIsNone(cache.get("foo"))
+            self.assertEqual(cache.get("baz"), "ham")
+            self.assertEqual(len(cache), 1)
+
+    def test_lru_eviction(self):
+        cache = TTLCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_disabled(self):
+        cache = TTLCache(ttl=0)
+        cache.set("foo", "bar")
+        self.assertIsNone(cache.get("foo"))
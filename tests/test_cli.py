@@ -1,8 +1,12 @@
 import json
 import logging
+import os
+import shutil
 from unittest import mock
 from unittest.mock import call
 
+import asynctest
+
 from kapten import __version__, cli
 
 from .testcases import KaptenTestCase
@@ -155,6 +159,10 @@ class CLICommandTestCase(KaptenTestCase):
                 self.cli_command(argv)
             self.assertEqual(cm.exception.code, 666)
 
+    def test_command_docker_api_error_response(self):
+        services = [("foo", "repo/foo:tag@sha256:0")]
+        argv = self.build_sys_args(services)
+
         with self.mock_docker(services, with_api_error=True):
             with self.assertRaises(SystemExit) as cm:
                 self.cli_command(argv)
@@ -167,6 +175,22 @@ class CLICommandTestCase(KaptenTestCase):
         with self.mock_docker(services, api_version="1.39"):
             self.cli_command(argv, with_healthcheck=True)
 
+    def test_command_digest_cache(self):
+        services = [("foo", "repo/foo:tag@sha256:0")]
+        argv = self.build_sys_args(services)
+
+        with self.mock_docker(services) as httpx_mock:
+            self.cli_command(argv, with_healthcheck=True)
+            self.assertEqual(len(httpx_mock["distribution"].calls), 1)
+
+    def test_command_digest_cache_disabled(self):
+        services = [("foo", "repo/foo:tag@sha256:0")]
+        argv = self.build_sys_args(services)
+
+        with self.mock_docker(services) as httpx_mock:
+            self.cli_command(argv + ["--cache-ttl", "0"], with_healthcheck=True)
+            self.assertEqual(len(httpx_mock["distribution"].calls), 2)
+
     def test_healthcheck_failure(self):
         services = [("foo", "repo/foo:tag@sha256:0")]
         argv = self.build_sys_args(services, "--check")
@@ -221,3 +245,90 @@ class CLICommandTestCase(KaptenTestCase):
                     uvicorn.run.mock_calls[0],
                     call(app, host="1.2.3.4", port=8888, proxy_headers=True),
                 )
+
+    def test_command_server_workers(self):
+        from kapten import server
+
+        services = [("foo", "repo/foo:tag@sha256:0")]
+        argv = self.build_sys_args(
+            services, "--server", "--webhook-token", "secret", "--workers", "2"
+        )
+        uvicorn = mock.MagicMock()
+        with mock.patch.dict("sys.modules", uvicorn=uvicorn):
+            with mock.patch.dict("os.environ"):
+                with self.mock_docker(services):
+                    self.cli_command(argv)
+
+                    # Workers configure themselves from the command line, with
+                    # a lock dir private to this server
+                    worker_args = json.loads(os.environ[server.WORKER_ARGS])
+                    self.assertListEqual(worker_args[:-2], argv)
+                    self.assertEqual(worker_args[-2], "--lock-dir")
+                    lock_dir = worker_args[-1]
+
+        # Removed once the server stops
+        self.assertFalse(os.path.exists(lock_dir))
+
+        self.assertEqual(
+            uvicorn.run.mock_calls[0],
+            call(
+                "kapten.server:app",
+                host="0.0.0.0",
+                port=8800,
+                proxy_headers=True,
+                workers=2,
+            ),
+        )
+
+        cli.worker(worker_args)
+        self.addCleanup(shutil.rmtree, lock_dir, ignore_errors=True)
+        self.addCleanup(server.app.state.client.close)
+        self.assertEqual(server.app.state.client.service_names, ["foo"])
+        self.assertEqual(str(server.app.state.token), "secret")
+        self.assertEqual(server.app.state.locks.directory, lock_dir)
+
+    def test_command_watch(self):
+        services = [("foo", "repo/foo:tag@sha256:0")]
+        argv = self.build_sys_args(
+            services, "--watch", "--interval", "30", "--max-interval", "600"
+        )
+
+        with mock.patch("kapten.scheduler.Scheduler") as scheduler:
+            scheduler.return_value.run = asynctest.CoroutineMock(
+                side_effect=KeyboardInterrupt()
+            )
+            with self.mock_docker(services):
+                self.cli_command(argv)
+
+        self.assertTrue(scheduler.return_value.run.called)
+        self.assertDictEqual(
+            scheduler.call_args[1],
+            {"interval": 30, "min_interval": None, "max_interval": 600},
+        )
+
+    def test_command_endpoints(self):
+        services = [("foo", "repo/foo:tag@sha256:0")]
+        argv = self.build_sys_args(services, "-e", "a=tcp://a:2375", "-e", "b=tcp://b")
+
+        with self.mock_docker(services) as httpx_mock:
+            self.cli_command(argv)
+            hosts = {r.url.host for r, _ in httpx_mock["service_update"].calls}
+            self.assertSetEqual(hosts, {"a", "b"})
+
+        with self.assertRaises(SystemExit) as cm:
+            with self.mock_stderr() as stderr:
+                self.cli_command(argv + ["-e", "invalid"])
+        self.assertIn("expected NAME=HOST", stderr.getvalue())
+        self.assertEqual(cm.exception.code, 2)
+
+    def test_command_invalid_options(self):
+        with self.assertRaises(SystemExit) as cm:
+            with self.mock_stderr() as stderr:
+                self.cli_command(["-s", "/[/"])
+        self.assertIn("Invalid service pattern /[/", stderr.getvalue())
+        self.assertEqual(cm.exception.code, 2)
+
+        with self.assertRaises(SystemExit) as cm:
+            with self.mock_stderr() as stderr:
+                self.cli_command(["-s", "app", "--waves", "stacks"])
+        self.assertIn("Invalid rollout waves: stacks", stderr.getvalue())
@@ -0,0 +1,282 @@
+import asyncio
+import os
+import tempfile
+from unittest import mock
+
+import asynctest
+
+from kapten.concurrency import (
+    AdaptiveLimiter,
+    BoardingFlight,
+    FileLocks,
+    SingleFlight,
+)
+from kapten.tool import Kapten
+
+from .testcases import KaptenTestCase
+
+
+class AdaptiveLimiterTestCase(KaptenTestCase):
+    async def test_bounded_concurrency(self):
+        limiter = AdaptiveLimiter(3)
+        running = []
+        peak = 0
+
+        async def work(n):
+            nonlocal peak
+            running.append(n)
+            peak = max(peak, len(running))
+            await asyncio.sleep(0.01)
+            running.remove(n)
+            return n
+
+        results = await asyncio.gather(*(limiter.call(work, n) for n in range(10)))
+        self.assertListEqual(results, list(range(10)))
+        self.assertEqual(peak, 3)
+        self.assertEqual(limiter.in_flight, 0)
+
+    async def test_adapts_limit(self):
+        limiter = AdaptiveLimiter(8, min_limit=2, latency_target=1.0)
+
+        async def fail():
+            raise ValueError()
+
+        for _ in range(3):
+            with self.assertRaises(ValueError):
+                await limiter.call(fail)
+        self.assertEqual(limiter.limit, 2)
+
+        await limiter.acquire()
+        limiter.release(latency=5.0)
+        self.assertEqual(limiter.limit, 2)
+
+        for _ in range(50):
+            await limiter.call(asyncio.sleep, 0)
+        self.assertEqual(limiter.limit, 8)
+
+    async def test_cancelled_waiter(self):
+        limiter = AdaptiveLimiter(1)
+        await limiter.acquire()
+
+        waiter = asyncio.ensure_future(limiter.acquire())
+        other = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+
+        # Wake the first waiter, but cancel it before it takes the slot
+        limiter.release(latency=0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+
+        self.assertTrue(waiter.cancelled())
+        self.assertTrue(other.done())
+        self.assertEqual(limiter.in_flight, 1)
+
+
+class SingleFlightTestCase(KaptenTestCase):
+    async def test_coalesces_calls(self):
+        flights = SingleFlight()
+        calls = []
+
+        async def work(n):
+            calls.append(n)
+            await asyncio.sleep(0.01)
+            return n
+
+        results = await asyncio.gather(
+            flights.call("a", work, 1),
+            flights.call("a", work, 2),
+            flights.call("b", work, 3),
+        )
+        self.assertListEqual(results, [1, 1, 3])
+        self.assertListEqual(calls, [1, 3])
+        self.assertEqual(len(flights), 0)
+
+        # Landed flights are not reused
+        self.assertEqual(await flights.call("a", work, 4), 4)
+
+    async def test_shares_errors(self):
+        flights = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError("Boom")
+
+        results = await asyncio.gather(
+            flights.call("a", fail), flights.call("a", fail), return_exceptions=True
+        )
+        self.assertIs(results[0], results[1])
+        self.assertIsInstance(results[0], ValueError)
+
+    async def test_cancelled_caller(self):
+        flights = SingleFlight()
+        done = asyncio.Event()
+
+        async def work():
+            await done.wait()
+            return "ok"
+
+        first = asyncio.ensure_future(flights.call("a", work))
+        second = asyncio.ensure_future(flights.call("a", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        done.set()
+        self.assertEqual(await second, "ok")
+
+    async def test_coalesces_service_updates(self):
+        services = [
+            ("stack_app", "repo/app:latest@sha256:10001"),
+            ("stack_worker", "repo/app:latest@sha256:10001"),
+        ]
+        client = Kapten([name for name, _ in services])
+
+        with self.mock_docker(services) as httpx_mock:
+            results = await asyncio.gather(
+                client.update_services(image="repo/app:latest"),
+                client.update_services(image="repo/app:latest"),
+                client.update_services(image="repo/app:latest@sha256:10002"),
+            )
+            self.assertEqual(httpx_mock["services"].call_count, 1)
+            self.assertEqual(httpx_mock["service_update"].call_count, 2)
+            self.assertListEqual(results[0], results[2])
+
+            # Joining an update not yet started, the latest digest wins
+            results = await asyncio.gather(
+                client.update_services(image="repo/app:latest"),
+                client.update_services(image="repo/app:latest@sha256:10003"),
+            )
+            self.assertEqual(httpx_mock["services"].call_count, 2)
+            self.assertListEqual(results[0], results[1])
+            self.assertEqual(
+                {s.image_with_digest for s in results[1]},
+                {"repo/app:latest@sha256:10003"},
+            )
+
+        await client.close()
+
+    async def test_service_updates_during_update(self):
+        client = Kapten(["stack_app"])
+        pushed = asyncio.Event()
+        rolled_out = []
+
+        async def rollout(services, digests):
+            rolled_out.append(digests["repo/app:latest"])
+            await pushed.wait()
+            return {}
+
+        get_latest_digests = asynctest.CoroutineMock(
+            side_effect=[
+                {"repo/app:latest": "sha256:10002"},
+                {"repo/app:latest": "sha256:10003"},
+            ]
+        )
+        services = [("stack_app", "repo/app:latest@sha256:10001")]
+        with self.mock_docker(services):
+            with mock.patch.object(client, "rollout", rollout):
+                with mock.patch.object(
+                    client, "get_latest_digests", get_latest_digests
+                ):
+                    first = asyncio.ensure_future(
+                        client.update_services(image="repo/app:latest")
+                    )
+                    while not rolled_out:
+                        await asyncio.sleep(0.001)
+
+                    # Pushes announced, without digest, while rolling out
+                    later = [
+                        asyncio.ensure_future(
+                            client.update_services(image="repo/app:latest")
+                        )
+                        for _ in range(2)
+                    ]
+                    await asyncio.sleep(0.001)
+                    pushed.set()
+                    await asyncio.gather(first, *later)
+
+        # Updated once more, to the latest push
+        self.assertListEqual(rolled_out, ["sha256:10002", "sha256:10003"])
+        self.assertEqual(get_latest_digests.call_count, 2)
+        self.assertEqual(len(client.flights), 0)
+        await client.close()
+
+
+class BoardingFlightTestCase(KaptenTestCase):
+    async def test_queues_after_departure(self):
+        flights = BoardingFlight()
+        departing = asyncio.Event()
+        calls = []
+
+        async def work(depart, n):
+            calls.append(n)
+            await departing.wait()
+            depart()
+            await asyncio.sleep(0.01)
+            if n == 1:
+                raise ValueError("Boom")
+            return n
+
+        first = asyncio.ensure_future(flights.call("a", work, 1))
+        await asyncio.sleep(0)
+        joined = asyncio.ensure_future(flights.call("a", work, 2))
+        await asyncio.sleep(0.001)
+        departing.set()
+        await asyncio.sleep(0.001)
+
+        # One call queued after the departed one, with the latest arguments
+        results = await asyncio.gather(
+            first,
+            joined,
+            flights.call("a", work, 3),
+            flights.call("a", work, 4),
+            flights.call("b", work, 5),
+            return_exceptions=True,
+        )
+        self.assertIsInstance(results[0], ValueError)
+        self.assertIs(results[0], results[1])
+        self.assertListEqual(results[2:], [4, 4, 5])
+        self.assertListEqual(calls, [1, 5, 4])
+        self.assertEqual(len(flights), 0)
+
+
+class FileLocksTestCase(KaptenTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = os.path.join(directory.name, "locks")
+
+    async def test_exclusive_per_key(self):
+        # As if held by separate processes
+        first = FileLocks(self.directory, poll_interval=0.001)
+        second = FileLocks(self.directory, poll_interval=0.001)
+        running = []
+        log = []
+
+        async def work(name):
+            running.append(name)
+            log.append((name, tuple(running)))
+            await asyncio.sleep(0.01)
+            running.remove(name)
+            return name
+
+        results = await asyncio.gather(
+            first.call("repo/app:latest", work, "a"),
+            second.call("repo/app:latest", work, "b"),
+            second.call("repo/db:latest", work, "c"),
+        )
+        self.assertListEqual(results, ["a", "b", "c"])
+        self.assertIn(("c", ("a", "c")), log)
+        self.assertTrue(all(running != ("a", "b") for _, running in log))
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+    async def test_released_on_error(self):
+        locks = FileLocks(self.directory)
+
+        async def fail():
+            raise ValueError("boom")
+
+        with self.assertRaises(ValueError):
+            await locks.call("repo/app:latest", fail)
+
+        fd = await asyncio.wait_for(locks.acquire("repo/app:latest"), timeout=1)
+        locks.release(fd)
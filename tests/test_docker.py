@@ -1,8 +1,14 @@
 import json
 import os
+import re
 from unittest import mock
 
-from kapten.docker import DockerAPIClient
+import asynctest
+import respx
+from httpx.exceptions import ConnectionClosed, ConnectTimeout, DecodingError
+
+from kapten.docker import DockerAPIClient, JSONArrayDecoder, Service
+from kapten.exceptions import KaptenAPIError, KaptenConnectionError
 
 from .testcases import KaptenTestCase
 
@@ -70,3 +76,182 @@ class DockerAPIClientTestCase(KaptenTestCase):
             with self.mock_docker():
                 version = await api.version()
                 self.assertIn("ApiVersion", version)
+
+    async def test_pooled_client(self):
+        api = DockerAPIClient(pool_size=3)
+        with self.mock_docker():
+            await api.version()
+            client = api.client
+            await api.version()
+            self.assertIs(api.client, client)
+            self.assertEqual(client.dispatch.pool_limits.hard_limit, 3)
+
+        await api.close()
+        self.assertIsNone(api._client)
+        await api.close()
+
+    async def test_broken_connection(self):
+        api = DockerAPIClient()
+        with self.mock_docker():
+            respx.get(re.compile(r"^http://[^/]+/info$"), content=ConnectionClosed())
+            client = api.client
+            with self.assertRaises(KaptenConnectionError):
+                await api.request("GET", "/info")
+
+            # Only the broken connection is dropped, not the shared pool
+            await api.version()
+            self.assertIs(api.client, client)
+
+        await api.close()
+
+    async def test_services_filtered(self):
+        api = DockerAPIClient()
+        services = [("foo", "foo/bar:baz@sha256:1"), ("foobar", "foo/bar:baz@sha256:1")]
+        with self.mock_docker(services=services) as httpx_mock:
+            services = await api.services(keep=lambda s: s.name == "foo", name=["foo"])
+            self.assertListEqual([s.name for s in services], ["foo"])
+            request, _ = httpx_mock["services"].calls[0]
+            self.assertIn("filters", request.url.query)
+
+    async def test_services_error(self):
+        api = DockerAPIClient()
+        respx.get(
+            re.compile(r"^http://[^/]+/services$"),
+            status_code=500,
+            content={"message": "Boom"},
+        )
+        with self.assertRaisesRegex(KaptenAPIError, "Boom"):
+            await api.services()
+
+    async def test_services_invalid(self):
+        api = DockerAPIClient()
+        respx.get(re.compile(r"^http://[^/]+/services$"), content="[{")
+        with self.assertRaises(KaptenAPIError):
+            await api.services()
+
+    async def test_services_http_error(self):
+        api = DockerAPIClient()
+        respx.get(re.compile(r"^http://[^/]+/services$"), content=DecodingError())
+        with self.assertRaises(KaptenAPIError):
+            await api.services()
+
+    async def test_service(self):
+        api = DockerAPIClient()
+        services = [("foobar", "foo/bar:baz@sha256:1")]
+        with self.mock_docker(services=services):
+            service = await api.service("foobar")
+            self.assertEqual(service.image, "foo/bar:baz")
+
+    async def test_events(self):
+        api = DockerAPIClient()
+        on_connect = asynctest.CoroutineMock()
+        with self.mock_docker(events='{"Type": "service"}\n\n{"Type": "node"}\n'):
+            events = api.events(on_connect=on_connect, type=["service"])
+            events = [event async for event in events]
+            self.assertListEqual(events, [{"Type": "service"}, {"Type": "node"}])
+            self.assertTrue(on_connect.called)
+
+    async def test_events_own_connection(self):
+        api = DockerAPIClient(pool_size=1)
+        with self.mock_docker(events='{"Type": "service"}\n'):
+            # The stream leaves the single pooled connection free for others
+            events = api.events(on_connect=api.version)
+            events = [event async for event in events]
+            self.assertListEqual(events, [{"Type": "service"}])
+            self.assertIsNotNone(api._client)
+
+        await api.close()
+
+    async def test_events_error(self):
+        api = DockerAPIClient()
+        respx.get(re.compile(r"^http://[^/]+/events$"), status_code=500)
+        with self.assertRaises(KaptenAPIError):
+            async for _ in api.events():
+                pass  # pragma: nocover
+
+    async def test_events_connection_error(self):
+        api = DockerAPIClient()
+        with self.mock_docker(events=ConnectTimeout()):
+            with self.assertRaises(KaptenConnectionError):
+                async for _ in api.events():
+                    pass  # pragma: nocover
+
+
+class ServiceTestCase(KaptenTestCase):
+    def test_parse(self):
+        data = self.build_service_response("stack_app", "repo/app:latest@sha256:1")
+        data["Endpoint"] = {"Ports": []}
+        service = Service(data)
+        self.assertEqual(service.id, data["ID"])
+        self.assertEqual(service.version, data["Version"]["Index"])
+        self.assertIs(service.spec, data["Spec"])
+        self.assertEqual(service.name, "stack_app")
+        self.assertEqual(service.stack, "stack")
+        self.assertEqual(service.short_name, "app")
+        self.assertEqual(service.image, "repo/app:latest")
+        self.assertEqual(service.digest, "sha256:1")
+        self.assertEqual(service.repository, "repo/app")
+        self.assertFalse(hasattr(service, "__dict__"))
+        self.assertIn("stack_app", repr(service))
+
+        # Only service labels, as docker's label filter sees them
+        self.assertDictEqual(service.labels, {})
+        data["Spec"]["Labels"] = {"tier": "backend"}
+        self.assertDictEqual(Service(data).labels, {"tier": "backend"})
+
+        service = Service(self.build_service_response("app", "localhost:5000/app"))
+        self.assertIsNone(service.stack)
+        self.assertEqual(service.short_name, "app")
+        self.assertEqual(service.repository, "localhost:5000/app")
+        self.assertEqual(service.digest, "")
+
+        service = Service(self.build_service_response("app", "localhost:5000/app:1"))
+        self.assertEqual(service.repository, "localhost:5000/app")
+
+    def test_clone(self):
+        data = self.build_service_response("stack_app", "repo/app:latest@sha256:1")
+        data["Spec"]["TaskTemplate"]["Networks"] = [{"Target": "net"}]
+        data["Spec"]["Labels"] = {"foo": "bar"}
+        service = Service(data)
+
+        clone = service.clone("sha256:2")
+        self.assertEqual(clone.image_with_digest, "repo/app:latest@sha256:2")
+        self.assertEqual(clone.digest, "sha256:2")
+        self.assertEqual(service.image_with_digest, "repo/app:latest@sha256:1")
+        self.assertEqual(clone.id, service.id)
+        self.assertEqual(clone.version, service.version)
+
+        # Untouched parts of the spec are shared, not copied
+        spec, original = clone.spec, service.spec
+        self.assertIs(spec["Labels"], original["Labels"])
+        self.assertIs(
+            spec["TaskTemplate"]["Networks"], original["TaskTemplate"]["Networks"]
+        )
+        container_spec = dict(original["TaskTemplate"]["ContainerSpec"])
+        container_spec["Image"] = "repo/app:latest@sha256:2"
+        self.assertDictEqual(spec["TaskTemplate"]["ContainerSpec"], container_spec)
+
+
+class JSONArrayDecoderTestCase(KaptenTestCase):
+    def test_feed(self):
+        items = [
+            {"ID": str(i), "Spec": {"Name": "x" * i, "Labels": {}}} for i in range(50)
+        ]
+        data = " " + json.dumps(items, indent=2) + "\n"
+        for size in (1, 7, 64, len(data)):
+            decoder = JSONArrayDecoder()
+            decoded = []
+            for i in range(0, len(data), size):
+                decoded.extend(decoder.feed(data[i : i + size]))
+            decoder.close()
+            self.assertListEqual(decoded, items)
+
+    def test_invalid(self):
+        decoder = JSONArrayDecoder()
+        with self.assertRaises(ValueError):
+            decoder.feed('{"foo": "bar"}')
+
+        decoder = JSONArrayDecoder()
+        self.assertListEqual(decoder.feed('[{"foo": 1}, {"ba'), [{"foo": 1}])
+        with self.assertRaises(ValueError):
+            decoder.close()
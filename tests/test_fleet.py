@@ -0,0 +1,108 @@
+from kapten.exceptions import KaptenError
+from kapten.fleet import Fleet, parse_endpoint, route_services
+
+from .testcases import KaptenTestCase
+
+
+class FleetTestCase(KaptenTestCase):
+    endpoints = {"staging": "tcp://staging:2375", "production": "tcp://prod:2375"}
+
+    def test_parse_endpoint(self):
+        self.assertEqual(
+            parse_endpoint("staging=tcp://1.2.3.4:2375"),
+            ("staging", "tcp://1.2.3.4:2375"),
+        )
+        for value in ("staging", "=tcp://1.2.3.4", "staging="):
+            with self.assertRaises(ValueError):
+                parse_endpoint(value)
+
+    def test_route_services(self):
+        service_names = ["app", "staging:debug", "production:db", "image=repo/*:beta"]
+        self.assertListEqual(
+            route_services(service_names, "staging"),
+            ["app", "debug", "image=repo/*:beta"],
+        )
+        self.assertListEqual(
+            route_services(service_names, "production"),
+            ["app", "db", "image=repo/*:beta"],
+        )
+        self.assertListEqual(
+            route_services(["staging:/^app(?:_v2)?$/"], "staging"), ["/^app(?:_v2)?$/"]
+        )
+
+    def test_invalid_services(self):
+        with self.assertRaises(ValueError):
+            Fleet(self.endpoints, ["qa:app"])
+        with self.assertRaises(ValueError):
+            Fleet({}, ["app"])
+
+    async def test_update_services(self):
+        services = [
+            ("stack_app", "repo/app:latest@sha256:10001"),
+            ("stack_db", "repo/db:latest@sha256:20001"),
+        ]
+        fleet = Fleet(self.endpoints, ["stack_app", "staging:stack_db"])
+        staging, production = fleet.clients["staging"], fleet.clients["production"]
+        self.assertListEqual(staging.service_names, ["stack_app", "stack_db"])
+        self.assertListEqual(production.service_names, ["stack_app"])
+
+        # Digest lookups and caches are shared
+        self.assertIs(staging.digests, production.digests)
+        self.assertIs(staging.lookups, production.lookups)
+        self.assertIsNot(staging.updates, production.updates)
+
+        with self.mock_docker(services) as httpx_mock:
+            self.assertEqual(await fleet.healthcheck(), 3)
+            self.assertSetEqual(
+                set(await fleet.list_repositories()), {"repo/app", "repo/db"}
+            )
+
+            distribution_calls = httpx_mock["distribution"].call_count
+            updated = await fleet.update_services(image="repo/app:latest")
+            self.assertListEqual(
+                [s.image_with_digest for s in updated],
+                ["repo/app:latest@sha256:10002"] * 2,
+            )
+
+            # Resolved once for both endpoints
+            self.assertEqual(
+                httpx_mock["distribution"].call_count, distribution_calls + 1
+            )
+            hosts = {
+                request.url.host for request, _ in httpx_mock["service_update"].calls
+            }
+            self.assertSetEqual(hosts, {"staging", "prod"})
+
+            await fleet.update_services()
+            self.assertEqual(httpx_mock["service_update"].call_count, 5)
+
+        await fleet.close()
+
+    async def test_tracked_repositories(self):
+        services = [
+            ("stack_app", "repo/app:latest@sha256:10001"),
+            ("stack_db", "repo/db:latest@sha256:20001"),
+        ]
+        fleet = Fleet(self.endpoints, ["production:stack_app", "staging:stack_db"])
+
+        with self.mock_docker(services):
+            # Unknown until every endpoint's inventory is synced
+            await fleet.clients["staging"].inventory.resync()
+            self.assertIsNone(fleet.tracked_repositories())
+            await fleet.clients["production"].inventory.resync()
+            self.assertSetEqual(fleet.tracked_repositories(), {"repo/app", "repo/db"})
+
+        await fleet.close()
+
+    async def test_update_services_failure(self):
+        services = [("app", "repo/app:latest@sha256:10001")]
+        fleet = Fleet(self.endpoints, ["app"])
+
+        with self.mock_docker(services, with_api_error=True) as httpx_mock:
+            with self.assertRaises(KaptenError):
+                await fleet.update_services(image="repo/app:latest")
+
+            # Failing on one endpoint does not stop the others
+            self.assertEqual(httpx_mock["service_update"].call_count, 2)
+
+        await fleet.close()
@@ -0,0 +1,156 @@
+import asyncio
+import json
+from unittest import mock
+
+from kapten.docker import Service
+from kapten.exceptions import KaptenAPIError, KaptenError
+from kapten.inventory import ServiceIndex
+from kapten.selectors import ServiceSelector
+from kapten.tool import Kapten
+
+from .testcases import KaptenTestCase
+
+
+class ServiceIndexTestCase(KaptenTestCase):
+    def test_index(self):
+        services = [
+            Service(self.build_service_response(name, image))
+            for name, image in (
+                ("stack_db", "repo/db:latest@sha256:1"),
+                ("stack_app", "repo/app:latest@sha256:2"),
+                ("stack_worker", "repo/app:latest@sha256:2"),
+                ("stack_beta", "repo/app:beta@sha256:3"),
+                ("other", "repo/other:latest@sha256:4"),
+            )
+        ]
+        names = ["stack_app", "stack_worker", "stack_beta", "stack_db", "stack_app"]
+        index = ServiceIndex(services, ServiceSelector(names + ["missing"]))
+
+        self.assertEqual(len(index), 4)
+        self.assertListEqual(
+            [s.name for s in index.services],
+            ["stack_app", "stack_worker", "stack_beta", "stack_db"],
+        )
+        self.assertIs(index.by_name["stack_db"], services[0])
+        self.assertListEqual(
+            [s.name for s in index.by_image["repo/app:latest"]],
+            ["stack_app", "stack_worker"],
+        )
+        self.assertEqual(len(index.by_repository["repo/app"]), 3)
+        self.assertSetEqual(set(index.repositories), {"repo/app", "repo/db"})
+        self.assertIn("repo/app:beta", index.images)
+        self.assertListEqual(index.missing, ["missing"])
+
+
+class ServiceInventoryTestCase(KaptenTestCase):
+    def build_event(self, action, name):
+        return {
+            "Type": "service",
+            "Action": action,
+            "Actor": {"ID": name, "Attributes": {"name": name}},
+        }
+
+    async def test_follow_events(self):
+        services = [
+            ("stack_app", "repository/app:latest@sha256:10001"),
+            ("stack_db", "repository/db:latest@sha256:20001"),
+        ]
+        events = "\n".join(
+            json.dumps(event)
+            for event in (
+                self.build_event("update", "stack_app"),
+                self.build_event("remove", "stack_db"),
+                self.build_event("update", "untracked"),
+                {"Type": "container", "Action": "start"},
+                self.build_event("unknown", "stack_app"),
+            )
+        )
+        client = Kapten(["stack_app", "stack_db"])
+
+        with self.mock_docker(services, events=events) as httpx_mock:
+            await client.inventory.follow()
+            self.assertTrue(client.inventory.ready)
+            self.assertListEqual(
+                [s.name for s in client.inventory.index.services], ["stack_app"]
+            )
+            self.assertEqual(httpx_mock["service"].call_count, 1)
+            request, _ = httpx_mock["events"].calls[0]
+            self.assertIn("service", request.url.query)
+
+            # Services are listed from inventory once ready
+            self.assertEqual(httpx_mock["services"].call_count, 1)
+            with self.assertRaises(KaptenError):
+                await client.list_services()
+            self.assertEqual(httpx_mock["services"].call_count, 1)
+
+        await client.close()
+
+    async def test_follow_selected_events(self):
+        services = [
+            ("stack_app", "repository/app:latest@sha256:10001"),
+            ("web_app", "repository/web:latest@sha256:30001"),
+            ("other", "repository/other:latest@sha256:40001"),
+        ]
+        events = "\n".join(
+            json.dumps(self.build_event("update", name))
+            for name in ("web_app", "other")
+        )
+        client = Kapten(["/_app$/"])
+
+        with self.mock_docker(services, events=events) as httpx_mock:
+            await client.inventory.follow()
+            self.assertListEqual(
+                [s.name for s in client.inventory.index.services],
+                ["stack_app", "web_app"],
+            )
+            # Events of services not matching by name are never inspected
+            self.assertEqual(httpx_mock["service"].call_count, 1)
+
+        await client.close()
+
+    async def test_tracked_repositories(self):
+        services = [("stack_app", "repository/app:latest@sha256:10001")]
+        client = Kapten(["stack_app", "stack_db"])
+        self.assertIsNone(client.tracked_repositories())
+
+        with self.mock_docker(services):
+            await client.inventory.resync()
+            self.assertSetEqual(client.tracked_repositories(), {"repository/app"})
+
+            # Created after the last listing
+            services.append(("stack_db", "repository/db:latest@sha256:20001"))
+            await client.inventory.apply(self.build_event("create", "stack_db"))
+            self.assertSetEqual(
+                client.tracked_repositories(), {"repository/app", "repository/db"}
+            )
+
+            # Known repositories are kept while out of sync
+            client.inventory.ready = False
+            self.assertEqual(len(client.tracked_repositories()), 2)
+
+        await client.close()
+
+    async def test_watch(self):
+        client = Kapten(["app"], resync_interval=0.01)
+        inventory = client.inventory
+        inventory.ready = True
+        outcomes = [asyncio.sleep(1), KaptenAPIError("Boom"), KeyError("ID"), None]
+
+        async def follow():
+            if not outcomes:
+                raise asyncio.CancelledError()
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            elif outcome is not None:
+                await outcome
+
+        with mock.patch.object(inventory, "follow", follow):
+            with self.assertRaises(asyncio.CancelledError):
+                await inventory.watch(retry_delay=0.001)
+
+        self.assertFalse(inventory.ready)
+        self.logger_mock.warning.assert_called_with(
+            "Service inventory out of sync: %s", mock.ANY
+        )
+        self.logger_mock.exception.assert_called_with("Service inventory failed")
@@ -0,0 +1,243 @@
+import asyncio
+import os
+import tempfile
+from unittest import mock
+
+import asynctest
+
+from kapten.exceptions import KaptenAPIError
+from kapten.jobs import CLAIM_TIMEOUT, JobQueue, JobStore
+
+from .testcases import KaptenTestCase
+
+
+class JobQueueTestCase(KaptenTestCase):
+    async def test_run_jobs(self):
+        update = asynctest.CoroutineMock(side_effect=[[], KaptenAPIError("Boom")])
+        on_start = asynctest.CoroutineMock()
+        on_finish = asynctest.CoroutineMock()
+        publish = mock.Mock()
+        jobs = JobQueue(update, workers=2, publish=publish)
+        jobs.start()
+
+        first = jobs.submit("repo/app:latest", on_start=on_start, on_finish=on_finish)
+        second = jobs.submit("repo/app:beta")
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(first.status, "queued")
+        self.assertIn("queued", repr(first))
+
+        await jobs.join()
+        self.assertEqual(first.status, "succeeded")
+        self.assertLessEqual(first.created, first.started)
+        self.assertLessEqual(first.started, first.finished)
+        on_start.assert_awaited_once_with(first)
+        on_finish.assert_awaited_once_with(first)
+        # Published when queued, started and finished
+        self.assertEqual(publish.call_count, 6)
+        self.assertEqual(second.status, "failed")
+        self.assertEqual(second.error, "Boom")
+        self.assertIs(jobs.get(second.id), second)
+        self.assertIsNone(jobs.get("unknown"))
+
+        await jobs.stop()
+        self.assertListEqual(jobs.tasks, [])
+
+    async def test_unhandled_error(self):
+        update = asynctest.CoroutineMock(side_effect=RuntimeError())
+        jobs = JobQueue(update, workers=1)
+        jobs.start()
+
+        job = jobs.submit("repo/app:latest")
+        await jobs.join()
+        self.assertEqual(job.status, "failed")
+        self.assertEqual(job.error, "RuntimeError")
+        self.logger_mock.exception.assert_called_with("Unhandled error")
+        await jobs.stop()
+
+    async def test_bounded(self):
+        done = asyncio.Event()
+
+        async def update(image):
+            await done.wait()
+            return []
+
+        jobs = JobQueue(update, workers=1, maxsize=2, history=2)
+        self.assertEqual(len(jobs), 0)
+        await jobs.join()
+        jobs.start()
+
+        # Queue is full until workers get to run
+        jobs.submit("repo/app:1")
+        jobs.submit("repo/app:2")
+        with self.assertRaises(asyncio.QueueFull):
+            jobs.submit("repo/app:3")
+
+        # Unfinished jobs are never forgotten
+        await asyncio.sleep(0)
+        jobs.submit("repo/app:3")
+        self.assertEqual(len(jobs.jobs), 3)
+
+        # Only the latest finished jobs are kept
+        done.set()
+        await jobs.join()
+        job = jobs.submit("repo/app:4")
+        self.assertListEqual(
+            [j.image for j in jobs.jobs.values()], ["repo/app:3", "repo/app:4"]
+        )
+        self.assertIs(jobs.get(job.id), job)
+        await jobs.stop()
+
+    async def test_coalesce_queued(self):
+        done = asyncio.Event()
+        calls = []
+
+        async def update(image):
+            calls.append(image)
+            await done.wait()
+            return []
+
+        on_finish = asynctest.CoroutineMock()
+        jobs = JobQueue(update, workers=1, maxsize=2)
+        jobs.start()
+
+        # More webhooks than workers, all but the running one collapse
+        running = jobs.submit("repo/app:latest@sha256:1")
+        await asyncio.sleep(0)
+        queued = [
+            jobs.submit("repo/app:latest@sha256:2", on_finish=on_finish),
+            jobs.submit("repo/app:latest@sha256:3", on_finish=on_finish),
+            jobs.submit("repo/app:latest", on_finish=on_finish),
+        ]
+        beta = jobs.submit("repo/app:beta")
+        self.assertIsNot(queued[0], running)
+        self.assertEqual(len(set(queued)), 1)
+        self.assertEqual(len(jobs), 2)
+
+        done.set()
+        await jobs.join()
+        self.assertListEqual(
+            calls, ["repo/app:latest@sha256:1", "repo/app:latest", "repo/app:beta"]
+        )
+        self.assertEqual(beta.status, "succeeded")
+        self.assertEqual(on_finish.await_count, 3)
+        on_finish.assert_awaited_with(queued[0])
+        self.assertEqual(len(jobs), 0)
+        await jobs.stop()
+
+    async def test_debounce(self):
+        update = asynctest.CoroutineMock(return_value=[])
+        jobs = JobQueue(update, workers=1, maxsize=1, debounce=0.01)
+        jobs.start()
+
+        # Waiting out the window holds no worker, and counts towards capacity
+        first = jobs.submit("repo/app:latest@sha256:1")
+        await asyncio.sleep(0)
+        second = jobs.submit("repo/app:latest@sha256:2")
+        self.assertIs(first, second)
+        self.assertEqual(first.status, "queued")
+        with self.assertRaises(asyncio.QueueFull):
+            jobs.submit("repo/app:beta")
+
+        await jobs.join()
+        update.assert_awaited_once_with("repo/app:latest@sha256:2")
+
+        # Stopping drops jobs still waiting out the window
+        job = jobs.submit("repo/app:beta")
+        await jobs.stop()
+        self.assertEqual(job.status, "queued")
+        self.assertSetEqual(jobs.delayed, set())
+
+
+class JobStoreTestCase(KaptenTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "jobs.db")
+
+    def test_shared(self):
+        # As if used by separate worker processes
+        first = JobStore(self.path, history=2)
+        second = JobStore(self.path, history=2)
+        self.addCleanup(first.close)
+        self.addCleanup(second.close)
+
+        first.save("1", {"id": "1", "status": "queued"})
+        first.deliver("delivery", "1")
+        self.assertDictEqual(second.load("1"), {"id": "1", "status": "queued"})
+        self.assertEqual(second.delivery("delivery"), "1")
+        self.assertIsNone(second.delivery("unknown"))
+
+        # Only the latest jobs are kept
+        for job_id in ("1", "2", "3"):
+            second.save(job_id, {"id": job_id, "status": "succeeded"})
+        self.assertIsNone(first.load("1"))
+        self.assertEqual(first.load("3")["status"], "succeeded")
+
+    def test_prune_history(self):
+        store = JobStore(self.path, history=20)
+        self.addCleanup(store.close)
+        with mock.patch("kapten.jobs.time.time", side_effect=range(22)):
+            for job_id in range(21):
+                store.save(str(job_id), {"id": job_id})
+
+            # Pruned every other save, by a tenth of the history
+            self.assertEqual(store.load("0"), {"id": 0})
+            store.save("21", {"id": 21})
+        self.assertIsNone(store.load("0"))
+        self.assertIsNone(store.load("1"))
+        self.assertEqual(store.load("2"), {"id": 2})
+
+    async def test_call_and_defer(self):
+        store = JobStore(self.path)
+        self.addCleanup(store.close)
+
+        # Deferred writes are done in order, before anything queued later
+        store.defer(store.save, "1", {"id": "1", "status": "queued"})
+        store.defer(store.save, "1", {"id": "1", "status": "running"})
+        data = await store.call(store.load, "1")
+        self.assertEqual(data["status"], "running")
+
+        store.defer(store.save, "2", {"id": object()})
+        self.assertIsNone(await store.call(store.load, "2"))
+        self.logger_mock.error.assert_called_once()
+
+    def test_claim_delivery(self):
+        store = JobStore(ttl=60)
+        self.addCleanup(store.close)
+        with mock.patch("kapten.jobs.time.time", return_value=100):
+            self.assertTrue(store.claim("expired"))
+            store.deliver("expired", "1")
+
+        with mock.patch("kapten.jobs.time.time", return_value=160):
+            # Reserved until its job is queued
+            self.assertTrue(store.claim("delivery"))
+            self.assertFalse(store.claim("delivery"))
+            self.assertIsNone(store.delivery("delivery"))
+            store.deliver("delivery", "2")
+            self.assertFalse(store.claim("delivery"))
+            self.assertEqual(store.delivery("delivery"), "2")
+
+            # Released reservations can be claimed again, delivered ones not
+            self.assertTrue(store.claim("failed"))
+            store.release("failed")
+            self.assertTrue(store.claim("failed"))
+            store.release("delivery")
+            self.assertEqual(store.delivery("delivery"), "2")
+
+            # Expired deliveries are forgotten
+            self.assertIsNone(store.delivery("expired"))
+            self.assertTrue(store.claim("expired"))
+
+    def test_claim_timeout(self):
+        store = JobStore(ttl=3600)
+        self.addCleanup(store.close)
+        with mock.patch("kapten.jobs.time.time", return_value=100):
+            self.assertTrue(store.claim("crashed"))
+            self.assertTrue(store.claim("delivery"))
+            store.deliver("delivery", "1")
+
+        # Reservations left behind, e.g. by a crashed worker, time out sooner
+        with mock.patch("kapten.jobs.time.time", return_value=100 + CLAIM_TIMEOUT):
+            self.assertTrue(store.claim("crashed"))
+            self.assertFalse(store.claim("delivery"))
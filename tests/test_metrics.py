@@ -0,0 +1,99 @@
+import asyncio
+
+from kapten.docker import Service
+from kapten.metrics import (
+    PHASE_DURATION,
+    PHASE_ERRORS,
+    PHASE_IN_FLIGHT,
+    Counter,
+    Gauge,
+    Histogram,
+    Registry,
+    measure,
+)
+from kapten.tool import Kapten
+
+from .testcases import KaptenTestCase
+
+
+class MetricsTestCase(KaptenTestCase):
+    def test_counter(self):
+        counter = Counter("test_total", "Test counter.", ["phase", "type"])
+        counter.inc(phase="a", type="KeyError")
+        counter.inc(2, phase="a", type="KeyError")
+        counter.inc(phase="b", type='Quoted"Error')
+        self.assertEqual(counter.get(phase="a", type="KeyError"), 3)
+        self.assertEqual(
+            counter.render(),
+            "# HELP test_total Test counter.\n"
+            "# TYPE test_total counter\n"
+            'test_total{phase="a",type="KeyError"} 3\n'
+            'test_total{phase="b",type="Quoted\\"Error"} 1',
+        )
+
+    def test_gauge(self):
+        gauge = Gauge("test", "Test gauge.")
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertEqual(gauge.get(), 1)
+        gauge.set(5)
+        self.assertIn("\ntest 5", gauge.render())
+
+    def test_histogram(self):
+        histogram = Histogram("test_seconds", "Test.", ["phase"], buckets=(1, 0.1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, phase="a")
+
+        self.assertEqual(histogram.count(phase="a"), 4)
+        self.assertEqual(histogram.count(phase="b"), 0)
+        self.assertListEqual(
+            histogram.render().splitlines()[2:],
+            [
+                'test_seconds_bucket{phase="a",le="0.1"} 2',
+                'test_seconds_bucket{phase="a",le="1.0"} 3',
+                'test_seconds_bucket{phase="a",le="+Inf"} 4',
+                'test_seconds_sum{phase="a"} 3.65',
+                'test_seconds_count{phase="a"} 4',
+            ],
+        )
+
+    def test_registry(self):
+        registry = Registry()
+        registry.register(Gauge("a", "A."))
+        registry.register(Gauge("b", "B."))
+        self.assertEqual(
+            registry.render(),
+            "# HELP a A.\n# TYPE a gauge\n# HELP b B.\n# TYPE b gauge\n",
+        )
+
+    async def test_measure(self):
+        with measure("test"):
+            self.assertEqual(PHASE_IN_FLIGHT.get(phase="test"), 1)
+        with self.assertRaises(KeyError):
+            with measure("test"):
+                raise KeyError("boom")
+
+        self.assertEqual(PHASE_IN_FLIGHT.get(phase="test"), 0)
+        self.assertEqual(PHASE_DURATION.count(phase="test"), 2)
+        self.assertEqual(PHASE_ERRORS.get(phase="test", type="KeyError"), 1)
+
+    async def test_measure_service_update(self):
+        client = Kapten(["stack_app", "stack_db"], update_concurrency=1)
+        in_flight = []
+
+        async def service_update(service_id, version, spec):
+            in_flight.append(PHASE_IN_FLIGHT.get(phase="service_update"))
+            await asyncio.sleep(0.001)
+
+        # Updates queued for a limiter slot are not measured yet
+        client.docker.service_update = service_update
+        services = [
+            Service(self.build_service_response(name, "repo/app:latest@sha256:1"))
+            for name in ("stack_app", "stack_db")
+        ]
+        await asyncio.gather(
+            *(client.update_service(service, "sha256:2") for service in services)
+        )
+        self.assertListEqual(in_flight, [1, 1])
+        await client.close()
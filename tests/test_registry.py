@@ -0,0 +1,138 @@
+import contextlib
+import re
+
+import httpx
+import respx
+
+from kapten.exceptions import KaptenRegistryError
+from kapten.registry import RegistryClient, parse_image
+from kapten.tool import Kapten
+
+from .testcases import KaptenTestCase
+
+
+class RegistryTestCase(KaptenTestCase):
+    @contextlib.contextmanager
+    def mock_registry(self, digest="sha256:10002", token="s3cr3t", etag='"v1"'):
+        realm = "https://auth.docker.io/token"
+
+        def manifest(request, response):
+            if request.method != "HEAD" or "/manifests/" not in str(request.url):
+                return None
+
+            if request.headers.get("authorization") != f"Bearer {token}":
+                response.status_code = 401
+                response.headers["WWW-Authenticate"] = (
+                    f'Bearer realm="{realm}",service="registry.docker.io",'
+                    f'scope="repository:5monkeys/app:pull"'
+                )
+            elif request.headers.get("if-none-match") == etag:
+                response.status_code = 304
+            else:
+                response.headers["Docker-Content-Digest"] = digest
+                response.headers["ETag"] = etag
+            return response
+
+        respx.request(manifest, alias="manifest")
+        respx.get(
+            re.compile(r"^https://auth\.docker\.io/token\?.*$"),
+            content={"token": token, "expires_in": 300},
+            alias="token",
+        )
+        yield
+
+    def test_parse_image(self):
+        self.assertTupleEqual(
+            parse_image("nginx:1.17"), ("registry-1.docker.io", "library/nginx", "1.17")
+        )
+        self.assertTupleEqual(
+            parse_image("5monkeys/app:latest"),
+            ("registry-1.docker.io", "5monkeys/app", "latest"),
+        )
+        self.assertTupleEqual(
+            parse_image("docker.io/5monkeys/app"),
+            ("registry-1.docker.io", "5monkeys/app", "latest"),
+        )
+        self.assertTupleEqual(
+            parse_image("localhost:5000/team/app:dev"),
+            ("localhost:5000", "team/app", "dev"),
+        )
+        self.assertTupleEqual(
+            parse_image("ghcr.io/5monkeys/app:1"), ("ghcr.io", "5monkeys/app", "1")
+        )
+
+    async def test_manifest_digest(self):
+        registry = RegistryClient()
+        with self.mock_registry():
+            digest = await registry.manifest_digest("5monkeys/app:latest")
+            self.assertEqual(digest, "sha256:10002")
+            self.assertEqual(respx.aliases["token"].call_count, 1)
+
+            # Token and etag are reused for the conditional request
+            digest = await registry.manifest_digest("5monkeys/app:latest")
+            self.assertEqual(digest, "sha256:10002")
+            self.assertEqual(respx.aliases["token"].call_count, 1)
+            request, _ = respx.aliases["manifest"].calls[-1]
+            self.assertEqual(request.headers["if-none-match"], '"v1"')
+            self.assertIn(
+                "application/vnd.docker.distribution.manifest.list.v2+json",
+                request.headers["accept"],
+            )
+        await registry.close()
+
+    async def test_manifest_digest_errors(self):
+        registry = RegistryClient()
+        url = "https://registry-1.docker.io/v2/5monkeys/{}/manifests/latest"
+
+        respx.head(url.format("missing"), status_code=404)
+        with self.assertRaises(KaptenRegistryError):
+            await registry.manifest_digest("5monkeys/missing:latest")
+
+        respx.head(url.format("nodigest"))
+        with self.assertRaises(KaptenRegistryError):
+            await registry.manifest_digest("5monkeys/nodigest:latest")
+
+        respx.head(
+            url.format("private"),
+            status_code=401,
+            headers={"WWW-Authenticate": "Negotiate"},
+        )
+        with self.assertRaises(KaptenRegistryError):
+            await registry.manifest_digest("5monkeys/private:latest")
+
+    async def test_authenticate(self):
+        registry = RegistryClient()
+        with self.mock_docker():
+            headers = await registry.authenticate("localhost:5000", 'Basic realm="x"')
+            self.assertEqual(headers["Authorization"], "Basic Zm9vOmJhcg==")
+
+        realm = "https://auth.example.com/{}"
+        respx.get(realm.format("denied"), status_code=403)
+        respx.get(realm.format("empty"), content={})
+        respx.get(realm.format("html"), content="<html>Maintenance</html>")
+        for path in ("denied", "empty", "html"):
+            challenge = 'Bearer realm="{}"'.format(realm.format(path))
+            with self.assertRaises(KaptenRegistryError):
+                await registry.authenticate("example.com", challenge)
+
+    async def test_kapten_registry_lookup(self):
+        services = [("app", "5monkeys/app:latest@sha256:10001")]
+        client = Kapten(["app"], registry_lookup=True)
+        with self.mock_docker(services) as httpx_mock, self.mock_registry():
+            updated = await client.update_services()
+            self.assertEqual(updated[0].digest, "sha256:10002")
+            self.assertFalse(httpx_mock["distribution"].called)
+        await client.close()
+
+    async def test_kapten_registry_fallback(self):
+        services = [("app", "5monkeys/app:latest@sha256:10001")]
+        client = Kapten(["app"], registry_lookup=True)
+        with self.mock_docker(services) as httpx_mock:
+            respx.head(
+                re.compile(r"^https://registry-1\.docker\.io/.*$"),
+                content=httpx.exceptions.ConnectTimeout(),
+            )
+            updated = await client.update_services()
+            self.assertEqual(updated[0].digest, "sha256:10002")
+            self.assertTrue(httpx_mock["distribution"].called)
+        await client.close()
@@ -0,0 +1,174 @@
+import json
+import re
+from unittest import mock
+
+import respx
+from httpx.exceptions import ConnectTimeout, DecodingError, ReadTimeout
+
+from kapten.docker import DockerAPIClient
+from kapten.exceptions import KaptenAPIError, KaptenConflictError, KaptenConnectionError
+from kapten.retry import CircuitBreaker, backoff_delay
+from kapten.tool import Kapten
+
+from .testcases import KaptenTestCase
+
+
+class RetryTestCase(KaptenTestCase):
+    def setUp(self):
+        super().setUp()
+        mocker = mock.patch("kapten.docker.backoff_delay", return_value=0)
+        mocker.start()
+        self.addCleanup(mocker.stop)
+
+    def mock_flaky(self, path, failures, error=ConnectTimeout, **kwargs):
+        calls = []
+
+        def flaky(request, response):
+            if request.url.path != path:
+                return None
+            calls.append(request)
+            if len(calls) <= failures:
+                response.content = error()
+            else:
+                response.content = kwargs.get("content", {"ApiVersion": "1.40"})
+            return response
+
+        respx.request(flaky)
+        return calls
+
+    def test_backoff_delay(self):
+        for attempt in range(10):
+            delay = backoff_delay(attempt, base=0.1, cap=1.0)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(1.0, 0.1 * 2**attempt))
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(threshold=2, reset_timeout=10)
+        with mock.patch("kapten.retry.time.monotonic", return_value=100):
+            breaker.failure()
+            breaker.check()
+            breaker.failure()
+            self.assertTrue(breaker.is_open)
+            with self.assertRaises(KaptenConnectionError):
+                breaker.check()
+
+        # Half-open after timeout, a failing trial reopens
+        with mock.patch("kapten.retry.time.monotonic", return_value=111):
+            breaker.check()
+            breaker.failure()
+            self.assertTrue(breaker.is_open)
+
+        with mock.patch("kapten.retry.time.monotonic", return_value=122):
+            breaker.success()
+            self.assertFalse(breaker.is_open)
+            self.assertEqual(breaker.failures, 0)
+
+    async def test_retry_idempotent(self):
+        api = DockerAPIClient(retries=2)
+        calls = self.mock_flaky("/version", failures=2)
+        version = await api.version()
+        self.assertEqual(version["ApiVersion"], "1.40")
+        self.assertEqual(len(calls), 3)
+
+    async def test_retry_exhausted(self):
+        api = DockerAPIClient(retries=1)
+        calls = self.mock_flaky("/version", failures=2)
+        with self.assertRaises(KaptenConnectionError):
+            await api.version()
+        self.assertEqual(len(calls), 2)
+
+    async def test_retry_timeouts(self):
+        api = DockerAPIClient(retries=2, breaker=CircuitBreaker(threshold=5))
+        calls = self.mock_flaky("/version", failures=2, error=ReadTimeout)
+        version = await api.version()
+        self.assertEqual(version["ApiVersion"], "1.40")
+        self.assertEqual(len(calls), 3)
+
+        calls = self.mock_flaky("/services/1/update", failures=1, error=ReadTimeout)
+        with self.assertRaises(KaptenConnectionError):
+            await api.service_update("1", 1, {})
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(api.breaker.failures, 1)
+
+    async def test_no_retry_api_errors(self):
+        api = DockerAPIClient(retries=2)
+        calls = self.mock_flaky("/version", failures=1, error=DecodingError)
+        with self.assertRaises(KaptenAPIError):
+            await api.version()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(api.breaker.failures, 0)
+
+    async def test_retry_services(self):
+        api = DockerAPIClient(retries=1)
+        service = self.build_service_response("app", "repo/app:latest@sha256:1")
+        calls = self.mock_flaky("/services", failures=1, content=[service])
+        services = await api.services()
+        self.assertEqual(services[0].name, "app")
+        self.assertEqual(len(calls), 2)
+
+    async def test_no_retry_non_idempotent(self):
+        api = DockerAPIClient(retries=2)
+        calls = self.mock_flaky("/services/1/update", failures=1)
+        with self.assertRaises(KaptenConnectionError):
+            await api.service_update("1", 1, {})
+        self.assertEqual(len(calls), 1)
+
+    async def test_circuit_breaker_fails_fast(self):
+        api = DockerAPIClient(retries=5, breaker=CircuitBreaker(threshold=2))
+        calls = self.mock_flaky("/version", failures=10)
+        with self.assertRaises(KaptenConnectionError):
+            await api.version()
+        self.assertEqual(len(calls), 2)
+
+        with self.assertRaisesRegex(KaptenConnectionError, "failing fast"):
+            await api.version()
+        self.assertEqual(len(calls), 2)
+
+    async def test_error_responses(self):
+        api = DockerAPIClient(retries=0)
+        respx.post(
+            re.compile(r"^http://[^/]+/services/1/update.*$"),
+            status_code=500,
+            content={"message": "rpc error: update out of sequence"},
+        )
+        respx.post(
+            re.compile(r"^http://[^/]+/services/2/update.*$"),
+            status_code=503,
+            content={"message": "no leader"},
+        )
+        with self.assertRaises(KaptenConflictError):
+            await api.service_update("1", 1, {})
+        with self.assertRaisesRegex(KaptenConnectionError, "no leader"):
+            await api.service_update("2", 1, {})
+
+    async def test_update_version_conflict(self):
+        services = [
+            ("stack_app", "repository/app:latest@sha256:10001"),
+            ("stack_db", "repository/db:latest@sha256:20001"),
+        ]
+        conflicts = []
+
+        def conflict_once(request, response):
+            if request.method != "POST" or conflicts:
+                return None
+            conflicts.append(request)
+            response.status_code = 500
+            response.content = {"message": "update out of sequence"}
+            return response
+
+        respx.request(conflict_once)
+        client = Kapten(["stack_app", "stack_db"])
+        with self.mock_docker(services) as httpx_mock:
+            updated = await client.update_services()
+            self.assertEqual(len(updated), 2)
+            self.assertEqual(len(conflicts), 1)
+            self.assertEqual(httpx_mock["service"].call_count, 1)
+            self.assertEqual(httpx_mock["service_update"].call_count, 2)
+
+            # Conflicting service was refetched and updated again
+            updated_names = {
+                json.loads(request.content.decode("utf-8"))["Name"]
+                for request, _ in httpx_mock["service_update"].calls
+            }
+            self.assertSetEqual(updated_names, {"stack_app", "stack_db"})
+        await client.close()
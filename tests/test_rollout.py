@@ -0,0 +1,228 @@
+import asyncio
+import re
+
+import asynctest
+import respx
+from httpx.exceptions import ConnectTimeout
+
+from kapten.docker import DockerAPIClient, Service
+from kapten.exceptions import KaptenAPIError, KaptenError
+from kapten.rollout import ConvergenceWatcher, is_converged, plan_waves, validate_waves
+from kapten.tool import Kapten
+
+from .testcases import KaptenTestCase
+
+
+class RolloutTestCase(KaptenTestCase):
+    def build_service(self, name, image="repo/app:latest@sha256:2", **data):
+        response = self.build_service_response(name, image)
+        response.update(data)
+        return Service(response)
+
+    def build_task(self, state="running", image="repo/app:latest@sha256:2"):
+        return {
+            "Status": {"State": state},
+            "Spec": {"ContainerSpec": {"Image": image}},
+        }
+
+    def test_plan_waves(self):
+        services = [
+            self.build_service(name)
+            for name in ("a_app", "b_app", "a_db", "c_app", "b_db")
+        ]
+        services[0].labels["tier"] = services[2].labels["tier"] = "backend"
+
+        def names(waves):
+            return [[s.name for s in wave] for wave in waves]
+
+        self.assertListEqual(plan_waves([], None), [])
+        self.assertListEqual(
+            names(plan_waves(services, None)),
+            [["a_app", "b_app", "a_db", "c_app", "b_db"]],
+        )
+        self.assertListEqual(
+            names(plan_waves(services, "2")),
+            [["a_app", "b_app"], ["a_db", "c_app"], ["b_db"]],
+        )
+        self.assertListEqual(
+            names(plan_waves(services, "stack")),
+            [["a_app", "a_db"], ["b_app", "b_db"], ["c_app"]],
+        )
+        self.assertListEqual(
+            names(plan_waves(services, "label:tier")),
+            [["a_app", "a_db"], ["b_app", "c_app", "b_db"]],
+        )
+        with self.assertRaises(KaptenError):
+            plan_waves(services, "random")
+
+    def test_validate_waves(self):
+        for waves in (None, "", "2", "stack", "label:tier"):
+            validate_waves(waves)
+        for waves in ("stacks", "label:", "-1"):
+            with self.assertRaisesRegex(ValueError, "Invalid rollout waves"):
+                Kapten(["app"], waves=waves)
+
+    def test_is_converged(self):
+        service = self.build_service("app")
+        running = self.build_task()
+        self.assertTrue(is_converged(service, [running, running]))
+        self.assertFalse(is_converged(service, []))
+        self.assertFalse(is_converged(service, [running, self.build_task("ready")]))
+        self.assertFalse(
+            is_converged(service, [self.build_task(image="repo/app:latest@sha256:1")])
+        )
+
+        updating = self.build_service("app", UpdateStatus={"State": "updating"})
+        self.assertFalse(is_converged(updating, [running]))
+
+        scaled_down = self.build_service("app")
+        scaled_down.spec["Mode"] = {"Replicated": {"Replicas": 0}}
+        self.assertTrue(is_converged(scaled_down, []))
+
+        paused = self.build_service("app", UpdateStatus={"State": "paused"})
+        with self.assertRaises(KaptenError):
+            is_converged(paused, [running])
+
+    async def test_watcher(self):
+        services = [self.build_service(name) for name in ("app", "worker", "db")]
+        app, worker, db = services
+        states = {"app": ["updating", "completed"], "worker": ["paused"], "db": []}
+
+        def build_services_response(request):
+            return [
+                dict(
+                    self.build_service_response(s.name, s.image_with_digest),
+                    UpdateStatus={"State": states[s.name].pop(0)},
+                )
+                for s in services
+                if states[s.name]
+            ]
+
+        def build_tasks_response(request):
+            return [dict(self.build_task(), ServiceID=app.id)]
+
+        services_mock = respx.get(
+            re.compile(r"^http://[^/]+/services\?.*$"),
+            content=build_services_response,
+        )
+        tasks_mock = respx.get(
+            re.compile(r"^http://[^/]+/tasks\?.*$"), content=build_tasks_response
+        )
+
+        docker = DockerAPIClient()
+        watcher = ConvergenceWatcher(docker, poll_interval=0.001)
+        results = await asyncio.gather(
+            *(watcher.wait(service) for service in services), return_exceptions=True
+        )
+
+        # Services and tasks are polled once for all pending services
+        self.assertEqual(services_mock.call_count, 2)
+        self.assertEqual(tasks_mock.call_count, 2)
+        request, _ = tasks_mock.calls[0]
+        self.assertIn(app.id, request.url.query)
+        self.assertIn(db.id, request.url.query)
+
+        self.assertIs(results[0], app)
+        self.assertGreater(app.converged_after, app.first_running_after)
+        self.assertIn("paused", str(results[1]))
+        self.assertIsNone(worker.converged_after)
+        self.assertIn("removed", str(results[2]))
+        self.assertDictEqual(watcher.pending, {})
+        await docker.close()
+
+    async def test_watcher_timeout(self):
+        service = self.build_service("app")
+        respx.get(re.compile(r"^http://[^/]+/services\?.*$"), content=ConnectTimeout())
+
+        docker = DockerAPIClient(retries=0)
+        watcher = ConvergenceWatcher(docker, timeout=0.05, poll_interval=0.001)
+        with self.assertRaises(KaptenError) as cm:
+            await watcher.wait(service)
+
+        self.assertIn("Timed out", str(cm.exception))
+        self.logger_mock.warning.assert_called_with(
+            "Failed polling service convergence: %s", asynctest.ANY
+        )
+        self.assertDictEqual(watcher.pending, {})
+        await watcher.task
+        await docker.close()
+
+    async def test_watcher_failed(self):
+        service = self.build_service("app")
+        docker = DockerAPIClient()
+        watcher = ConvergenceWatcher(docker, poll_interval=0.001)
+
+        with asynctest.patch.object(docker, "services", side_effect=KeyError("ID")):
+            with self.assertRaisesRegex(KaptenError, "Stopped watching"):
+                await watcher.wait(service)
+
+        self.logger_mock.exception.assert_called_with(
+            "Failed watching service convergence"
+        )
+        self.assertDictEqual(watcher.pending, {})
+        await docker.close()
+
+    async def test_watcher_superseded(self):
+        service = self.build_service("app")
+        docker = DockerAPIClient()
+        watcher = ConvergenceWatcher(docker, poll_interval=10)
+
+        first = asyncio.ensure_future(watcher.wait(service))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(watcher.wait(service))
+        await asyncio.sleep(0)
+        with self.assertRaises(KaptenError):
+            await first
+
+        watcher.close()
+        second.cancel()
+        await docker.close()
+
+    async def test_update_in_waves(self):
+        services = [
+            ("a_app", "repo/app:latest@sha256:10001"),
+            ("b_app", "repo/app:latest@sha256:10001"),
+            ("c_app", "repo/app:latest@sha256:10001"),
+        ]
+        client = Kapten([name for name, _ in services], waves="stack")
+
+        async def converge(service):
+            service.first_running_after, service.converged_after = 0.5, 1.5
+            return service
+
+        wait = asynctest.CoroutineMock(side_effect=converge)
+        with self.mock_docker(services) as httpx_mock:
+            with asynctest.patch.object(client.convergence, "wait", wait):
+                updated = await client.update_services()
+
+        self.assertListEqual([s.name for s in updated], ["a_app", "b_app", "c_app"])
+        self.assertEqual(wait.call_count, 3)
+        self.assertEqual(httpx_mock["service_update"].call_count, 3)
+        self.logger_mock.info.assert_any_call("Rolling out wave %s/%s", 3, 3)
+        self.logger_mock.info.assert_any_call(
+            "Service %s running after %.1fs, converged after %.1fs", "c_app", 0.5, 1.5
+        )
+        await client.close()
+
+    async def test_update_in_waves_halted(self):
+        services = [
+            ("a_app", "repo/app:latest@sha256:10001"),
+            ("a_db", "repo/db:latest@sha256:20001"),
+            ("b_app", "repo/app:latest@sha256:10001"),
+        ]
+        client = Kapten([name for name, _ in services], waves="stack")
+        wait = asynctest.CoroutineMock(
+            side_effect=[None, KaptenError("Rollout of a_db failed: paused")]
+        )
+
+        with self.mock_docker(services) as httpx_mock:
+            with asynctest.patch.object(client.convergence, "wait", wait):
+                with self.assertRaises(KaptenAPIError) as cm:
+                    await client.update_services()
+
+        self.assertIn("a_db", str(cm.exception))
+        self.assertEqual(httpx_mock["service_update"].call_count, 2)
+        self.logger_mock.warning.assert_called_with(
+            "Halting rollout, skipping %s", "b_app"
+        )
+        await client.close()
@@ -0,0 +1,141 @@
+import asyncio
+
+import asynctest
+
+from kapten.exceptions import KaptenError
+from kapten.scheduler import Scheduler
+from kapten.tool import Kapten
+
+from .testcases import KaptenTestCase
+
+
+class SchedulerTestCase(KaptenTestCase):
+    services = [
+        ("stack_app", "repo/app:latest@sha256:10001"),
+        ("stack_worker", "repo/app:latest@sha256:10001"),
+        ("stack_db", "repo/db:latest@sha256:20001"),
+    ]
+
+    def build_scheduler(self, **kwargs):
+        client = Kapten([name for name, _ in self.services])
+        self.addCleanup(client.close)
+        return Scheduler(client, **kwargs)
+
+    def test_schedule(self):
+        scheduler = self.build_scheduler(interval=10)
+
+        scheduler.schedule({"repo/b", "repo/a"}, now=100)
+        self.assertDictEqual(scheduler.due, {"repo/a": 100, "repo/b": 105})
+
+        scheduler.schedule({"repo/b", "repo/c"}, now=200)
+        self.assertDictEqual(scheduler.due, {"repo/b": 105, "repo/c": 200})
+
+    def test_next_interval(self):
+        scheduler = self.build_scheduler(interval=10, jitter=0.1)
+        for _ in range(10):
+            self.assertTrue(9 <= scheduler.next_interval("repo/app") <= 11)
+
+    def test_learn(self):
+        scheduler = self.build_scheduler(
+            interval=60, min_interval=10, max_interval=3600
+        )
+
+        # First lookup has nothing to compare with
+        scheduler.learn("repo/app", {"repo/app:latest": "sha256:1"})
+        self.assertDictEqual(scheduler.intervals, {})
+
+        # Stretched while unchanged, up to max interval
+        for interval in (90, 135, 202.5):
+            scheduler.learn("repo/app", {"repo/app:latest": "sha256:1"})
+            self.assertEqual(scheduler.intervals["repo/app"], interval)
+        for _ in range(20):
+            scheduler.learn("repo/app", {"repo/app:latest": "sha256:1"})
+        self.assertEqual(scheduler.intervals["repo/app"], 3600)
+
+        # Halved on change, down to min interval
+        scheduler.learn("repo/app", {"repo/app:latest": "sha256:2"})
+        self.assertEqual(scheduler.intervals["repo/app"], 1800)
+        for i in range(3, 20):
+            scheduler.learn("repo/app", {"repo/app:latest": f"sha256:{i}"})
+        self.assertEqual(scheduler.intervals["repo/app"], 10)
+
+        # Forgotten when no longer tracked
+        scheduler.schedule({"repo/app"}, now=0)
+        scheduler.schedule({"repo/db"}, now=0)
+        self.assertDictEqual(scheduler.intervals, {})
+        self.assertNotIn("repo/app", scheduler.digests)
+
+    def test_fixed_interval(self):
+        scheduler = self.build_scheduler(interval=60)
+        for i in range(3):
+            scheduler.learn("repo/app", {"repo/app:latest": f"sha256:{i}"})
+        self.assertEqual(scheduler.intervals["repo/app"], 60)
+
+    async def test_check(self):
+        scheduler = self.build_scheduler()
+
+        with self.mock_docker(self.services) as httpx_mock:
+            updated = await scheduler.check("repo/app")
+            self.assertListEqual(
+                sorted(s.name for s in updated), ["stack_app", "stack_worker"]
+            )
+            self.assertEqual(httpx_mock["service_update"].call_count, 2)
+
+            # Every check looks the digest up again
+            await scheduler.check("repo/app")
+            self.assertEqual(httpx_mock["distribution"].call_count, 2)
+
+    async def test_check_unchanged(self):
+        scheduler = self.build_scheduler()
+
+        with self.mock_docker(self.services, with_new_distribution=False) as m:
+            self.assertListEqual(await scheduler.check("repo/db"), [])
+            self.assertEqual(m["distribution"].call_count, 1)
+            self.assertFalse(m["service_update"].called)
+
+    async def test_tick(self):
+        scheduler = self.build_scheduler(interval=10, jitter=0)
+
+        with self.mock_docker(self.services) as httpx_mock:
+            delay = await scheduler.tick()
+            self.assertSetEqual(set(scheduler.checks), {"repo/app"})
+            self.assertAlmostEqual(delay, 5, places=1)
+            due = scheduler.due["repo/app"]
+            await asyncio.gather(*scheduler.checks.values())
+            self.assertDictEqual(scheduler.checks, {})
+
+            # Rescheduled once checked
+            self.assertGreater(scheduler.due["repo/app"], due)
+
+            # Nothing due until the spread out check of repo/db
+            await scheduler.tick()
+            self.assertDictEqual(scheduler.checks, {})
+            self.assertEqual(httpx_mock["distribution"].call_count, 1)
+
+    async def test_run_check_failure(self):
+        scheduler = self.build_scheduler()
+
+        with self.mock_docker(self.services, with_missing_distribution=True):
+            await scheduler.run_check("repo/app")
+
+        self.logger_mock.error.assert_called_with(
+            "Failed checking %s: %s", "repo/app", asynctest.ANY
+        )
+
+    async def test_run(self):
+        scheduler = self.build_scheduler(interval=0.001)
+        watch = asynctest.CoroutineMock()
+        tick = asynctest.CoroutineMock(
+            side_effect=[KaptenError("Boom"), 0, asyncio.CancelledError()]
+        )
+
+        with asynctest.patch.object(scheduler.client, "watch", watch):
+            with asynctest.patch.object(scheduler, "tick", tick):
+                with self.assertRaises(asyncio.CancelledError):
+                    await scheduler.run()
+
+        self.assertEqual(tick.call_count, 3)
+        self.assertTrue(watch.called)
+        self.logger_mock.error.assert_called_with(
+            "Failed listing services: %s", asynctest.ANY
+        )
@@ -0,0 +1,85 @@
+from kapten.docker import Service
+from kapten.selectors import Selector, ServiceSelector
+
+from .testcases import KaptenTestCase
+
+
+class SelectorTestCase(KaptenTestCase):
+    def build_service(self, name, image="repo/app:latest@sha256:1", labels=None):
+        response = self.build_service_response(name, image)
+        response["Spec"]["Labels"] = labels or {}
+        return Service(response)
+
+    def test_parse(self):
+        for value, kind in (
+            ("stack_app", "name"),
+            ("stack_*", "glob"),
+            ("stack_[ab]pp", "glob"),
+            ("/^stack_(app|db)$/", "regex"),
+            ("label=kapten.enable", "label"),
+            ("label=kapten.enable=true", "label"),
+            ("image=repo/app:*", "image"),
+        ):
+            self.assertEqual(Selector(value).kind, kind, value)
+
+        selector = Selector("label=kapten.enable=true")
+        self.assertEqual(selector.label, "kapten.enable")
+        self.assertEqual(selector.label_value, "true")
+        self.assertIsNone(Selector("label=kapten.enable").label_value)
+
+        with self.assertRaisesRegex(ValueError, "Invalid service pattern"):
+            Selector("/[/")
+
+    def test_matches(self):
+        app = self.build_service("stack_app", labels={"kapten.enable": "true"})
+        db = self.build_service("stack_db", "repo/db:latest@sha256:2")
+
+        for value, matched in (
+            ("stack_app", ["stack_app"]),
+            ("stack", []),
+            ("stack_*", ["stack_app", "stack_db"]),
+            ("/_db$/", ["stack_db"]),
+            ("label=kapten.enable", ["stack_app"]),
+            ("label=kapten.enable=false", []),
+            ("image=repo/db:*", ["stack_db"]),
+        ):
+            selector = Selector(value)
+            self.assertListEqual(
+                [s.name for s in (app, db) if selector.matches(s)], matched, value
+            )
+
+    def test_filters(self):
+        self.assertDictEqual(
+            ServiceSelector(["stack_app", "web_*"]).filters(),
+            {"name": ["stack_app", "web_"]},
+        )
+        self.assertDictEqual(
+            ServiceSelector(["label=kapten.enable=true"]).filters(),
+            {"label": ["kapten.enable=true"]},
+        )
+        for selectors in (
+            ["*_app"],
+            ["stack_app", "/app/"],
+            ["label=a", "label=b"],
+            ["image=repo/*"],
+        ):
+            self.assertDictEqual(ServiceSelector(selectors).filters(), {}, selectors)
+
+    def test_service_selector(self):
+        selector = ServiceSelector(["stack_db", "web_*", "label=kapten.enable", "gone"])
+        app = self.build_service("stack_app", labels={"kapten.enable": "1"})
+        db = self.build_service("stack_db")
+        web = self.build_service("web_app")
+        other = self.build_service("other")
+
+        self.assertListEqual(
+            sorted([other, web, app, db], key=selector.sort_key), [db, web, app, other]
+        )
+        self.assertFalse(selector.matches(other))
+        self.assertListEqual(selector.missing([app, db, web]), ["gone"])
+
+        # Labels are unknown from events, any name may match
+        self.assertTrue(selector.may_match("other"))
+        by_name = ServiceSelector(["stack_db", "web_*"])
+        self.assertTrue(by_name.may_match("web_app"))
+        self.assertFalse(by_name.may_match("other"))
@@ -1,14 +1,23 @@
+import asyncio
 import contextlib
 import hashlib
 import hmac
 import json
+import os
+import re
+import tempfile
 import uuid
 from unittest import mock
 
+import asynctest
 import respx
 from starlette.testclient import TestClient
 
 from kapten import __version__, server
+from kapten.concurrency import FileLocks
+from kapten.docker import Service
+from kapten.jobs import JobStore
+from kapten.metrics import PHASE_DURATION, PHASE_ERRORS
 from kapten.tool import Kapten
 
 from .testcases import KaptenTestCase
@@ -23,12 +32,30 @@ class ServerTestCase(KaptenTestCase):
     def mock_server(self, services=None, **kwargs):
         services = services or [("app", "5monkeys/app:latest@sha256:10001")]
         with self.mock_docker(services=services, **kwargs):
+            respx.post(
+                re.compile(r"^https://api.github.com/repos/.+/statuses$"),
+                content={},
+                alias="github_status",
+            )
             with mock.patch.dict("sys.modules", uvicorn=mock.MagicMock()):
                 client = Kapten([name for name, _ in services])
                 server.run(client, self.token)
                 with TestClient(server.app) as test_client:
                     yield test_client
 
+    def wait_for_job(self, http, response):
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()["id"]
+        self.assertEqual(response.json()["status"], "queued")
+
+        # Let background workers run the job
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(server.app.state.jobs.join())
+
+        response = http.get(f"/jobs/{job_id}")
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
     @contextlib.contextmanager
     def mock_dockerhub(
         self,
@@ -122,6 +149,29 @@ class ServerTestCase(KaptenTestCase):
             self.assertEqual(response.status_code, 200)
             self.assertDictEqual(response.json(), {"kapten": __version__})
 
+    def test_metrics_endpoint(self):
+        parsed = PHASE_DURATION.count(phase="webhook_parse")
+        updates = PHASE_DURATION.count(phase="service_update")
+        failed = PHASE_ERRORS.get(phase="webhook_parse", type="ValueError")
+
+        with self.mock_server() as http:
+            with self.mock_dockerhub() as payload:
+                response = http.post("/webhook/dockerhub/MY-TOKEN", json=payload)
+                self.wait_for_job(http, response)
+            http.post("/webhook/dockerhub/MY-TOKEN", json={"foo": "bar"})
+
+            response = http.get("/metrics")
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("text/plain", response.headers["content-type"])
+            self.assertIn('kapten_phase_in_flight{phase="callback"} 0', response.text)
+            self.assertIn("kapten_jobs_queued 0", response.text)
+
+        self.assertEqual(PHASE_DURATION.count(phase="webhook_parse"), parsed + 2)
+        self.assertEqual(PHASE_DURATION.count(phase="service_update"), updates + 1)
+        self.assertEqual(
+            PHASE_ERRORS.get(phase="webhook_parse", type="ValueError"), failed + 1
+        )
+
     def test_dockerhub_endpoint(self):
         services = [
             ("stack_migrate", "5monkeys/app:latest@sha256:10001"),
@@ -132,9 +182,10 @@ class ServerTestCase(KaptenTestCase):
         with self.mock_server(services) as http:
             with self.mock_dockerhub() as payload:
                 response = http.post("/webhook/dockerhub/MY-TOKEN", json=payload)
-                self.assertEqual(response.status_code, 200)
+                job = self.wait_for_job(http, response)
+                self.assertEqual(job["status"], "succeeded")
                 self.assertListEqual(
-                    response.json(),
+                    job["services"],
                     [
                         {
                             "service": "stack_migrate",
@@ -147,6 +198,51 @@ class ServerTestCase(KaptenTestCase):
                     ],
                 )
 
+    def test_dockerhub_endpoint_with_locks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with self.mock_server() as http:
+                server.app.state.locks = FileLocks(directory)
+                with self.mock_dockerhub() as payload:
+                    response = http.post("/webhook/dockerhub/MY-TOKEN", json=payload)
+                    job = self.wait_for_job(http, response)
+                    self.assertEqual(job["status"], "succeeded")
+                    self.assertEqual(len(job["services"]), 1)
+
+            self.assertListEqual(
+                os.listdir(directory),
+                [os.path.basename(FileLocks(directory).path("5monkeys/app:latest"))],
+            )
+
+    def test_serialize_service(self):
+        service = Service(self.build_service_response("app", "repo/app:1@sha256:2"))
+        self.assertDictEqual(
+            server.serialize_service(service),
+            {"service": "app", "image": "repo/app:1@sha256:2"},
+        )
+
+        service.first_running_after = 1.23456
+        service.converged_after = 4.56789
+        self.assertDictEqual(
+            server.serialize_service(service),
+            {
+                "service": "app",
+                "image": "repo/app:1@sha256:2",
+                "first_running_after": 1.235,
+                "converged_after": 4.568,
+            },
+        )
+
+    def test_dockerhub_endpoint_invalidates_digest_cache(self):
+        with self.mock_server(with_new_distribution=False) as http:
+            with self.mock_dockerhub() as payload:
+                server.app.state.client.digests.set(
+                    "5monkeys/app:latest", "sha256:10002"
+                )
+                response = http.post("/webhook/dockerhub/MY-TOKEN", json=payload)
+                job = self.wait_for_job(http, response)
+                self.assertListEqual(job["services"], [])
+                self.assertTrue(respx.aliases["distribution"].called)
+
     def test_dockerhub_endpoint_with_bad_token(self):
         with self.mock_server() as http:
             response = http.post("/webhook/dockerhub/INVALID", json={})
@@ -176,24 +272,62 @@ class ServerTestCase(KaptenTestCase):
                 response = http.post("/webhook/dockerhub/MY-TOKEN", json=payload)
                 self.assertEqual(response.status_code, 404)
 
+    def test_dockerhub_endpoint_with_live_repositories(self):
+        with self.mock_server() as http:
+            client = server.app.state.client
+            self.assertSetEqual(set(server.app.state.repositories), {"5monkeys/app"})
+
+            # Repository of a service deployed after startup
+            live = frozenset({"5monkeys/app", "5monkeys/new"})
+            with mock.patch.object(client, "tracked_repositories", return_value=live):
+                with self.mock_dockerhub(
+                    repository_url="https://registry.hub.docker.com/u/5monkeys/new/"
+                ) as payload:
+                    response = http.post("/webhook/dockerhub/MY-TOKEN", json=payload)
+                    self.assertEqual(response.status_code, 202)
+                    self.wait_for_job(http, response)
+
+            # Last known repositories are kept while the inventory is out of sync
+            with mock.patch.object(client, "tracked_repositories", return_value=None):
+                self.assertSetEqual(server.tracked_repositories(), live)
+
     def test_dockerhub_endpoint_with_failing_callback(self):
         with self.mock_server() as http:
             with self.mock_dockerhub(callback_failure=True) as payload:
                 response = http.post("/webhook/dockerhub/MY-TOKEN", json=payload)
                 self.assertEqual(response.status_code, 400)
 
+                # Left for Docker Hub to deliver again
+                job_store = server.app.state.job_store
+                self.assertTrue(job_store.claim(payload["callback_url"]))
+
+    def test_dockerhub_endpoint_with_raising_callback(self):
+        callback = asynctest.CoroutineMock(side_effect=[OSError("DNS"), True])
+        with self.mock_server() as http:
+            with self.mock_dockerhub() as payload:
+                with mock.patch("kapten.dockerhub.callback", callback):
+                    with self.assertRaises(OSError):
+                        http.post("/webhook/dockerhub/MY-TOKEN", json=payload)
+
+                    # Redelivery is accepted as new
+                    response = http.post("/webhook/dockerhub/MY-TOKEN", json=payload)
+                    job = self.wait_for_job(http, response)
+                    self.assertEqual(job["status"], "succeeded")
+
     def test_dockerhub_endpoint_with_non_matching_services(self):
         with self.mock_server(with_new_distribution=False) as http:
             with self.mock_dockerhub(tag="dev") as payload:
                 response = http.post("/webhook/dockerhub/MY-TOKEN", json=payload)
-                self.assertEqual(response.status_code, 200)
-                self.assertListEqual(response.json(), [])
+                job = self.wait_for_job(http, response)
+                self.assertListEqual(job["services"], [])
 
     def test_dockerhub_endpoint_with_client_error(self):
         with self.mock_server(with_api_error=True) as http:
             with self.mock_dockerhub() as payload:
                 response = http.post("/webhook/dockerhub/MY-TOKEN", json=payload)
-                self.assertEqual(response.status_code, 503)
+                job = self.wait_for_job(http, response)
+                self.assertEqual(job["status"], "failed")
+                self.assertIn("Failed updating services", job["error"])
 
     def test_github_endpoint(self):
         services = [
@@ -211,9 +345,10 @@ class ServerTestCase(KaptenTestCase):
                 json=payload,
                 headers={"X-Hub-Signature": signature, "X-GitHub-Event": "Deployment"},
             )
-            self.assertEqual(response.status_code, 200)
+            job = self.wait_for_job(http, response)
+            self.assertEqual(job["status"], "succeeded")
             self.assertListEqual(
-                response.json(),
+                job["services"],
                 [
                     {
                         "service": "stack_migrate",
@@ -225,6 +360,133 @@ class ServerTestCase(KaptenTestCase):
                     },
                 ],
             )
+            self.assertEqual(respx.aliases["github_status"].call_count, 2)
+            status = self.get_request_body("github_status", 1)
+            self.assertEqual(status["state"], "in_progress")
+            self.assertEqual(status["environment"], "development")
+            status = self.get_request_body("github_status", 2)
+            self.assertEqual(status["state"], "success")
+            self.assertEqual(status["description"], "Updated 2 service(s)")
+
+    def test_github_endpoint_with_redelivery(self):
+        with self.mock_server() as http:
+            payload, signature = self.build_github_payload()
+            headers = {
+                "X-Hub-Signature": signature,
+                "X-GitHub-Event": "Deployment",
+                "X-GitHub-Delivery": str(uuid.uuid4()),
+            }
+            response = http.post("/webhook/github", json=payload, headers=headers)
+            job = self.wait_for_job(http, response)
+            services_calls = respx.aliases["services"].call_count
+
+            # Answered with the original job, without updating again
+            response = http.post("/webhook/github", json=payload, headers=headers)
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.json()["id"], job["id"])
+            self.assertEqual(response.json()["status"], "succeeded")
+            self.assertEqual(len(server.app.state.jobs.jobs), 1)
+            self.assertEqual(respx.aliases["services"].call_count, services_calls)
+            self.assertEqual(respx.aliases["service_update"].call_count, 1)
+
+            # Another delivery of the same deployment is updated again
+            headers["X-GitHub-Delivery"] = str(uuid.uuid4())
+            response = http.post("/webhook/github", json=payload, headers=headers)
+            self.assertNotEqual(self.wait_for_job(http, response)["id"], job["id"])
+
+    def test_dockerhub_endpoint_with_redelivery(self):
+        with self.mock_server() as http:
+            with self.mock_dockerhub() as payload:
+                response = http.post("/webhook/dockerhub/MY-TOKEN", json=payload)
+                job = self.wait_for_job(http, response)
+
+                response = http.post("/webhook/dockerhub/MY-TOKEN", json=payload)
+                self.assertEqual(response.status_code, 202)
+                self.assertEqual(response.json()["id"], job["id"])
+                self.assertEqual(respx.aliases["dockerhub"].call_count, 1)
+                self.assertEqual(respx.aliases["distribution"].call_count, 1)
+
+    def test_jobs_of_other_workers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "jobs.db")
+            other = JobStore(path)
+            self.addCleanup(other.close)
+
+            with self.mock_server() as http:
+                server.app.state.job_store = JobStore(path)
+                with self.mock_dockerhub() as payload:
+                    # Accepted and finished by another worker process
+                    other.save("1", {"id": "1", "status": "succeeded"})
+                    other.deliver(payload["callback_url"], "1")
+
+                    response = http.get("/jobs/1")
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(response.json()["status"], "succeeded")
+
+                    response = http.post("/webhook/dockerhub/MY-TOKEN", json=payload)
+                    self.assertEqual(response.status_code, 202)
+                    self.assertEqual(response.json()["id"], "1")
+                    self.assertEqual(respx.aliases["dockerhub"].call_count, 0)
+
+                # Jobs of this worker are visible to the other
+                payload, signature = self.build_github_payload()
+                headers = {"X-Hub-Signature": signature, "X-GitHub-Event": "Deployment"}
+                response = http.post("/webhook/github", json=payload, headers=headers)
+                job = self.wait_for_job(http, response)
+
+            # Once written, at the latest on shutdown
+            self.assertEqual(other.load(job["id"])["status"], "succeeded")
+
+    def test_dockerhub_endpoint_with_concurrent_redelivery(self):
+        with self.mock_server() as http:
+            with self.mock_dockerhub() as payload:
+                # Claimed before calling back, as by a request still in flight
+                server.app.state.job_store.claim(payload["callback_url"])
+                response = http.post("/webhook/dockerhub/MY-TOKEN", json=payload)
+                self.assertEqual(response.status_code, 202)
+                self.assertEqual(respx.aliases["dockerhub"].call_count, 0)
+                self.assertEqual(len(server.app.state.jobs.jobs), 0)
+
+    def test_job_endpoint_not_found(self):
+        with self.mock_server() as http:
+            response = http.get("/jobs/unknown")
+            self.assertEqual(response.status_code, 404)
+
+    def test_webhooks_with_full_queue(self):
+        with self.mock_server() as http:
+            submit = mock.Mock(side_effect=asyncio.QueueFull())
+            with mock.patch.object(server.app.state.jobs, "submit", submit):
+                with self.mock_dockerhub() as payload:
+                    response = http.post("/webhook/dockerhub/MY-TOKEN", json=payload)
+                    self.assertEqual(response.status_code, 429)
+                    job_store = server.app.state.job_store
+                    self.assertTrue(job_store.claim(payload["callback_url"]))
+
+                payload, signature = self.build_github_payload()
+                response = http.post(
+                    "/webhook/github",
+                    json=payload,
+                    headers={
+                        "X-Hub-Signature": signature,
+                        "X-GitHub-Event": "Deployment",
+                    },
+                )
+                self.assertEqual(response.status_code, 429)
+
+    def test_github_endpoint_primes_digest_cache(self):
+        with self.mock_server() as http:
+            payload, signature = self.build_github_payload(
+                image="5monkeys/app", tag="latest", digest="5monkeys/app@sha256:10003"
+            )
+            response = http.post(
+                "/webhook/github",
+                json=payload,
+                headers={"X-Hub-Signature": signature, "X-GitHub-Event": "Deployment"},
+            )
+            self.wait_for_job(http, response)
+            self.assertFalse(respx.aliases["distribution"].called)
+            digests = server.app.state.client.digests
+            self.assertEqual(digests.get("5monkeys/app:latest"), "sha256:10003")
 
     def test_github_ping_webhook(self):
         with self.mock_server() as http:
@@ -418,8 +680,8 @@ class ServerTestCase(KaptenTestCase):
                 json=payload,
                 headers={"X-Hub-Signature": signature, "X-GitHub-Event": "Deployment"},
             )
-            self.assertEqual(response.status_code, 200)
-            self.assertListEqual(response.json(), [])
+            job = self.wait_for_job(http, response)
+            self.assertListEqual(job["services"], [])
 
     def test_github_webhook_with_client_error(self):
         with self.mock_server(with_api_error=True) as http:
@@ -429,4 +691,8 @@ class ServerTestCase(KaptenTestCase):
                 json=payload,
                 headers={"X-Hub-Signature": signature, "X-GitHub-Event": "Deployment"},
             )
-            self.assertEqual(response.status_code, 503)
+            job = self.wait_for_job(http, response)
+            self.assertEqual(job["status"], "failed")
+            self.assertEqual(
+                self.get_request_body("github_status", 2)["state"], "failure"
+            )
@@ -47,3 +47,19 @@ class SlackTestCase(KaptenTestCase):
             self.assertTrue(success)
             body = self.get_request_body("slack")
             self.assertNotIn("attachments", body)
+
+    async def test_notify_durations(self):
+        services = [
+            Service(self.build_service_response(name, "repo/foo:tag@sha256:1"))
+            for name in ("foo_web", "foo_worker")
+        ]
+        services[0].first_running_after = 2.04
+        services[0].converged_after = 10.46
+        with self.mock_slack(token="token"):
+            await slack.notify("token", services)
+            fields = self.get_request_body("slack")["attachments"][0]["fields"]
+            self.assertEqual(fields[-1]["title"], "Durations")
+            self.assertEqual(
+                fields[-1]["value"],
+                "• web: running after 2.0s, converged after 10.5s",
+            )
@@ -0,0 +1,72 @@
+import os
+import tempfile
+
+from kapten.state import StateStore
+from kapten.tool import Kapten
+
+from .testcases import KaptenTestCase
+
+
+class StateStoreTestCase(KaptenTestCase):
+    services = [
+        ("stack_app", "repo/app:latest@sha256:10001"),
+        ("stack_db", "repo/db:latest@sha256:20001"),
+    ]
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "kapten.db")
+
+    async def test_batched_writes(self):
+        store = StateStore(self.path, flush_interval=60)
+        store.record_digest("repo/app:latest", "sha256:1")
+        store.record_digest("repo/app:latest", "sha256:2")
+        store.record_digest("repo/db:latest", "sha256:3")
+        self.assertEqual(len(store), 2)
+
+        # Nothing written until flushed
+        self.assertDictEqual(StateStore(self.path).digests(), {})
+        await store.close()
+        self.assertEqual(len(store), 0)
+
+        digests = StateStore(self.path).digests()
+        self.assertListEqual(
+            sorted((image, digest) for image, (digest, _) in digests.items()),
+            [("repo/app:latest", "sha256:2"), ("repo/db:latest", "sha256:3")],
+        )
+
+    async def test_warm_cache(self):
+        store = StateStore(self.path)
+        store.record_digest("repo/app:latest", "sha256:10001")
+        await store.close()
+        with store.connection:
+            store.connection.execute(
+                "INSERT INTO digests VALUES (?, ?, ?)",
+                ("repo/db:latest", "sha256:1", 0),
+            )
+
+        # Only digests younger than the cache ttl are used
+        client = Kapten(["stack_app", "stack_db"], state=StateStore(self.path))
+        self.assertEqual(client.digests.get("repo/app:latest"), "sha256:10001")
+        self.assertIsNone(client.digests.get("repo/db:latest"))
+
+        with self.mock_docker(self.services) as httpx_mock:
+            await client.get_latest_digests(["repo/app:latest", "repo/db:latest"])
+            self.assertEqual(httpx_mock["distribution"].call_count, 1)
+        await client.close()
+
+        # Resolved digests are stored on close
+        digests = StateStore(self.path, flush_interval=0).digests()
+        self.assertEqual(digests["repo/db:latest"][0], "sha256:20002")
+
+    async def test_record_delivered_digest(self):
+        store = StateStore(self.path, flush_interval=0)
+        client = Kapten(["stack_app", "stack_db"], state=store)
+
+        with self.mock_docker(self.services):
+            await client.update_services("repo/app:latest@sha256:10002")
+        await client.close()
+
+        self.assertEqual(store.digests()["repo/app:latest"][0], "sha256:10002")
@@ -0,0 +1,116 @@
+import json
+import os
+import tempfile
+
+import respx
+
+from kapten import dockerhub, github, slack, tracing
+from kapten.docker import DockerAPIClient
+from kapten.exceptions import KaptenAPIError
+
+from .testcases import KaptenTestCase
+
+
+class TracingTestCase(KaptenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.spans = []
+        tracing.add_hook(self.spans.append)
+        self.addCleanup(tracing.remove_hook, self.spans.append)
+
+    def test_span(self):
+        with tracing.span("test", "GET", "/things/{id}") as span:
+            span.status = 200
+
+        with self.assertRaises(KeyError):
+            with tracing.span("test", "GET", "/things/{id}"):
+                raise KeyError("boom")
+
+        self.assertListEqual([s.status for s in self.spans], [200, None])
+        self.assertListEqual([s.error for s in self.spans], [None, "KeyError"])
+        self.assertTrue(all(s.duration >= 0 for s in self.spans))
+
+    async def test_docker_spans(self):
+        services = [("stack_app", "repo/app:latest@sha256:10001")]
+        client = DockerAPIClient()
+        self.addCleanup(client.close)
+
+        with self.mock_docker(services, with_api_error=True):
+            service = await client.service("stack_app")
+            await client.services()
+            with self.assertRaises(KaptenAPIError):
+                await client.service_update(service.id, service.version, service.spec)
+
+        self.assertListEqual(
+            [(s.name, s.method, s.url, s.status) for s in self.spans],
+            [
+                ("docker", "GET", "/services/{id}", 200),
+                ("docker", "GET", "/services", 200),
+                ("docker", "POST", "/services/{id}/update", 503),
+            ],
+        )
+        self.assertGreater(self.spans[1].bytes, 0)
+        self.assertEqual(self.spans[2].error, "KaptenConnectionError")
+
+    async def test_webhook_spans(self):
+        with self.mock_slack(token="secret"):
+            await slack.post("secret", "Hello")
+
+        callback_url = "https://registry.hub.docker.com/u/5monkeys/app/hook/secret/"
+        respx.post(callback_url, status_code=200)
+        await dockerhub.callback(callback_url, "Valid webhook received")
+
+        statuses_url = (
+            "https://api.github.com/repos/5monkeys/app/deployments/1/statuses"
+        )
+        respx.post(statuses_url, status_code=201)
+        await github.callback(statuses_url, "success", "production", "Deployed")
+
+        self.assertListEqual(
+            [(s.name, s.url, s.status) for s in self.spans],
+            [
+                ("slack.post", "https://hooks.slack.com/services/{token}", 200),
+                (
+                    "dockerhub.callback",
+                    "https://registry.hub.docker.com/u/5monkeys/app/hook/{id}/",
+                    200,
+                ),
+                (
+                    "github.callback",
+                    "https://api.github.com/repos/{owner}/{repo}/deployments/{id}"
+                    "/statuses",
+                    201,
+                ),
+            ],
+        )
+
+    def test_span_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "spans.jsonl")
+            span_file = tracing.SpanFile(path)
+            tracing.add_hook(span_file)
+            try:
+                for status in (200, 404):
+                    with tracing.span("docker", "GET", "/version") as span:
+                        span.status = status
+            finally:
+                tracing.remove_hook(span_file)
+                span_file.close()
+
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+
+        self.assertListEqual([line["status"] for line in lines], [200, 404])
+        self.assertSetEqual(
+            set(lines[0]),
+            {
+                "name",
+                "method",
+                "url",
+                "status",
+                "bytes",
+                "error",
+                "started",
+                "duration",
+            },
+        )
@@ -2,6 +2,7 @@ import contextlib
 import json
 import os
 import re
+import zlib
 from functools import partial
 from io import StringIO
 from itertools import chain, repeat
@@ -18,7 +19,20 @@ class KaptenTestCase(asynctest.TestCase):
     def setUp(self):
         # Mock logger
         self.logger_mock = mock.MagicMock()
-        modules = ["cli", "tool", "slack", "server"]
+        modules = [
+            "cli",
+            "tool",
+            "slack",
+            "server",
+            "registry",
+            "inventory",
+            "scheduler",
+            "rollout",
+            "jobs",
+            "fleet",
+            "state",
+            "tracing",
+        ]
         for module in modules:
             mocker = mock.patch(f"kapten.{module}.logger", self.logger_mock)
             mocker.start()
@@ -39,7 +53,7 @@ class KaptenTestCase(asynctest.TestCase):
         stack = service_name.rpartition("_")[0]
         labels = {"com.docker.stack.namespace": stack} if stack else {}
         return {
-            "ID": str(randint(5555555555, 9999999999)),
+            "ID": self.build_service_id(service_name),
             "Version": {"Index": randint(11111, 99999)},
             "Spec": {
                 "Name": service_name,
@@ -55,6 +69,14 @@ class KaptenTestCase(asynctest.TestCase):
             for service_name, image_with_digest in reversed(services)
         ]
 
+    def build_service_id(self, service_name):
+        return str(5555555555 + zlib.crc32(service_name.encode("utf-8")))
+
+    def build_inspect_response(self, request, service_id, services=None):
+        for service_name, image_with_digest in services or []:
+            if service_id in (service_name, self.build_service_id(service_name)):
+                return self.build_service_response(service_name, image_with_digest)
+
     def build_distribution_response(
         self, request, services=None, with_new_digest=True, image=None
     ):
@@ -85,6 +107,7 @@ class KaptenTestCase(asynctest.TestCase):
         with_api_error=False,
         with_api_exception=False,
         with_auth_header=True,
+        events=None,
     ):
         env = (
             {"DOCKER_USERNAME": "foo", "DOCKER_PASSWORD": "bar"}
@@ -104,7 +127,7 @@ class KaptenTestCase(asynctest.TestCase):
 
             # Mock services request
             respx.get(
-                re.compile(r"^http://[^/]+/services\??.*$"),
+                re.compile(r"^http://[^/]+/services(\?.*)?$"),
                 content=(
                     ConnectTimeout()
                     if with_api_exception
@@ -112,7 +135,21 @@ class KaptenTestCase(asynctest.TestCase):
                     if not with_missing_services
                     else []
                 ),
-                alias="version",
+                alias="services",
+            )
+
+            # Mock service inspect request
+            respx.get(
+                re.compile(r"^http://[^/]+/services/(?P<service_id>[^/]+)$"),
+                content=partial(self.build_inspect_response, services=services),
+                alias="service",
+            )
+
+            # Mock events request
+            respx.get(
+                re.compile(r"^http://[^/]+/events\??.*$"),
+                content=events or "",
+                alias="events",
             )
 
             # Mock distribution request